@@ -1,6 +1,14 @@
 from gpt_neox.autoregressive_wrapper import AutoregressiveWrapper
 from gpt_neox.data_utils import get_tokenizer, read_enwik8_data
-from gpt_neox.datasets import TextSamplerDataset, GPT2Dataset
-from gpt_neox.gpt_neox import GPTNeoX, GPTNeoX_Pipe
+from gpt_neox.datasets import TextSamplerDataset, GPT2Dataset, StreamingTextDataset, MixtureDataset
+from gpt_neox.gpt_neox import GPTNeoX
 from gpt_neox.utils import *
 from gpt_neox.data_downloader_registry import prepare_data
+
+
+def __getattr__(name):
+    # heavy optional dependencies (deepspeed) are only imported when the feature that needs them is first used
+    if name == "GPTNeoX_Pipe":
+        from gpt_neox.gpt_neox_pipe import GPTNeoX_Pipe
+        return GPTNeoX_Pipe
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
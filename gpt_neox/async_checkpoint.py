@@ -0,0 +1,320 @@
+import glob
+import os
+import random
+import re
+import threading
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+"""
+Asynchronous training checkpoints.
+
+Training blocks only while the state (model, optimizer, scheduler, RNG and data position) is copied to CPU memory;
+serializing it, fsyncing and publishing it happen on a background thread while training continues. Each rank writes
+its own file, step_<N>/rank_<r>-of-<world>.pt, to a temporary name that is renamed into place once it is on disk, so a
+checkpoint is complete exactly when every rank's file exists - a run preempted mid-write resumes from the checkpoint
+before. The newest keep complete checkpoints are kept. The checkpoint directory has to be on a filesystem every rank
+sees.
+
+Configured by "checkpoint_dir", "checkpoint_every" (steps) and "keep_checkpoints" in the model config; get_checkpointer
+returns None without a checkpoint_dir, so checkpointing is opt-in. A run with checkpoints in its checkpoint_dir resumes
+from the newest one. Checkpoints are only taken right after an optimizer step (see optimizer_stepped) - with gradient
+accumulation, at the first one at or after every checkpoint_every steps.
+"""
+
+
+def _snapshot(obj, buffers, key=()):
+    # copies every tensor in a nest of dicts / lists / tuples to CPU, into the buffers of the last snapshot if they fit
+    if isinstance(obj, torch.Tensor):
+        buffer = buffers.get(key)
+        if buffer is None or buffer.shape != obj.shape or buffer.dtype != obj.dtype:
+            buffer = buffers[key] = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=obj.is_cuda)
+        return buffer.copy_(obj.detach(), non_blocking=obj.is_cuda)
+    if isinstance(obj, dict):
+        copy = type(obj)((k, _snapshot(v, buffers, key + (k,))) for k, v in obj.items())
+        if hasattr(obj, "_metadata"):
+            copy._metadata = obj._metadata  # module state dicts carry their version info here
+        return copy
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_snapshot(v, buffers, key + (i,)) for i, v in enumerate(obj))
+    return obj
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def rng_state():
+    # the numpy state as plain python values, so checkpoints load with torch.load(weights_only=True)
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    state = {"python": random.getstate(), "numpy": (name, keys.tolist(), pos, has_gauss, cached_gaussian),
+             "torch": torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    name, keys, pos, has_gauss, cached_gaussian = state["numpy"]
+    np.random.set_state((name, np.asarray(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian))
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+class AsyncCheckpointer:
+    """
+    saves this rank's training state to save_dir every save() call, in the background. At most one save is in
+    flight - a save() while the previous one is still writing waits for it - so at most one snapshot is held in memory
+    besides the training state itself. Errors from the background write are raised by the next save() or wait()
+    """
+    def __init__(self, save_dir, rank=0, world_size=1, keep=3):
+        assert keep >= 1
+        self.save_dir = save_dir
+        self.rank = rank
+        self.world_size = world_size
+        self.keep = keep
+        self._buffers = {}
+        self._thread = None
+        self._error = None
+        os.makedirs(save_dir, exist_ok=True)
+
+    def path(self, step, rank=None):
+        """the file rank (default: this rank) writes at step"""
+        rank = self.rank if rank is None else rank
+        return os.path.join(self.save_dir, f"step_{step}", f"rank_{rank}-of-{self.world_size}.pt")
+
+    def steps(self):
+        """steps with a complete checkpoint - a file from every rank - oldest first"""
+        steps = []
+        for path in glob.glob(os.path.join(self.save_dir, "step_*")):
+            match = re.fullmatch(r"step_(\d+)", os.path.basename(path))
+            if match and all(os.path.isfile(self.path(int(match.group(1)), rank)) for rank in range(self.world_size)):
+                steps.append(int(match.group(1)))
+        return sorted(steps)
+
+    def latest_step(self):
+        steps = self.steps()
+        return steps[-1] if steps else None
+
+    def save(self, step, state):
+        """snapshots state (a nest of dicts / lists of tensors and picklable values) and writes it in the background"""
+        self.wait()
+        snapshot = _snapshot(state, self._buffers)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()  # the copies to pinned memory are asynchronous
+        self._thread = threading.Thread(target=self._write, args=(step, snapshot), daemon=True)
+        self._thread.start()
+
+    def _write(self, step, snapshot):
+        try:
+            path = self.path(step)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                torch.save(snapshot, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+            _fsync_dir(os.path.dirname(path))
+            self._prune()
+        except BaseException as e:
+            self._error = e
+
+    def _prune(self):
+        # removes this rank's files from checkpoints older than the newest keep complete ones - including incomplete
+        # ones, which can never be completed. Whichever rank removes the last file removes the directory
+        steps = self.steps()
+        if len(steps) < self.keep:
+            return
+        oldest_kept = steps[-self.keep]
+        for path in glob.glob(os.path.join(self.save_dir, "step_*")):
+            match = re.fullmatch(r"step_(\d+)", os.path.basename(path))
+            if match and int(match.group(1)) < oldest_kept:
+                for f in glob.glob(os.path.join(path, f"rank_{self.rank}-of-*.pt*")):
+                    os.remove(f)
+                try:
+                    os.rmdir(path)
+                except OSError:
+                    pass  # other ranks' files are still there
+
+    def wait(self):
+        """waits for the save in flight, raising its error if it failed"""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("writing a checkpoint failed") from error
+
+    def load(self, step=None, rank=None):
+        """returns the state saved by rank (default: this rank) at step (default: the newest complete checkpoint)"""
+        step = self.latest_step() if step is None else step
+        if step is None:
+            return None
+        return torch.load(self.path(step, rank), map_location="cpu")
+
+
+class ResumableSampler(Sampler):
+    """
+    splits the indices of a map-style dataset between data parallel ranks like DistributedSampler, shuffled with a
+    new seeded permutation every epoch, and can start part way through an epoch
+    """
+    def __init__(self, dataset, rank=0, world_size=1, shuffle=True, seed=0):
+        self.n = len(dataset)
+        self.rank = rank
+        self.world_size = world_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch, self.start = 0, 0
+
+    def set_epoch(self, epoch, start=0):
+        """the next iteration is epoch, skipping the first start indices of this rank"""
+        self.epoch, self.start = epoch, start
+
+    def __iter__(self):
+        if self.shuffle:
+            g = torch.Generator()
+            g.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(self.n, generator=g)
+        else:
+            indices = torch.arange(self.n)
+        per_rank = self.n // self.world_size
+        return iter(indices[self.rank:per_rank * self.world_size:self.world_size][self.start:].tolist())
+
+    def __len__(self):
+        return self.n // self.world_size - self.start
+
+
+class ResumableLoader:
+    """
+    iterates a data loader epoch by epoch, counting the batches drawn, so that state_dict() - taken between steps -
+    records the position, and load_state_dict() continues from it. A resumed epoch starts part way through if the
+    loader's sampler is a ResumableSampler, restores the dataset's own state if it has one (MixtureDataset), and
+    otherwise draws and drops the batches already trained on - which only gives the same batches if the loader's
+    order doesn't depend on the global RNG
+    """
+    def __init__(self, loader, sampler=None, dataset=None):
+        self.loader = loader
+        self.sampler = sampler
+        self.dataset = dataset if dataset is not None and hasattr(dataset, "state_dict") else None
+        self.epoch, self.batches = 0, 0
+        self._skip = 0
+
+    def state_dict(self):
+        return {"epoch": self.epoch, "batches": self.batches,
+                "dataset": self.dataset.state_dict() if self.dataset is not None else None}
+
+    def load_state_dict(self, state):
+        self.epoch, self.batches = state["epoch"], state["batches"]
+        if self.dataset is not None:
+            self.dataset.load_state_dict(state["dataset"])
+        elif self.sampler is None:
+            self._skip = self.batches
+
+    def epoch_batches(self):
+        """yields the (rest of the) current epoch, then moves on to the next"""
+        if self.sampler is not None:
+            # loaders that draw whole batches through a BatchSampler have no batch_size of their own
+            batch_size = self.loader.batch_size or self.loader.sampler.batch_size
+            self.sampler.set_epoch(self.epoch, self.batches * batch_size)
+        # starting a DataLoader iterator draws a seed from the global RNG, which a resumed epoch would draw at a
+        # different point, and the RNG state restored already accounts for the batches skipped - so both use a copy
+        with torch.random.fork_rng(devices=[]):
+            batches = iter(self.loader)
+            for _ in range(self._skip):
+                next(batches, None)
+        self._skip = 0
+        for batch in batches:
+            self.batches += 1
+            yield batch
+        self.epoch, self.batches = self.epoch + 1, 0
+
+
+def engine_state(model_engine):
+    """the training state of a DeepSpeed engine: module, optimizer, scheduler and step counters"""
+    scheduler = model_engine.lr_scheduler
+    return {"module": model_engine.module.state_dict(),
+            "optimizer": model_engine.optimizer.state_dict() if model_engine.optimizer is not None else None,
+            "lr_scheduler": scheduler.state_dict() if scheduler is not None else None,
+            "global_steps": model_engine.global_steps,
+            "global_samples": getattr(model_engine, "global_samples", None),
+            "micro_steps": getattr(model_engine, "micro_steps", None),
+            "skipped_steps": model_engine.skipped_steps}
+
+
+def load_engine_state(model_engine, state, optimizer_states=None):
+    """
+    restores an engine_state(). ZeRO optimizers are restored from the optimizer states of every data parallel rank,
+    in rank order - optimizer_states - as they're partitioned between them
+    """
+    model_engine.module.load_state_dict(state["module"])
+    if model_engine.optimizer is not None:
+        if model_engine.zero_optimization():
+            model_engine.optimizer.load_state_dict(optimizer_states, load_optimizer_states=True,
+                                                   load_from_fp32_weights=model_engine.zero_load_from_fp32_weights())
+        else:
+            model_engine.optimizer.load_state_dict(state["optimizer"])
+    if model_engine.lr_scheduler is not None and state["lr_scheduler"] is not None:
+        model_engine.lr_scheduler.load_state_dict(state["lr_scheduler"])
+    model_engine.global_steps = state["global_steps"]
+    if state["global_samples"] is not None:
+        model_engine.global_samples = state["global_samples"]
+    model_engine.skipped_steps = state["skipped_steps"]
+    if state.get("micro_steps") is not None:
+        model_engine.micro_steps = state["micro_steps"]
+
+
+def optimizer_stepped(model_engine):
+    """
+    whether the last micro batch ended with an optimizer step. Accumulated gradients aren't checkpointed, so only then
+    does a checkpoint hold the whole training state
+    """
+    accumulation = model_engine.gradient_accumulation_steps
+    accumulation = accumulation() if callable(accumulation) else accumulation  # a method on DeepSpeed engines
+    return model_engine.micro_steps % accumulation == 0
+
+
+def training_state(step, model_engine, train_batches=None, seq_len_warmup=None):
+    """everything a training script needs to continue exactly from step: engine, RNG and data position"""
+    return {"step": step, "engine": engine_state(model_engine), "rng": rng_state(),
+            "data": train_batches.state_dict() if train_batches is not None else None,
+            "seq_len_warmup_step": seq_len_warmup.step if seq_len_warmup is not None else None}
+
+
+def resume(checkpointer, model_engine, train_batches=None, seq_len_warmup=None, dp_ranks=None):
+    """
+    restores the newest complete training_state() in checkpointer, returning the step it was taken at - or 0 if
+    there's none. dp_ranks are the ranks whose optimizer states make up a ZeRO optimizer's (default: all of them)
+    """
+    if checkpointer is None or checkpointer.latest_step() is None:
+        return 0
+    state = checkpointer.load()
+    optimizer_states = None
+    if model_engine.zero_optimization():
+        dp_ranks = range(checkpointer.world_size) if dp_ranks is None else dp_ranks
+        optimizer_states = [state["engine"]["optimizer"] if rank == checkpointer.rank else
+                            checkpointer.load(state["step"], rank)["engine"]["optimizer"] for rank in dp_ranks]
+    load_engine_state(model_engine, state["engine"], optimizer_states)
+    if train_batches is not None:
+        train_batches.load_state_dict(state["data"])
+    if seq_len_warmup is not None:
+        seq_len_warmup.step = state["seq_len_warmup_step"] or 0
+    set_rng_state(state["rng"])
+    print(f"Resumed from the checkpoint at step {state['step']} in {checkpointer.save_dir}")
+    return state["step"]
+
+
+def get_checkpointer(params, rank=0, world_size=1):
+    """returns the AsyncCheckpointer configured in params, or None if there's no "checkpoint_dir" """
+    if params.get("checkpoint_dir") is None:
+        return None
+    return AsyncCheckpointer(params["checkpoint_dir"], rank=rank, world_size=world_size,
+                             keep=params.get("keep_checkpoints", 3))
@@ -1,3 +1,5 @@
+import time
+
 import torch
 from torch import nn
 import torch.nn.functional as F
@@ -33,8 +35,13 @@ class AutoregressiveWrapper(nn.Module):
         self.net = net
         self.seq_len = net.seq_len
 
-    @torch.no_grad()
-    def generate(self, start_tokens, seq_len, eos_token = None, temperature = 1., filter_logits_fn = top_k, filter_thres = 0.9, **kwargs):
+    def generate_stream(self, start_tokens, seq_len, eos_token = None, temperature = 1., filter_logits_fn = top_k, filter_thres = 0.9, stop_sequences = None, max_time = None, **kwargs):
+        """
+        yields the sampled tokens of each step as soon as they're sampled - a (b,) tensor, or a scalar tensor for 1d
+        start_tokens. Decoding ends after seq_len steps, once every row has sampled eos_token or ended with one of
+        stop_sequences (lists of token ids, included in the output), or once max_time seconds have passed. If the
+        consumer stops iterating early, the model is put back in its previous mode and the sequence is freed.
+        """
         device = start_tokens.device
         was_training = self.net.training
         num_dims = len(start_tokens.shape)
@@ -43,6 +50,8 @@ class AutoregressiveWrapper(nn.Module):
             start_tokens = start_tokens[None, :]
 
         b, t = start_tokens.shape
+        stop_sequences = [torch.as_tensor(s, device=device) for s in (stop_sequences or [])]
+        deadline = time.perf_counter() + max_time if max_time is not None else None
 
         self.net.eval()
         out = start_tokens
@@ -51,28 +60,42 @@ class AutoregressiveWrapper(nn.Module):
         if mask is None:
             mask = torch.full_like(out, True, dtype=torch.bool, device=out.device)
 
-        for _ in range(seq_len):
-            x = out[:, -self.seq_len:]
-            mask = mask[:, -self.seq_len:]
-
-            logits = self.net(x, mask=mask, **kwargs)[:, -1, :]
-            filtered_logits = filter_logits_fn(logits, thres = filter_thres)
-            probs = F.softmax(filtered_logits / temperature, dim=-1)
-            sample = torch.multinomial(probs, 1)
-
-            out = torch.cat((out, sample), dim=-1)
-            mask = F.pad(mask, (0, 1), value=True)
-
-            if eos_token is not None and (sample == eos_token).all():
-                break
+        finished = torch.zeros(b, dtype=torch.bool, device=device)
+        try:
+            for _ in range(seq_len):
+                x = out[:, -self.seq_len:]
+                mask = mask[:, -self.seq_len:]
+
+                with torch.no_grad():
+                    logits = self.net(x, mask=mask, **kwargs)[:, -1, :].float()
+                    filtered_logits = filter_logits_fn(logits, thres = filter_thres)
+                    probs = F.softmax(filtered_logits / temperature, dim=-1)
+                    sample = torch.multinomial(probs, 1)
+
+                out = torch.cat((out, sample), dim=-1)
+                mask = F.pad(mask, (0, 1), value=True)
+
+                yield sample[0, 0] if num_dims == 1 else sample[:, 0]
+
+                if eos_token is not None:
+                    finished |= sample[:, 0] == eos_token
+                for stop in stop_sequences:
+                    if out.shape[1] - t >= len(stop):
+                        finished |= (out[:, -len(stop):] == stop).all(dim=-1)
+                if finished.all() or (deadline is not None and time.perf_counter() > deadline):
+                    break
+        finally:
+            # also runs when the consumer closes the generator, e.g. by breaking out of a for loop
+            del out, mask
+            self.net.train(was_training)
 
-        out = out[:, t:]
-
-        if num_dims == 1:
-            out = out.squeeze(0)
-
-        self.net.train(was_training)
-        return out
+    @torch.no_grad()
+    def generate(self, start_tokens, seq_len, eos_token = None, temperature = 1., filter_logits_fn = top_k, filter_thres = 0.9, **kwargs):
+        steps = list(self.generate_stream(start_tokens, seq_len, eos_token = eos_token, temperature = temperature,
+                                          filter_logits_fn = filter_logits_fn, filter_thres = filter_thres, **kwargs))
+        if not steps:
+            return start_tokens[..., :0]
+        return torch.stack(steps, dim=-1)
 
     def forward(self, x, **kwargs):
         xi = x[:, :-1]
@@ -85,9 +108,17 @@ class AutoregressiveWrapper(nn.Module):
             mask = mask[:, :-1]
             kwargs.update(mask = mask)
 
-        out = self.net(xi, **kwargs)
-
-        losses = F.cross_entropy(out.transpose(1, 2), xo, reduction='none', ignore_index = self.ignore_index)
+        head = self.net.to_logits
+        if hasattr(head, 'loss'):
+            # adaptive / sampled softmax heads compute the loss from the hidden states, without the logits of the
+            # whole vocabulary
+            hidden = self.net(xi, return_hidden = True, **kwargs)
+            with self.net.autocast(hidden.device):
+                losses = head.loss(hidden, xo, ignore_index = self.ignore_index)
+        else:
+            # the loss is computed in fp32 from logits that may be reduced precision
+            out = self.net(xi, **kwargs).float()
+            losses = F.cross_entropy(out.transpose(1, 2), xo, reduction='none', ignore_index = self.ignore_index)
         loss = losses.mean()
         
         return loss
@@ -0,0 +1,163 @@
+import json
+import os
+
+import numpy as np
+import torch
+
+"""
+A flat tensor file format for fast, low memory model loading.
+
+The file is an 8 byte magic, the 8 byte length of a JSON header, the header - mapping each tensor name to its dtype,
+shape and offset - and then the raw tensor data, each tensor aligned to 64 bytes. Loading memory maps the file, so
+tensors are views of the page cache rather than copies: startup costs no more than reading the header, and pages are
+only read in when a tensor is first used.
+
+Together with building the model on the meta device - which allocates and initializes nothing - parameters are
+materialized straight from the mapped file, instead of being initialized and then overwritten by a checkpoint.
+"""
+
+MAGIC = b"NEOXTENS"
+_ALIGN = 64
+
+_DTYPES = {"float32": torch.float32, "float16": torch.float16, "bfloat16": torch.bfloat16, "float64": torch.float64,
+           "int64": torch.int64, "int32": torch.int32, "int16": torch.int16, "int8": torch.int8, "uint8": torch.uint8,
+           "bool": torch.bool}
+_DTYPE_NAMES = {v: k for k, v in _DTYPES.items()}
+# numpy has no bfloat16, so those are mapped as int16 and reinterpreted
+_NUMPY_DTYPES = {"float32": np.float32, "float16": np.float16, "bfloat16": np.int16, "float64": np.float64,
+                 "int64": np.int64, "int32": np.int32, "int16": np.int16, "int8": np.int8, "uint8": np.uint8,
+                 "bool": np.bool_}
+
+
+def get_dtype(name):
+    """returns the torch dtype called name (e.g. "bfloat16"), or None for None"""
+    if name is None:
+        return None
+    if name not in _DTYPES:
+        raise ValueError(f"dtype {name} not recognized, should be one of {sorted(_DTYPES)}")
+    return _DTYPES[name]
+
+
+def is_tensor_file(path):
+    if not os.path.isfile(path):
+        return False
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def save_tensors(state_dict, path, dtype=None):
+    """
+    writes a state dict to path in the tensor file format, casting floating point tensors to dtype if given. Written
+    to a temporary file and renamed, so path is always a complete file
+    """
+    header, offset = {}, 0
+    tensors = {}
+    for name, tensor in state_dict.items():
+        tensor = tensor.detach().cpu()
+        if dtype is not None and tensor.is_floating_point():
+            tensor = tensor.to(dtype)
+        tensors[name] = tensor.contiguous()
+        nbytes = tensor.numel() * tensor.element_size()
+        header[name] = {"dtype": _DTYPE_NAMES[tensor.dtype], "shape": list(tensor.shape), "offset": offset}
+        offset += -(-nbytes // _ALIGN) * _ALIGN
+
+    header_bytes = json.dumps(header).encode()
+    header_bytes += b" " * (-(len(MAGIC) + 8 + len(header_bytes)) % _ALIGN)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC + len(header_bytes).to_bytes(8, "little") + header_bytes)
+        data_start = f.tell()
+        for name, tensor in tensors.items():
+            f.seek(data_start + header[name]["offset"])
+            if tensor.numel():
+                f.write(memoryview(tensor.reshape(-1).view(torch.uint8).numpy()))
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+def read_header(path):
+    """returns the header of a tensor file (name -> dtype, shape and offset) and where its data starts"""
+    with open(path, "rb") as f:
+        assert f.read(len(MAGIC)) == MAGIC, f"{path} is not a tensor file"
+        header_len = int.from_bytes(f.read(8), "little")
+        header = json.loads(f.read(header_len))
+    return header, len(MAGIC) + 8 + header_len
+
+
+def tensor_nbytes(info):
+    return int(np.prod(info["shape"], dtype=np.int64)) * np.dtype(_NUMPY_DTYPES[info["dtype"]]).itemsize
+
+
+def read_tensors(f, header, data_start, names, dtype=None):
+    """
+    reads the tensors called names from an open tensor file into newly allocated memory - unlike load_tensors, which
+    maps the whole file. Floating point tensors are cast to dtype if given
+    """
+    tensors = {}
+    for name in names:
+        info = header[name]
+        buffer = torch.empty(tensor_nbytes(info), dtype=torch.uint8)
+        f.seek(data_start + info["offset"])
+        f.readinto(memoryview(buffer.numpy()))
+        tensor = buffer.view(_DTYPES[info["dtype"]]).reshape(info["shape"])
+        if dtype is not None and tensor.is_floating_point() and tensor.dtype != dtype:
+            tensor = tensor.to(dtype)
+        tensors[name] = tensor
+    return tensors
+
+
+def load_tensors(path, dtype=None):
+    """
+    memory maps a tensor file, returning a dict of CPU tensors backed by the mapping. The mapping is copy-on-write, so
+    tensors can be modified without touching the file. Floating point tensors are cast to dtype if given, which
+    copies them
+    """
+    header, data_start = read_header(path)
+    data = np.memmap(path, dtype=np.uint8, mode="c")
+
+    tensors = {}
+    for name, info in header.items():
+        np_dtype = np.dtype(_NUMPY_DTYPES[info["dtype"]])
+        count = int(np.prod(info["shape"], dtype=np.int64))
+        start = data_start + info["offset"]
+        array = data[start:start + count * np_dtype.itemsize].view(np_dtype).reshape(info["shape"])
+        tensor = torch.from_numpy(array)
+        if info["dtype"] == "bfloat16":
+            tensor = tensor.view(torch.bfloat16)
+        if dtype is not None and tensor.is_floating_point() and tensor.dtype != dtype:
+            tensor = tensor.to(dtype)
+        tensors[name] = tensor
+    return tensors
+
+
+class _SkipMetaInit(torch.overrides.TorchFunctionMode):
+    # in-place ops on meta tensors (the initializers: normal_, uniform_, zero_, ...) compute nothing anyway, and the
+    # first one run in a process spends seconds importing meta kernels
+    def __torch_function__(self, func, types, args=(), kwargs=None):
+        kwargs = kwargs or {}
+        name = getattr(func, "__name__", "")
+        target = args[0] if args else kwargs.get("tensor")  # torch.nn.init functions take their tensor by keyword
+        if name.endswith("_") and not name.startswith("_") and isinstance(target, torch.Tensor) and target.is_meta:
+            return target
+        return func(*args, **kwargs)
+
+
+def build_on_meta(fn, *args, **kwargs):
+    """
+    calls fn (e.g. a model constructor) with every tensor it creates on the meta device, so nothing is allocated or
+    initialized. The module's parameters then have to be assigned, e.g. by load_state_dict(..., assign=True)
+    """
+    with torch.device("meta"), _SkipMetaInit():
+        return fn(*args, **kwargs)
+
+
+def materialize(module, state_dict, device="cpu"):
+    """
+    replaces the meta parameters and buffers of module with the tensors of state_dict, without copying them, and
+    moves the module to device. Raises if anything is missing or left on the meta device
+    """
+    module.load_state_dict(state_dict, assign=True)
+    left = [name for name, t in list(module.named_parameters()) + list(module.named_buffers()) if t.is_meta]
+    if left:
+        raise RuntimeError(f"no tensors in the checkpoint for {left}")
+    return module.to(device)
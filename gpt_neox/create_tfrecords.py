@@ -7,15 +7,26 @@ import tensorflow as tf
 from lm_dataformat import Reader
 from tqdm import tqdm
 import logging
-from multiprocessing import Pool, cpu_count
-from itertools import repeat
+import queue
+import threading
+import time
+from multiprocessing import Pool, cpu_count, current_process
+from itertools import repeat, chain
+import shutil
+from functools import partial
+from glob import glob
+import json
+import re
+import numpy as np
 from data_utils import get_tokenizer
+from dedup import DedupIndex, Deduplicator, MinHasher
 
 logging.getLogger("transformers").setLevel(logging.ERROR)
 
 parser = argparse.ArgumentParser()
-parser.add_argument("--mode", type=str, choices=["chunks", "documents"], default="documents",
-                    help="Whether a tfrecord example is a constant sized chunk or a full document")
+parser.add_argument("--mode", type=str, choices=["chunks", "documents"], default="chunks",
+                    help="Whether to write constant sized chunks to tfrecords, or full documents to .docs files with "
+                         "an index of document offsets, to be packed into sequences at training time")
 parser.add_argument("--input_dir", type=str, help="Path to where your files are located. Files ending in .zst are treated as \
                     archives, all others as raw text.")
 parser.add_argument("--files_per", type=int, default=100000, help="Text files per tfrecord")
@@ -24,6 +35,8 @@ parser.add_argument("--name", type=str, default="openwebtext",
 parser.add_argument("--output_dir", type=str, default="./tfrecords", help="Where to put tfrecords")
 parser.add_argument("--encoder_path", type=str,
                     help="Path to encoder files, or leave unspecified to use GPT2 tokenizer")
+parser.add_argument("--tokenizer", type=str, default="hf_gpt2tokenizerfast",
+                    help="Tokenizer type, one of the types supported by data_utils.get_tokenizer")
 parser.add_argument("--minimum_size", type=int, default=100, help="Minimum size a document has to be to be included")
 parser.add_argument("--ftfy", action="store_false", help="normalize with ftfy")
 parser.add_argument("--separator", nargs="+", type=int, default=[50256],
@@ -32,6 +45,28 @@ parser.add_argument("--chunk_size", type=int, default=2048, help="How big a chun
                                                                  "Should equal your model's context size")
 parser.add_argument("--write_dataset_config", action="store_true", help="Write the dataset config file on completion")
 parser.add_argument("--processes", type=int, default=0, help="Number of processes to use. Defaults to cpu count.")
+parser.add_argument("--resume", action="store_true",
+                    help="Resume each worker from its checkpoint journal in output_dir, if present")
+parser.add_argument("--shard_bytes", type=int, default=0,
+                    help="Also start a new tfrecord once a shard reaches this many bytes. 0 disables the limit.")
+parser.add_argument("--dedup", type=str, choices=["none", "exact", "minhash"], default="none",
+                    help="Drop exact duplicate documents, or exact and near duplicates (MinHash / LSH)")
+parser.add_argument("--dedup_dir", type=str, default=None,
+                    help="Where to store the dedup index. Defaults to <output_dir>/dedup_index")
+parser.add_argument("--dedup_shards", type=int, default=16, help="Number of sqlite files to shard the dedup index over")
+parser.add_argument("--minhash_perms", type=int, default=128, help="Number of MinHash permutations")
+parser.add_argument("--minhash_bands", type=int, default=16,
+                    help="Number of LSH bands. More bands catch less similar documents")
+parser.add_argument("--shingle_size", type=int, default=5, help="Number of tokens per MinHash shingle")
+parser.add_argument("--tasks_per_process", type=int, default=4,
+                    help="Number of size-balanced tasks to split the input into per process")
+parser.add_argument("--tokenize_batch_size", type=int, default=256,
+                    help="Number of documents to normalize and batch encode at once")
+parser.add_argument("--ftfy_workers", type=int, default=0,
+                    help="Worker processes for ftfy normalization when running with a single process. "
+                         "0 normalizes in a background thread of the main process.")
+parser.add_argument("--queue_size", type=int, default=8,
+                    help="Maximum number of document batches buffered between pipeline stages")
 
 args = parser.parse_args()
 if not args.output_dir.endswith("/"):
@@ -50,13 +85,15 @@ def _int64_feature(value):
 
 def write_to_file(writer, data):
     """
-    writes data to tfrecord file
+    writes data to tfrecord file, and returns the number of bytes written
     """
     feature = {
         "text": _int64_feature(data)
     }
     tf_example = tf.train.Example(features=tf.train.Features(feature=feature))
-    writer.write(tf_example.SerializeToString())
+    serialized = tf_example.SerializeToString()
+    writer.write(serialized)
+    return len(serialized)
 
 
 def split_list(l, n):
@@ -64,40 +101,215 @@ def split_list(l, n):
     return [l[i:i + n] for i in range(0, len(l), n)]
 
 
-def archive_to_tokens(f, encoder, args):
-    # Generator that yields the contents of the files in an archive
-    # if data_to_prepend is not None, prepend data_to_prepend + a EOS separator to the encoded data
-    reader = Reader(f)
-    for doc in reader.stream_data(threaded=False):
-        if args.ftfy:  # fix text with ftfy if specified
-            doc = ftfy.fix_text(doc, normalization='NFKC')
-        doc = encoder.encode(doc) + args.separator  # read document from lmd and append separator token
-        yield split_list(doc, args.chunk_size)  # split into n_ctx + 1 size chunks
+class StageStats:
+    """
+    accumulates documents / tokens processed and busy time for one stage of the tokenization pipeline
+    """
+    def __init__(self, name):
+        self.name = name
+        self.docs = 0
+        self.tokens = 0
+        self.seconds = 0.
+
+    def update(self, docs, tokens, seconds):
+        self.docs += docs
+        self.tokens += tokens
+        self.seconds += seconds
+
+    def __str__(self):
+        seconds = max(self.seconds, 1e-9)
+        return f"{self.name}: {self.docs / seconds:.1f} docs/s, {self.tokens / seconds:.1f} tokens/s " \
+               f"({self.docs} docs, {self.tokens} tokens, {self.seconds:.1f}s busy)"
+
+
+def init_stats():
+    return {name: StageStats(name) for name in ["read", "normalize", "tokenize", "write"]}
+
+
+_DONE = object()
+
+
+class _StageError:
+    def __init__(self, exc):
+        self.exc = exc
+
+
+def _run_stage(source, fn, out_q, stats=None):
+    # pulls batches from source, applies fn and pushes the results to the bounded out_q. Exceptions are forwarded
+    # downstream so they are re-raised in the consuming thread.
+    try:
+        for batch in source:
+            if isinstance(batch, _StageError):
+                out_q.put(batch)
+                return
+            t = time.perf_counter()
+            out = fn(batch)
+            if stats is not None:
+                stats.update(len(out), sum(len(doc) for doc in out) if stats.name == "tokenize" else 0,
+                             time.perf_counter() - t)
+            out_q.put(out)
+    except BaseException as e:
+        out_q.put(_StageError(e))
+        return
+    out_q.put(_DONE)
+
+
+def _drain(q):
+    # iterates over a queue filled by _run_stage until the end marker
+    while True:
+        item = q.get()
+        if item is _DONE:
+            return
+        yield item
+
+
+def _read_batches(f, batch_size, stats, start_doc=0):
+    # yields lists of batch_size documents from an archive, timing decompression / parsing only
+    # f is either a path, or a (path, part, n_parts) tuple to only read every n_parts-th document starting at part
+    # the first start_doc documents are skipped here, before they're normalized or tokenized
+    path, part, n_parts = f if isinstance(f, (tuple, list)) else (f, 0, 1)
+    batch = []
+    t = time.perf_counter()
+    for doc_no, doc in enumerate(Reader(path).stream_data(threaded=False)):
+        if doc_no % n_parts != part or doc_no // n_parts < start_doc:
+            continue
+        batch.append(doc)
+        if len(batch) == batch_size:
+            stats.update(len(batch), 0, time.perf_counter() - t)
+            yield batch
+            batch = []
+            t = time.perf_counter()
+    if batch:
+        stats.update(len(batch), 0, time.perf_counter() - t)
+        yield batch
+
+
+def _fix_text(doc):
+    return ftfy.fix_text(doc, normalization='NFKC')
+
+
+def archive_to_tokens(f, encoder, args, stats=None, pool=None, start_doc=0):
+    # Generator that yields the contents of the files in an archive, split into chunk_size chunks
+    # documents are read, ftfy normalized (in the worker pool, if given) and batch encoded in background threads
+    # connected by bounded queues, so decompression, normalization, tokenization and writing all overlap
+    if stats is None:
+        stats = init_stats()
+
+    def normalize(batch):
+        if not args.ftfy:  # fix text with ftfy if specified
+            return batch
+        if pool is not None:
+            return pool.map(_fix_text, batch, chunksize=max(1, len(batch) // (4 * args.ftfy_workers)))
+        return [_fix_text(doc) for doc in batch]
+
+    def tokenize(batch):
+        return encoder(batch)["input_ids"]
+
+    stages = [(lambda batch: batch, None), (normalize, stats["normalize"]), (tokenize, stats["tokenize"])]
+    source = _read_batches(f, args.tokenize_batch_size, stats["read"], start_doc=start_doc)
+    for fn, stage_stats in stages:
+        out_q = queue.Queue(maxsize=args.queue_size)
+        threading.Thread(target=_run_stage, args=(source, fn, out_q, stage_stats), daemon=True).start()
+        source = _drain(out_q)
+
+    for batch in source:
+        if isinstance(batch, _StageError):
+            raise batch.exc
+        t = time.perf_counter()
+        for doc in batch:
+            doc = doc + args.separator  # append separator token
+            if args.mode == "documents":
+                yield [doc]  # keep documents whole
+            else:
+                yield split_list(doc, args.chunk_size)  # split into n_ctx + 1 size chunks
+        stats["write"].update(len(batch), sum(len(doc) for doc in batch), time.perf_counter() - t)
+
+
+class ShardWriter:
+    """
+    streams chunks into tfrecord shards as soon as they're ready, starting a new shard every files_per chunks (or
+    max_bytes serialized bytes, if set). Shards are written to a .tmp file and renamed to
+    <name>_<shard_no>[_<process_no>]_<n_chunks>.tfrecords once complete, so only one chunk is ever held in memory.
+    """
+    extensions = [".tfrecords"]
+
+    def __init__(self, output_dir, out_name, files_per, max_bytes=0, start_no=0, process_no=None):
+        self.output_dir = output_dir
+        self.out_name = out_name
+        self.files_per = files_per
+        self.max_bytes = max_bytes
+        self.shard_no = start_no
+        self.process_no = process_no
+        self._writer = None
+        self._count = 0
+        self._bytes = 0
+
+    def _shard_prefix(self):
+        fp = os.path.join(self.output_dir, f"{self.out_name}_{self.shard_no}")
+        if self.process_no is not None:
+            fp += f"_{self.process_no}"
+        return fp
+
+    def _open(self):
+        self._writer = tf.io.TFRecordWriter(self._shard_prefix() + ".tfrecords.tmp")
+
+    def _write_record(self, data):
+        return write_to_file(self._writer, data)
+
+    def _close(self):
+        self._writer.close()
+
+    def write(self, data):
+        """
+        writes one chunk, and returns True if this completed a shard
+        """
+        if self._writer is None:
+            self._open()
+            self._count, self._bytes = 0, 0
+        self._bytes += self._write_record(data)
+        self._count += 1
+        if self._count >= self.files_per or (self.max_bytes and self._bytes >= self.max_bytes):
+            self.close_shard()
+            return True
+        return False
+
+    def close_shard(self, keep=True):
+        # finalizes the open shard (if any), or deletes it if keep is False
+        if self._writer is None:
+            return
+        self._close()
+        self._writer = None
+        prefix = self._shard_prefix()
+        for ext in self.extensions:
+            if keep:
+                # add number of chunks in shard to end of fp
+                os.replace(prefix + ext + ".tmp", prefix + f"_{self._count}" + ext)
+            else:
+                os.remove(prefix + ext + ".tmp")
+        if keep:
+            self.shard_no += 1
+
+
+class DocumentShardWriter(ShardWriter):
+    """
+    writes whole documents into shards made of a flat int32 token file (<name>_..._<n_docs>.docs) and an int64 index
+    of document start offsets into it (<name>_..._<n_docs>.docs.idx, n_docs + 1 entries).
+    """
+    extensions = [".docs", ".docs.idx"]
 
+    def _open(self):
+        self._writer = open(self._shard_prefix() + ".docs.tmp", "wb")
+        self._offsets = [0]
 
-def write_files(files, files_per, output_dir, out_name, start_no, write_remainder=False, process_no=None):
-    # writes a list of files to .tfrecords
-    if files == None:
-        return
-    chunks = split_list(files, files_per)
+    def _write_record(self, data):
+        tokens = np.asarray(data, dtype=np.int32)
+        self._writer.write(tokens.tobytes())
+        self._offsets.append(self._offsets[-1] + len(tokens))
+        return tokens.nbytes
 
-    if len(chunks[-1]) != files_per and not write_remainder:  # pop the last file if it's length != files per
-        remainder = chunks.pop(-1)
-    else:
-        remainder = None  # assuming files = remainder from an old chunk here
-        files_per = len(chunks[-1])
-
-    for files in chunks:
-        fp = f"{output_dir}/{out_name}_{start_no}"
-        if process_no is not None:
-            fp += f"_{process_no}"
-        fp += f"_{files_per}"  # add number of files in tfrecord to end of fp
-        fp += ".tfrecords"
-        with tf.io.TFRecordWriter(fp) as writer:
-            for f in files:
-                write_to_file(writer, f)
-        start_no += 1
-    return start_no, remainder
+    def _close(self):
+        self._writer.close()
+        np.asarray(self._offsets, dtype=np.int64).tofile(self._shard_prefix() + ".docs.idx.tmp")
 
 
 def get_files(input_dir, filetypes=None):
@@ -105,101 +317,224 @@ def get_files(input_dir, filetypes=None):
     if filetypes == None:
         filetypes = ["jsonl.zst", ".txt", ".xz", ".tar.gz"]
     files = [list(Path(input_dir).glob(f"*{ft}")) for ft in filetypes]
-    return [str(item) for sublist in files for item in sublist]  # flatten list of list -> list and stringify Paths
-
+    # flatten list of list -> list and stringify Paths. Sorted so task assignment is stable across restarts
+    return sorted(str(item) for sublist in files for item in sublist)
 
-def read_checkpoint(checkpoint_path, resume_from_checkpoint=True):
-    # init checkpointing
-    if resume_from_checkpoint and os.path.isfile(checkpoint_path):
-        try:
-            resume_files_processed, tfrecord_count = [int(i) for i in open(checkpoint_path, "r").read().split(", ")]
-            print(f"\nResuming from tfrecord no. {tfrecord_count} / file no. {resume_files_processed}")
-            return resume_files_processed, tfrecord_count
-        except:
-            pass
-    return 0, 0
 
-
-def create_tfrecords(params, write_remainder=True, write_every_n_files=1, save_checkpoints=False,
-                     resume_from_checkpoint=False, display_pbar=False):
+def read_journal(journal_path, files):
+    """
+    reads a worker's resume journal. Returns None if there's no journal, or it was written for a different set of
+    input files.
+    """
+    if not os.path.isfile(journal_path):
+        return None
+    try:
+        with open(journal_path, "r") as journal_file:
+            state = json.load(journal_file)
+    except (OSError, ValueError):
+        logging.warning(f"Could not read {journal_path}, starting from scratch")
+        return None
+    if state.get("files") != json.loads(json.dumps(files)):
+        logging.warning(f"{journal_path} was written for different input files, starting from scratch")
+        return None
+    return state
+
+
+def write_journal(journal_path, **state):
+    # written to a temporary file and renamed, so a crash never leaves a half written journal
+    tmp_path = journal_path + ".tmp"
+    with open(tmp_path, "w") as journal_file:
+        json.dump(state, journal_file)
+        journal_file.flush()
+        os.fsync(journal_file.fileno())
+    os.replace(tmp_path, journal_path)
+
+
+def remove_partial_shards(output_dir, out_name, process_no, start_no):
+    # removes unfinished (.tmp) shards and any shards numbered >= start_no written by this worker after its last
+    # journal entry, as they'll be rewritten on resume
+    for fp in glob(os.path.join(output_dir, f"{out_name}_*_{process_no}*")):
+        match = re.match(re.escape(f"{out_name}_") + rf"(\d+)_{process_no}(_\d+)?\.(tfrecords|docs|docs\.idx)(\.tmp)?$",
+                         os.path.basename(fp))
+        if match is not None and (match.group(4) is not None or int(match.group(1)) >= start_no):
+            os.remove(fp)
+
+
+def get_deduplicator(args):
+    # every worker opens the same on-disk index, so duplicates are found across the whole process pool
+    if args.dedup == "none":
+        return None
+    index = DedupIndex(get_dedup_dir(args), n_shards=args.dedup_shards)
+    minhasher = MinHasher(num_perm=args.minhash_perms, bands=args.minhash_bands, shingle_size=args.shingle_size)
+    return Deduplicator(index, mode=args.dedup, minhasher=minhasher)
+
+
+def get_dedup_dir(args):
+    return args.dedup_dir if args.dedup_dir is not None else os.path.join(args.output_dir, "dedup_index")
+
+
+def get_metadata(files_processed, discarded_files, dedup_stats):
+    duplicates = dedup_stats.get("exact_duplicates", 0) + dedup_stats.get("near_duplicates", 0)
+    successful_files = files_processed - discarded_files - duplicates
+    return {"discarded": discarded_files, "processed": files_processed, "successful": successful_files, **dedup_stats}
+
+
+def create_tfrecords(params, write_remainder=True, save_checkpoints=False, resume_from_checkpoint=False,
+                     display_pbar=False):
     # iterates through files in input_dir, splitting into <args.chunk_size> chunks and saving a tfrecords file every <args.files_per> chunks.
     files, args, process_no = params
-    enc = get_tokenizer()  # get tokenizer
+    # pool workers are daemonic and can't have children, so ftfy only gets its own pool in single process mode
+    use_pool = args.ftfy and args.ftfy_workers > 0 and not current_process().daemon
+    ftfy_pool = Pool(processes=args.ftfy_workers) if use_pool else None
+    enc = get_tokenizer(tokenizer_type=args.tokenizer)  # get tokenizer
+    stats = init_stats()
 
     # init metadata
     discarded_files = 0
     files_processed = 0
     pbar = tqdm(desc=f"Writing TFRecord Files to {args.output_dir}. Parsed 0 input files. files_written ",
                 disable=not display_pbar)
-    checkpoint_path = f"{args.output_dir}/checkpoint.txt"
-    resume_files_processed, tfrecord_count = read_checkpoint(checkpoint_path, resume_from_checkpoint)
+    tfrecord_count = 0
+    data_to_prepend = np.empty(0, dtype=np.int32)  # tokens carried over from the ends of documents
+    dedup = get_deduplicator(args)
+
+    # each worker journals its position in its own file, recording the state from *before* the document that
+    # was being written when a shard was completed, so resuming can replay that document exactly
+    journal_path = os.path.join(args.output_dir, f"checkpoint_{process_no}.json")
+    state = read_journal(journal_path, files) if resume_from_checkpoint else None
+    start_file, start_doc, skip_chunks = 0, 0, 0
+    if state is not None:
+        if state["done"]:
+            print(f"\nWorker {process_no} already finished, skipping")
+            return get_metadata(state["processed"], state["discarded"], state.get("dedup", {}))
+        start_file, start_doc, skip_chunks = state["file_idx"], state["doc_no"], state["chunks_done"]
+        tfrecord_count = state["shard_no"]
+        files_processed, discarded_files = state["processed"], state["discarded"]
+        data_to_prepend = np.asarray(state["carry"], dtype=np.int32)
+        if dedup is not None:
+            dedup.load_stats(state.get("dedup", dedup.stats()))
+        print(f"\nResuming from tfrecord no. {tfrecord_count} / file no. {start_file} / document no. {start_doc}")
+    remove_partial_shards(args.output_dir, args.name, process_no, tfrecord_count)
+
+    writer_class = DocumentShardWriter if args.mode == "documents" else ShardWriter
+    writer = writer_class(args.output_dir, args.name, files_per=args.files_per, max_bytes=args.shard_bytes,
+                          start_no=tfrecord_count, process_no=process_no)
+
+    for file_idx, f in enumerate(files):
+        if file_idx < start_file:
+            continue
+        first_doc = start_doc if file_idx == start_file else 0
+        for doc_no, tokenized_files in enumerate(archive_to_tokens(f, enc, args, stats=stats, pool=ftfy_pool,
+                                                                   start_doc=first_doc), start=first_doc):
+            doc_state = {"file_idx": file_idx, "doc_no": doc_no, "carry": data_to_prepend,
+                         "processed": files_processed, "discarded": discarded_files,
+                         "dedup": dedup.stats() if dedup is not None else {}}
+            files_processed += 1
 
-    data_to_prepend = []
-    tokenized_files_array = []
+            if dedup is not None:
+                doc_tokens = np.fromiter(chain.from_iterable(tokenized_files), dtype=np.int64)
+                if dedup.is_duplicate(doc_tokens, doc_id=f"{process_no}:{file_idx}:{doc_no}"):
+                    continue
 
-    for f in files:
-        for tokenized_files in archive_to_tokens(f, enc, args):
-            files_processed += 1
-            if files_processed < resume_files_processed:
-                continue  # resume from checkpoint
+            if args.mode == "documents":
+                if len(tokenized_files[0]) < args.minimum_size:
+                    discarded_files += 1
+                    continue
 
             # if the last chunk < chunk size, but > minimum_size, take it and append it to the beginning of the next file
             n_tokens = len(tokenized_files[-1])
-            if n_tokens < args.chunk_size:
+            if args.mode == "chunks" and n_tokens < args.chunk_size:
                 data = tokenized_files.pop(-1)
                 if n_tokens >= args.minimum_size:
-                    data_to_prepend.extend(data)
+                    data_to_prepend = np.concatenate([data_to_prepend, np.asarray(data, dtype=np.int32)])
                 else:
                     discarded_files += 1
 
             if len(data_to_prepend) >= args.chunk_size:
-                # if length of data_to_prepend becomes greater than chunk size, add concatted files to tokenized files
-                tokenized_files_array.append(data_to_prepend[:args.chunk_size])
-                data_to_prepend = data_to_prepend[args.chunk_size:]
-            # add tokenized files > chunk size to main array
-            tokenized_files_array.extend(tokenized_files)
-
-            if len(tokenized_files_array) >= args.files_per * write_every_n_files:  # write every n files
-                _tfrecord_count, remainder = write_files(tokenized_files_array, files_per=args.files_per,
-                                                         output_dir=args.output_dir, out_name=args.name,
-                                                         start_no=tfrecord_count, process_no=process_no)
-                pbar.update(_tfrecord_count - tfrecord_count)  # update progress bar
-                pbar.set_description(
-                    f"Writing TFRecord Files to {args.output_dir}. Parsed {files_processed} input files. files_written ")
-                tfrecord_count = _tfrecord_count
-                tokenized_files_array = remainder if remainder is not None else []  # add remaining files to next chunk
-                with open(checkpoint_path, "w") as checkpoint_file:
-                    checkpoint_file.write(f"{files_processed}, {tfrecord_count}")
-
-    if len(tokenized_files_array) >= args.files_per:  # also write at end
-        _tfrecord_count, remainder = write_files(tokenized_files_array, files_per=args.files_per,
-                                                 output_dir=args.output_dir, out_name=args.name,
-                                                 start_no=tfrecord_count, process_no=process_no)
-        pbar.update(_tfrecord_count - tfrecord_count)
-        pbar.set_description(
-            f"Writing TFRecord Files to {args.output_dir}. Parsed {files_processed} input files. files_written ")
-        tfrecord_count = _tfrecord_count
-        with open(checkpoint_path, "w") as checkpoint_file:
-            checkpoint_file.write(f"{files_processed}, {tfrecord_count}")
-    else:
-        remainder = tokenized_files_array  # add remaining to remainder
+                # if length of data_to_prepend becomes greater than chunk size, write out the concatted files
+                tokenized_files.insert(0, data_to_prepend[:args.chunk_size].tolist())
+                data_to_prepend = data_to_prepend[args.chunk_size:].copy()
+
+            # stream every finished chunk straight into the open shard
+            for chunk_no, chunk in enumerate(tokenized_files):
+                if chunk_no < skip_chunks:
+                    continue  # already written before resuming
+                if writer.write(chunk):
+                    tfrecord_count = writer.shard_no
+                    pbar.update()  # update progress bar
+                    pbar.set_description(
+                        f"Writing TFRecord Files to {args.output_dir}. Parsed {files_processed} input files. files_written ")
+                    write_journal(journal_path, files=files, shard_no=tfrecord_count, chunks_done=chunk_no + 1,
+                                  done=False, **dict(doc_state, carry=doc_state["carry"].tolist()))
+            skip_chunks = 0
+
+    # write out the remaining files even if there's less than files_per
+    writer.close_shard(keep=write_remainder)
+    dedup_stats = dedup.stats() if dedup is not None else {}
+    write_journal(journal_path, files=files, shard_no=writer.shard_no, file_idx=len(files), doc_no=0, chunks_done=0,
+                  carry=[], processed=files_processed, discarded=discarded_files, dedup=dedup_stats, done=True)
+    if dedup is not None:
+        dedup.index.close()
+
+    if ftfy_pool is not None:
+        ftfy_pool.close()
+        ftfy_pool.join()
+    for stage_stats in stats.values():
+        print(f"process {process_no} - {stage_stats}")
+
+    return get_metadata(files_processed, discarded_files, dedup_stats)
+
+
+def schedule_tasks(files, n_tasks, max_parts=None):
+    """
+    splits files into roughly n_tasks tasks of equal compressed size.
 
-    if write_remainder:
-        # write out the remaining files even if there's less than files_per
-        write_files(remainder, files_per=args.files_per, output_dir=args.output_dir, out_name=args.name,
-                    start_no=tfrecord_count, write_remainder=True)
+    archives larger than the target task size are split into several tasks that each read every n-th document
+    (a (path, part, n_parts) tuple), and smaller files are grouped together. Tasks are returned largest first, and
+    their order - which determines the task number in output filenames - only depends on the input files.
 
-    successful_files = files_processed - discarded_files
-    return {"discarded": discarded_files, "processed": files_processed, "successful": successful_files}
+    zstd streams can't seek, so every part of a split archive decompresses and parses all of it: an archive in n parts
+    is read n times. Archives are split into at most max_parts parts (the number of processes) - more parts than
+    processes can read at once add no parallelism, only reads.
+    """
+    sizes = {f: os.path.getsize(f) for f in files}
+    target = max(1, sum(sizes.values()) // max(1, n_tasks))
+
+    tasks = []
+    group, group_size = [], 0
+    for f in sorted(files, key=lambda f: (-sizes[f], f)):
+        n_parts = -(-sizes[f] // target)  # ceil
+        if max_parts is not None:
+            n_parts = min(n_parts, max_parts)
+        if n_parts > 1:
+            tasks += [([(f, part, n_parts)], sizes[f] / n_parts) for part in range(n_parts)]
+            continue
+        group.append(f)
+        group_size += sizes[f]
+        if group_size >= target:
+            tasks.append((group, group_size))
+            group, group_size = [], 0
+    if group:
+        tasks.append((group, group_size))
+
+    tasks.sort(key=lambda task: -task[1])  # stable, so ties keep their deterministic order
+    return [task_files for task_files, _ in tasks]
 
 
 def create_tfrecords_mp(files, args):
-    files = split_list(files, len(files) // args.processes)
-    with Pool(processes=args.processes) as pool:
-        pbar = tqdm(pool.imap(create_tfrecords, zip(files, repeat(args), range(len(files)))))
-        meta = {"discarded": 0, "processed": 0, "successful": 0}
+    # tasks are pulled from a shared queue one at a time, so idle processes pick up the remaining work. Output
+    # files are named by task number rather than by worker, so they don't depend on process timing.
+    tasks = schedule_tasks(files, args.processes * args.tasks_per_process, max_parts=args.processes)
+    meta = {"discarded": 0, "processed": 0, "successful": 0}
+    if args.dedup != "none":
+        meta.update(exact_duplicates=0, near_duplicates=0, duplicate_tokens=0)
+    if not tasks:
+        return meta
+    worker = partial(create_tfrecords, resume_from_checkpoint=args.resume)
+    with Pool(processes=min(args.processes, len(tasks))) as pool:
+        pbar = tqdm(pool.imap_unordered(worker, zip(tasks, repeat(args), range(len(tasks))), chunksize=1),
+                    total=len(tasks))
         for results in pbar:
-            pbar.update()
             for k, v in results.items():
                 meta[k] += v  # update metadata
         return meta
@@ -207,6 +542,8 @@ def create_tfrecords_mp(files, args):
 
 if __name__ == "__main__":
     os.makedirs(args.output_dir, exist_ok=True)  # make output dir if it doesn't exist
+    if args.dedup != "none" and not args.resume:
+        shutil.rmtree(get_dedup_dir(args), ignore_errors=True)  # start from an empty dedup index
     files = get_files(args.input_dir)
     args.chunk_size += 1  # we shift the data by 1 to the right for targets, so increment the chunk size here
 
@@ -215,5 +552,5 @@ if __name__ == "__main__":
     if args.processes > 1:
         results = create_tfrecords_mp(files, args)
     else:
-        results = create_tfrecords((files, args, 0), display_pbar=True)
+        results = create_tfrecords((files, args, 0), resume_from_checkpoint=args.resume, display_pbar=True)
     print(results)
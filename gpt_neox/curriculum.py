@@ -0,0 +1,88 @@
+import torch
+
+"""
+Sequence length warmup: training starts on short sequences and ramps up to the model's full seq_len, keeping the
+number of tokens per step constant by training on proportionally more sequences per step.
+
+Configured with a "seq_len_warmup" section in the model config, e.g.
+
+    "seq_len_warmup": {"start_seq_len": 64, "warmup_steps": 10000, "mode": "rechunk", "multiple_of": 8}
+
+mode "rechunk" cuts each seq_len + 1 sample into k shorter sequences, overlapping by the one token that's both the
+last target of one piece and the first input of the next, so no tokens are wasted. mode "truncate" keeps only the
+start of each sample, and draws k batches from the loader per step to make up the tokens.
+"""
+
+
+class SeqLenWarmup:
+    def __init__(self, seq_len, start_seq_len, warmup_steps, mode="rechunk", multiple_of=8, schedule="linear"):
+        assert mode in ["rechunk", "truncate"], f"seq_len_warmup mode {mode} not recognized"
+        assert schedule in ["linear", "geometric"], f"seq_len_warmup schedule {schedule} not recognized"
+        assert 0 < start_seq_len <= seq_len
+        self.seq_len = seq_len
+        self.start_seq_len = start_seq_len
+        self.warmup_steps = warmup_steps
+        self.mode = mode
+        self.multiple_of = multiple_of
+        self.schedule = schedule
+        self.step = 0  # steps taken so far - set this when resuming
+        self.current_seq_len, self.current_split = seq_len, 1
+
+    def target_seq_len(self, step):
+        progress = min(step / max(self.warmup_steps, 1), 1.0)
+        if self.schedule == "linear":
+            return self.start_seq_len + (self.seq_len - self.start_seq_len) * progress
+        return self.start_seq_len * (self.seq_len / self.start_seq_len) ** progress
+
+    def split_at(self, step):
+        """
+        returns (seq_len, k): each full length sample becomes k sequences of seq_len, with seq_len * k <= the full
+        seq_len, so the shortest length is at least the scheduled one and at most multiple_of tokens per sample are
+        dropped
+        """
+        if step >= self.warmup_steps:
+            return self.seq_len, 1
+        k = max(1, int(self.seq_len // self.target_seq_len(step)))
+        seq_len = self.seq_len // k
+        if seq_len >= self.multiple_of:
+            seq_len -= seq_len % self.multiple_of
+        return seq_len, k
+
+    def _rechunk(self, batch, seq_len, k):
+        # (b, full_seq_len + 1) -> (b * k, seq_len + 1) windows at a stride of seq_len, without a copy until reshape
+        return batch.unfold(1, seq_len + 1, seq_len)[:, :k].reshape(-1, seq_len + 1)
+
+    def batches(self, loader):
+        """
+        reshapes the (b, seq_len + 1) batches of loader - tensors, or tuples of tensors such as (tokens, segment_ids)
+        - to the length scheduled for each step. Every batch yielded counts as a step
+        """
+        it = iter(loader)
+        for batch in it:
+            seq_len, k = self.split_at(self.step)
+            self.current_seq_len, self.current_split = seq_len, k
+            if k == 1:
+                yield batch
+            elif self.mode == "rechunk":
+                yield _map(lambda t: self._rechunk(t, seq_len, k), batch)
+            else:
+                extra = [b for _, b in zip(range(k - 1), it)]
+                yield _map(lambda *ts: torch.cat([t[:, :seq_len + 1] for t in ts]), batch, *extra)
+            self.step += 1
+
+    def metrics(self):
+        return {"seq_len": self.current_seq_len, "sequences_per_sample": self.current_split}
+
+
+def _map(fn, *batches):
+    if isinstance(batches[0], (tuple, list)):
+        return type(batches[0])(fn(*ts) for ts in zip(*batches))
+    return fn(*batches)
+
+
+def get_seq_len_warmup(params):
+    """returns the SeqLenWarmup configured in params["seq_len_warmup"], or None"""
+    config = params.get("seq_len_warmup")
+    if not config:
+        return None
+    return SeqLenWarmup(params["seq_len"], **config)
@@ -1,31 +1,73 @@
+import fcntl
+import json
 import os
 import tarfile
 from abc import ABC, abstractmethod
-from glob import glob
 import shutil
-import random
-import zstandard
+import hashlib
+import time
+
+from gpt_neox.fetch import fetch, open_stream, StreamReader
 
 """
 This registry is for automatically downloading and extracting datasets.
 
 To register a class you need to inherit the DataDownloader class and provide name, filetype and url attributes, and 
-(optionally) provide download / extract / exists functions to check if the data exists, and, if it doesn't, download and 
-extract the data and move it to the correct directory.
+(optionally) a checksum ("<algorithm>:<hex digest>") the download is verified against, preprocessing parameters, and 
+download / extract functions to download and extract the data into self.path.
+
+Prepared datasets are cached in <base_dir>/.cache (or $GPT_NEOX_DATA_CACHE, e.g. on a shared filesystem), in a 
+directory keyed by a fingerprint of the url, checksum and preprocessing parameters, so a dataset prepared once is reused 
+by every run and config that asks for the same thing. A completion marker is written once extraction has finished, and 
+a lock file makes sure only one process builds a dataset while the others wait for it. <base_dir>/<name> is then 
+linked to the cached copy.
 
 When done, add it to the DATA_DOWNLOADERS dict. The function process_data runs the pre-processing for the selected 
 dataset.
 """
 
+_COMPLETE_MARKER = ".complete"
+
+
+class _FileLock:
+    """exclusive lock on a file, held between processes - and, with fcntl locks, across nodes on NFS"""
+    def __init__(self, path):
+        self.path = path
+        self.f = None
+
+    def __enter__(self):
+        self.f = open(self.path, "a")
+        try:
+            fcntl.lockf(self.f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            print(f"Waiting for {self.path} - another process is preparing this dataset")
+            fcntl.lockf(self.f, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.lockf(self.f, fcntl.LOCK_UN)
+        self.f.close()
+
 
 class DataDownloader(ABC):
     """Dataset registry class to automatically download / extract datasets"""
 
+    def __init__(self, **preprocessing):
+        unknown = set(preprocessing) - set(self.preprocessing)
+        assert not unknown, f"{self.name} has no preprocessing parameters {sorted(unknown)}"
+        self.preprocessing = {**self.preprocessing, **preprocessing}
+        self.path = os.path.join(self.cache_dir, f"{self.name}-{self.fingerprint}")
+
     @property
     def base_dir(self):
         """base data directory"""
         return "./data"
 
+    @property
+    def cache_dir(self):
+        """where prepared datasets are kept - point $GPT_NEOX_DATA_CACHE at a shared filesystem to share them"""
+        return os.environ.get("GPT_NEOX_DATA_CACHE", os.path.join(self.base_dir, ".cache"))
+
     @property
     @abstractmethod
     def name(self):
@@ -44,41 +86,167 @@ class DataDownloader(ABC):
         """URL from which to download dataset"""
         pass
 
-    def _extract_tar(self):
-        self.path = os.path.join(self.base_dir, self.name)
+    checksum = None  # "<algorithm>:<hex digest>" of the downloaded file, or None to skip verification
+    preprocessing = {}  # parameters of extract(), which can be overridden per run and are part of the fingerprint
+
+    @property
+    def fingerprint(self):
+        """identifies the prepared data - changes whenever the source or the preprocessing does"""
+        key = json.dumps({"url": self.url, "checksum": self.checksum, "preprocessing": self.preprocessing},
+                         sort_keys=True)
+        return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+    @property
+    def mirrors(self):
+        """local directories or url prefixes to try before url, in addition to $GPT_NEOX_DATA_MIRRORS"""
+        return []
+
+    @property
+    def download_path(self):
+        """where the downloaded file is stored - keyed by url only, so datasets built from the same file share it"""
+        url_key = hashlib.sha256(self.url.encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, "downloads", url_key, os.path.basename(self.url))
+
+    @property
+    def published_path(self):
+        """where the dataset is linked to once prepared, i.e. the path configs point at"""
+        return os.path.join(self.base_dir, self.name)
+
+    @property
+    def published_target(self):
+        """what published_path links to"""
+        return self.path
+
+    stream_extract = False  # pipe the download straight into extraction, without saving the archive
+
+    def _open_source(self):
+        """opens the (compressed) dataset for streaming extraction"""
+        if self.stream_extract:
+            return open_stream(self.url, checksum=self.checksum, mirrors=self.mirrors)
+        return StreamReader(open(self.download_path, 'rb'), self.download_path)
+
+    def _report(self, source, bytes_written, t):
+        elapsed = max(time.perf_counter() - t, 1e-9)
+        print(f"Extracted {source.name}: read {source.bytes_read / 1e6:.1f}MB ({source.bytes_read / 1e6 / elapsed:.1f}MB/s), "
+              f"wrote {bytes_written / 1e6:.1f}MB ({bytes_written / 1e6 / elapsed:.1f}MB/s) in {elapsed:.1f}s")
+
+    def _extract_tar(self, destination=None):
+        """
+        streams the members of a .tar.gz to their final location. destination(member) returns the output path of a
+        member, or None to skip it - by default, members are extracted to self.path keeping their relative paths.
+        Members are staged next to their output paths and only moved into place once the whole archive has been read
+        and verified, and members whose names would leave self.path are rejected
+        """
         os.makedirs(self.path, exist_ok=True)
-        tarfile_path = os.path.join(self.base_dir, os.path.basename(self.url))
-        with tarfile.open(tarfile_path, "r:gz") as dataset_tar:
-            print(f'Extracting files from {tarfile_path}...')
-            dataset_tar.extractall(self.path)
+        if destination is None:
+            destination = lambda member: os.path.join(self.path, member.name)
+        root = os.path.realpath(self.path)
+        t, bytes_written, staged = time.perf_counter(), 0, []
+        try:
+            with self._open_source() as source, tarfile.open(fileobj=source, mode="r|gz") as dataset_tar:
+                print(f'Extracting files from {source.name}...')
+                for member in dataset_tar:
+                    if os.path.isabs(member.name) or ".." in member.name.replace("\\", "/").split("/"):
+                        raise ValueError(f"{source.name} has a member outside the archive root: {member.name}")
+                    output_path = destination(member) if member.isfile() else None
+                    if output_path is None:
+                        continue
+                    if os.path.commonpath([root, os.path.realpath(output_path)]) != root:
+                        raise ValueError(f"{member.name} of {source.name} would be extracted outside {self.path}")
+                    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+                    staged.append(output_path)
+                    with dataset_tar.extractfile(member) as src, open(output_path + ".tmp", 'wb') as dst:
+                        shutil.copyfileobj(src, dst, 1 << 20)
+                    bytes_written += member.size
+                source.verify()
+            for output_path in staged:
+                os.replace(output_path + ".tmp", output_path)
+            staged = []
+        finally:
+            # a failed or unverified extraction leaves nothing behind
+            for output_path in staged:
+                if os.path.exists(output_path + ".tmp"):
+                    os.remove(output_path + ".tmp")
+        self._report(source, bytes_written, t)
 
     def _extract_zstd(self):
-        self.path = os.path.join(self.base_dir, self.name)
+        import zstandard
+
         os.makedirs(self.path, exist_ok=True)
-        zstd_file_path = os.path.join(self.base_dir, os.path.basename(self.url))
-        with open(zstd_file_path, 'rb') as compressed:
+        output_path = os.path.join(self.path, os.path.basename(self.url).replace(".zst", ""))
+        t = time.perf_counter()
+        with self._open_source() as compressed:
             decomp = zstandard.ZstdDecompressor()
-            output_path = zstd_file_path.replace(".zst", "")
-            with open(output_path, 'wb') as destination:
-                decomp.copy_stream(compressed, destination)
+            with open(output_path + ".tmp", 'wb') as destination:
+                _, bytes_written = decomp.copy_stream(compressed, destination)
+            compressed.verify()
+        os.replace(output_path + ".tmp", output_path)
+        self._report(compressed, bytes_written, t)
 
     def extract(self):
         """extracts dataset and moves to the correct data dir if necessary"""
         self._extract_tar()
 
     def exists(self):
-        """Checks if the dataset is present"""
-        return os.path.isdir(f"{self.base_dir}/{self.name}")
+        """Checks if the dataset has been completely prepared with the current source and preprocessing"""
+        marker = os.path.join(self.path, _COMPLETE_MARKER)
+        if not os.path.isfile(marker):
+            return False
+        with open(marker) as f:
+            return json.load(f).get("fingerprint") == self.fingerprint
+
+    def _mark_complete(self):
+        # written last, and atomically, so a dataset is never taken as ready while it's half extracted
+        marker = os.path.join(self.path, _COMPLETE_MARKER)
+        with open(marker + ".tmp", "w") as f:
+            json.dump({"fingerprint": self.fingerprint, "name": self.name, "url": self.url, "checksum": self.checksum,
+                       "preprocessing": self.preprocessing, "time": time.time()}, f, indent=2)
+        os.replace(marker + ".tmp", marker)
+
+    def _unmanaged(self):
+        # data put at published_path by hand (not a link into the cache) is used as is
+        return os.path.exists(self.published_path) and not os.path.islink(self.published_path)
+
+    def _publish(self):
+        # (re)points published_path at the prepared data, via a relative symlink so it survives different mounts
+        link = self.published_path
+        target = os.path.relpath(self.published_target, os.path.dirname(os.path.abspath(link)))
+        if os.path.islink(link) and os.readlink(link) == target:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(link)), exist_ok=True)  # the cache may live elsewhere
+        tmp_link = f"{link}.{os.getpid()}.tmp"
+        os.symlink(target, tmp_link)
+        os.replace(tmp_link, link)
 
     def download(self):
         """downloads dataset"""
-        os.makedirs(self.base_dir, exist_ok=True)
-        os.system(f"wget {self.url} -O {os.path.join(self.base_dir, os.path.basename(self.url))}")
+        if self.stream_extract:
+            return  # extract() reads straight from the url
+        # downloads are shared between datasets built from the same file, so they're locked separately
+        os.makedirs(os.path.dirname(self.download_path), exist_ok=True)
+        with _FileLock(self.download_path + ".lock"):
+            if not os.path.isfile(self.download_path):  # fetch only ever leaves complete files at download_path
+                fetch(self.url, self.download_path, checksum=self.checksum, mirrors=self.mirrors)
 
     def prepare(self):
-        if not self.exists():
-            self.download()
-            self.extract()
+        """
+        builds the dataset unless it's already in the cache, or there's data at published_path that the cache doesn't
+        manage. Interrupted builds are picked up again on the next call: downloads resume, and extraction overwrites
+        whatever it had written.
+        """
+        if self._unmanaged():
+            print(f"{self.published_path} exists and isn't managed by the dataset cache, so it's used as is. Remove it "
+                  f"to build {self.name} in {self.cache_dir}")
+            return
+        os.makedirs(self.path, exist_ok=True)
+        with _FileLock(self.path + ".lock"):
+            if self.exists():
+                print(f"Using cached {self.name} from {self.path}")
+            else:
+                self.download()
+                self.extract()
+                self._mark_complete()
+        self._publish()
 
 class EnronJsonl(DataDownloader):
     name = "enron_jsonl"
@@ -86,30 +254,26 @@ class EnronJsonl(DataDownloader):
     url = "http://eaidata.bmk.sh/data/enron_emails.jsonl.zst"
     seed = 1
 
-    def exists(self):
-        self.path = os.path.join(self.base_dir, self.name)
-        return os.path.isfile(os.path.join(self.path, os.path.basename(self.url).replace(".zst", "")))
-
     def extract(self):
         self._extract_zstd()
-        shutil.move(os.path.join(self.base_dir, os.path.basename(self.url).replace(".zst", "")), os.path.join(self.base_dir, self.name))
 
 class EnronTFRecords(DataDownloader):
     name = "enron_tfr"
     filetype = "jsonl.zst"
     url = "http://eaidata.bmk.sh/data/enron_emails.jsonl.zst"
     seed = 1
-
-    def download(self):
-        """downloads dataset"""
-        os.makedirs(self.base_dir, exist_ok=True)
-        self.path = os.path.join(self.base_dir, self.name)
-        os.makedirs(self.path, exist_ok=True)
-        os.system(f"wget {self.url} -O {os.path.join(self.path, os.path.basename(self.url))}")
+    preprocessing = {"tokenizer": "hf_gpt2tokenizerfast", "chunk_size": 1024, "files_per": 2000, "ftfy": True}
 
     def extract(self):
-        os.system(f"python ./gpt_neox/create_tfrecords.py --input_dir {self.path} --files_per 2000 \
-        --name enron --output_dir {self.path}/tokenized --ftfy --chunk_size 1024 --processes 1")
+        # --resume picks up an interrupted build where it left off. create_tfrecords.py normalizes with ftfy unless
+        # it's passed --ftfy
+        no_ftfy = "" if self.preprocessing["ftfy"] else "--ftfy"
+        status = os.system(f"python ./gpt_neox/create_tfrecords.py --input_dir {os.path.dirname(self.download_path)} \
+        --files_per {self.preprocessing['files_per']} --name enron --output_dir {self.path}/tokenized {no_ftfy} \
+        --chunk_size {self.preprocessing['chunk_size']} --tokenizer {self.preprocessing['tokenizer']} --processes 1 \
+        --resume")
+        if status != 0:
+            raise RuntimeError(f"create_tfrecords.py failed with exit status {status}")
 
 
 class OWT2(DataDownloader):
@@ -119,42 +283,39 @@ class OWT2(DataDownloader):
     seed = 1
 
     def extract(self):
-        self._extract_tar()
-        # the files are within nested subdirectories, and not split by train/test
-        # so we need to move them to the correct directories
-        all_files = glob(f"{self.path}/**/*.{self.filetype}", recursive=True)
-        print(all_files)
+        # the files are within nested subdirectories, and not split by train/test, so each file is streamed
+        # straight to the train or eval directory as it comes out of the archive
         train_dir = f"{self.path}/train"
         eval_dir = f"{self.path}/eval"
-        os.makedirs(train_dir, exist_ok=True)
-        os.makedirs(eval_dir, exist_ok=True)
-        total_tfrecords = len(all_files)
-        n_eval_tfrecords = total_tfrecords // 10
-        # owt2 doesn't have an official train/test split, so sample at random from tfrecords
-        random.seed(self.seed)
-        random.shuffle(all_files)
-        eval_set = all_files[:n_eval_tfrecords]
-        train_set = all_files[n_eval_tfrecords:]
-        for f in train_set:
-            shutil.move(f, train_dir)
-        for f in eval_set:
-            shutil.move(f, eval_dir)
-        dirs_to_remove = [f for f in glob(f"{self.path}/*") if f not in [train_dir, eval_dir]]
-        for d in dirs_to_remove:
-            shutil.rmtree(d)
+
+        def destination(member):
+            if not member.name.endswith(f".{self.filetype}"):
+                return None
+            # owt2 doesn't have an official train/test split, so send a seeded pseudo-random 10% of tfrecords to eval
+            filename = os.path.basename(member.name)
+            digest = hashlib.md5(f"{self.seed}:{filename}".encode()).digest()
+            is_eval = int.from_bytes(digest[:4], "little") % 10 == 0
+            return os.path.join(eval_dir if is_eval else train_dir, filename)
+
+        self._extract_tar(destination)
 
 
 class Enwik8(DataDownloader):
-    name = "owt2"
+    name = "enwik8"
     filetype = "gz"
     url = "http://eaidata.bmk.sh/data/enwik8.gz"
 
+    @property
+    def published_path(self):
+        return os.path.join(self.base_dir, "enwik8.gz")
+
+    @property
+    def published_target(self):
+        return self.download_path
+
     def extract(self):
         pass
 
-    def exists(self):
-        return os.path.isfile(f"{self.base_dir}/enwik8.gz")
-
 
 DATA_DOWNLOADERS = {
     "owt2": OWT2,
@@ -164,10 +325,10 @@ DATA_DOWNLOADERS = {
 }
 
 
-def prepare_data(dataset_name):
+def prepare_data(dataset_name, **preprocessing):
     DownloaderClass = DATA_DOWNLOADERS.get(dataset_name, None)
     if DownloaderClass is None:
         raise NotImplementedError
     else:
-        d = DownloaderClass()
+        d = DownloaderClass(**preprocessing)
         d.prepare()
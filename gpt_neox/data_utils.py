@@ -1,8 +1,10 @@
-from transformers import GPT2TokenizerFast, GPT2Tokenizer
 from itertools import islice
 import re
 from collections import OrderedDict
 import gzip
+import os
+import struct
+import warnings
 import numpy as np
 import torch
 
@@ -29,6 +31,8 @@ def natural_sort(l):
 
 
 def get_tokenizer(tokenizer_type=None, from_pretrained=True, add_padding_token=True):
+    from transformers import GPT2TokenizerFast, GPT2Tokenizer
+
     if tokenizer_type is None or (tokenizer_type.lower() == "hf_gpt2tokenizerfast" and from_pretrained):
         tok = GPT2TokenizerFast.from_pretrained('gpt2')
         if add_padding_token:
@@ -42,9 +46,39 @@ def get_tokenizer(tokenizer_type=None, from_pretrained=True, add_padding_token=T
     else:
         raise NotImplementedError('TODO: add custom tokenizers')
 
-def read_enwik8_data(data_path):
-    with gzip.open(data_path) as file:
-        X = np.fromstring(file.read(int(95e6)), dtype=np.uint8)
-        trX, vaX = np.split(X, [int(90e6)])
-        data_train, data_val = torch.from_numpy(trX), torch.from_numpy(vaX)
+def _gzip_trailer(data_path):
+    # the last 8 bytes of a gzip file are the CRC32 and size (mod 2 ** 32) of the uncompressed data, so they identify
+    # the contents without reading the whole archive
+    with open(data_path, 'rb') as f:
+        f.seek(-8, os.SEEK_END)
+        return struct.unpack('<II', f.read(8))
+
+
+def _cache_enwik8_data(data_path, n_bytes):
+    # decompresses the first n_bytes of data_path once into a raw file alongside it, keyed by the archive checksum and
+    # the length it decompresses to - all of the archive, if that's shorter than n_bytes
+    crc, isize = _gzip_trailer(data_path)
+    length = min(n_bytes, isize)
+    cache_path = f"{data_path}.{crc:08x}{isize:08x}.{length}.raw"
+    if os.path.isfile(cache_path) and os.path.getsize(cache_path) == length:
+        return cache_path
+    tmp_path = f"{cache_path}.tmp.{os.getpid()}"
+    with gzip.open(data_path) as src, open(tmp_path, 'wb') as dst:
+        dst.write(src.read(n_bytes))
+    os.replace(tmp_path, cache_path)  # atomic, so concurrent ranks never see a partial cache file
+    return cache_path
+
+
+def read_enwik8_data(data_path, n_bytes=int(95e6), n_train=int(90e6)):
+    """
+    returns enwik8 train / validation uint8 tensors. Both are read-only views into a memory-mapped cache of the
+    decompressed data, so all local ranks share one page-cache copy.
+    """
+    cache_path = _cache_enwik8_data(data_path, n_bytes)
+    X = np.memmap(cache_path, dtype=np.uint8, mode='r')
+    with warnings.catch_warnings():
+        # torch warns that the mapping is not writable - the data is only ever read
+        warnings.simplefilter("ignore", UserWarning)
+        X = torch.from_numpy(X)
+    data_train, data_val = X[:n_train], X[n_train:]
     return data_train, data_val
@@ -1,17 +1,56 @@
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset, DataLoader, get_worker_info, BatchSampler, RandomSampler, SequentialSampler
 from .data_utils import get_tokenizer, natural_sort, skip, FixedSizeOrderedDict
+import os
 import random
 import glob
-import tensorflow.compat.v1 as tf
+import hashlib
+import multiprocessing
+import bisect
+import math
+import numbers
+import numpy as np
 import re
 import logging
 from itertools import cycle
+from collections import defaultdict, deque
+
+def _ranges(counts):
+    # concatenation of arange(c) for every c in counts
+    counts = np.asarray(counts, dtype=np.int64)
+    ends = np.cumsum(counts)
+    return np.arange(ends[-1] if len(ends) else 0) - np.repeat(ends - counts, counts)
+
+
+def _best_fit_decreasing(lengths, capacity):
+    # assigns each item to a bin of the given capacity, placing items longest first into the fullest bin they fit in
+    open_bins = defaultdict(list)  # remaining capacity -> bins with that much room left
+    capacities = []  # sorted remaining capacities of open bins
+    assignment = np.empty(len(lengths), dtype=np.int64)
+    n_bins = 0
+    for i in np.argsort(-lengths, kind='stable'):
+        length = int(lengths[i])
+        k = bisect.bisect_left(capacities, length)
+        if k == len(capacities):
+            b, room = n_bins, capacity - length
+            n_bins += 1
+        else:
+            c = capacities[k]
+            b, room = open_bins[c].pop(), c - length
+            if not open_bins[c]:
+                capacities.pop(k)
+        assignment[i] = b
+        if room > 0:
+            if not open_bins[room]:
+                bisect.insort(capacities, room)
+            open_bins[room].append(b)
+    return assignment
+
 
 class GPT2Dataset(Dataset):
 
     def __init__(self, glob_pattern, seq_len, seed=1, shuffle_input_filenames=True, pretokenized=True,
-                 filetype="tfrecords", mode="normal", train=True, tokenizer=None, **kwargs):
+                 filetype="tfrecords", mode="normal", train=True, tokenizer=None, packing="greedy", **kwargs):
 
         super().__init__()
         self.files = glob.glob(glob_pattern)  # glob pattern pointing to files
@@ -23,21 +62,29 @@ class GPT2Dataset(Dataset):
             random.shuffle(self.files)
         else:
             self.files = natural_sort(self.files)
-        self.filetype = filetype  # filetype ["tfrecords"]
-        implemented_filetypes = ["tfrecords"]
+        self.filetype = filetype  # filetype ["tfrecords", "docs"]
+        implemented_filetypes = ["tfrecords", "docs"]
         if self.filetype not in implemented_filetypes:
             raise NotImplementedError
 
-        self.processed_files = FixedSizeOrderedDict(max=1)  # storage for lazily loading data
+        self.seq_len = seq_len  # set sequence length
 
-        # parses the length of the files, either by encoding in the filenames or by iterating over them
-        self._get_lens()
+        if self.filetype == "docs":
+            # whole documents (written by create_tfrecords.py --mode documents), packed into sequences here
+            assert packing in ["greedy", "best_fit"], f"packing {packing} not recognized"
+            if not self.files:
+                raise FileNotFoundError(f"no document shards found for {glob_pattern}")
+            self.packing = packing
+            self._load_documents()
+        else:
+            self.processed_files = FixedSizeOrderedDict(max=1)  # storage for lazily loading data
+
+            # parses the length of the files, either by encoding in the filenames or by iterating over them
+            self._get_lens()
 
-        self.seq_len = seq_len  # set sequence length
-        
         self.pretokenized = pretokenized
         if not self.pretokenized:
-            raise NotImplementedError  # TODO: tokenize text data on the fly
+            raise NotImplementedError("use StreamingTextDataset to train on raw text")
 
         self.train = train
         self.mode = mode
@@ -55,6 +102,7 @@ class GPT2Dataset(Dataset):
             "Found no metadata found in filename - iterating through first tfrecord to find global length")
         count = 0
         if self.filetype == "tfrecords":
+            import tensorflow.compat.v1 as tf
             for _ in tf.io.tf_record_iterator(filename):
                 count += 1
         return count
@@ -70,11 +118,13 @@ class GPT2Dataset(Dataset):
         self._len = sum(self.lens)
 
     def _parse_single_example(self, example):
+        import tensorflow.compat.v1 as tf
         data = tf.train.Example.FromString(example)
         data = torch.tensor(list(data.features.feature["text"].int64_list.value), dtype=torch.long)
         return data
 
     def _process_tfrecord(self, tfrecords_file, resume_idx=None):
+        import tensorflow.compat.v1 as tf
         for idx, example in enumerate(tf.io.tf_record_iterator(tfrecords_file)):
             yield self._parse_single_example(example)
 
@@ -97,7 +147,84 @@ class GPT2Dataset(Dataset):
                 skip_idx = count
                 return skip_idx, remainder
 
+    def _load_documents(self):
+        # memory maps the tokens of each .docs shard and reads its index of document offsets
+        self.doc_tokens, self.doc_offsets = [], []
+        for f in self.files:
+            offsets = np.fromfile(f + ".idx", dtype=np.int64)
+            self.doc_offsets.append(offsets)
+            self.doc_tokens.append(np.memmap(f, dtype=np.int32, mode='r') if offsets[-1] > 0
+                                   else np.empty(0, dtype=np.int32))
+        # start of each shard in the concatenation of all tokens / all documents
+        self.file_token_starts = np.cumsum([0] + [o[-1] for o in self.doc_offsets])
+        self.file_doc_starts = np.cumsum([0] + [len(o) - 1 for o in self.doc_offsets])
+
+        total_tokens = self.file_token_starts[-1]
+        if self.packing == "greedy":
+            # documents are concatenated and cut into seq_len + 1 sized sequences
+            self._len = int(total_tokens // (self.seq_len + 1))
+        else:
+            self._pack_best_fit()
+            self._len = len(self.bin_starts) - 1
+        logging.info(f"Packed {self.file_doc_starts[-1]} documents / {total_tokens} tokens into {self._len} "
+                     f"sequences ({self.packing} packing)")
+
+    def _pack_best_fit(self):
+        # splits documents into pieces of at most seq_len + 1 tokens, and packs them into sequences with best fit
+        # decreasing bin packing, so no document is split unless it is longer than a sequence
+        capacity = self.seq_len + 1
+        starts = np.concatenate([o[:-1] + s for o, s in zip(self.doc_offsets, self.file_token_starts)])
+        lengths = np.diff(np.concatenate([starts, self.file_token_starts[-1:]])) if len(starts) else starts
+        n_full = lengths // capacity
+        piece_starts = [np.repeat(starts, n_full) + capacity * _ranges(n_full)]
+        piece_lens = [np.full(n_full.sum(), capacity, dtype=np.int64)]
+        remainder = lengths % capacity
+        has_remainder = remainder > 0
+        piece_starts.append(starts[has_remainder] + (n_full * capacity)[has_remainder])
+        piece_lens.append(remainder[has_remainder])
+        self.piece_starts = np.concatenate(piece_starts).astype(np.int64)
+        self.piece_lens = np.concatenate(piece_lens).astype(np.int64)
+
+        assignment = _best_fit_decreasing(self.piece_lens, capacity)
+        order = np.lexsort((self.piece_starts, assignment))  # pieces grouped by sequence, in corpus order
+        self.piece_starts, self.piece_lens = self.piece_starts[order], self.piece_lens[order]
+        self.bin_starts = np.searchsorted(assignment[order], np.arange(assignment.max() + 2 if len(order) else 1))
+
+    def _read_tokens(self, start, end):
+        # reads tokens [start, end) of the concatenation of all shards, and the global document id of each token
+        tokens, doc_ids = [], []
+        f = np.searchsorted(self.file_token_starts, start, side='right') - 1
+        while start < end:
+            stop = min(end, self.file_token_starts[f + 1])
+            lo, hi = start - self.file_token_starts[f], stop - self.file_token_starts[f]
+            tokens.append(self.doc_tokens[f][lo:hi])
+            doc_ids.append(self.file_doc_starts[f] + np.searchsorted(self.doc_offsets[f], np.arange(lo, hi),
+                                                                     side='right') - 1)
+            start = stop
+            f += 1
+        return np.concatenate(tokens), np.concatenate(doc_ids)
+
+    def _get_packed_sequence(self, idx):
+        # returns the tokens of a packed sequence, and segment ids numbering the documents in it from 1 (0 = padding)
+        if self.packing == "greedy":
+            tokens, doc_ids = self._read_tokens(idx * (self.seq_len + 1), (idx + 1) * (self.seq_len + 1))
+        else:
+            pieces = [self._read_tokens(s, s + l) for s, l in
+                      zip(self.piece_starts[self.bin_starts[idx]:self.bin_starts[idx + 1]],
+                          self.piece_lens[self.bin_starts[idx]:self.bin_starts[idx + 1]])]
+            tokens = np.concatenate([t for t, _ in pieces])
+            doc_ids = np.concatenate([d for _, d in pieces])
+        segment_ids = np.cumsum(np.concatenate([[1], doc_ids[1:] != doc_ids[:-1]]))
+        pad = self.seq_len + 1 - len(tokens)
+        tokens = np.pad(tokens, (0, pad))  # padding with 0, the AutoregressiveWrapper's default ignore_index
+        segment_ids = np.pad(segment_ids, (0, pad))
+        return torch.from_numpy(tokens.astype(np.int64)), torch.from_numpy(segment_ids.astype(np.int64))
+
     def __getitem__(self, idx):
+        if self.filetype == "docs":
+            output, segment_ids = self._get_packed_sequence(idx)
+            return self._format_output(output, segment_ids)
+
         # seek to correct chunk
         seek_idx, remainder = self._seek(idx)
         f = self.files[seek_idx]
@@ -109,12 +236,20 @@ class GPT2Dataset(Dataset):
         output = chunk[remainder]
         assert output is not None
         assert output.size(0) == (self.seq_len + 1), f"Output shape ({output.size(0)}) != the specified sequence length + 1 ({self.seq_len + 1})"
+        return self._format_output(output)
+
+    def _format_output(self, output, segment_ids=None):
         if self.mode == "normal":
             return output
         elif self.mode == 'with_labels':
             x_seq = output[:-1]
             y_seq = output[1:]
             return x_seq, y_seq
+        elif self.mode == 'with_segment_ids':
+            if segment_ids is None:
+                # chunks don't keep document boundaries
+                segment_ids = torch.ones_like(output)
+            return output, segment_ids
         else:
             raise ValueError(f'mode {self.mode} not recognized')
 
@@ -122,25 +257,359 @@ class GPT2Dataset(Dataset):
         return self._len
 
 
+def _reader_shard():
+    # (index, count) of this reader among all distributed ranks x DataLoader workers
+    rank, world_size = 0, 1
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        rank, world_size = torch.distributed.get_rank(), torch.distributed.get_world_size()
+    worker_info = get_worker_info()
+    if worker_info is None:
+        return rank, world_size
+    return rank * worker_info.num_workers + worker_info.id, world_size * worker_info.num_workers
+
+
+_worker_tokenizer = None
+
+
+def _init_tokenizer_worker(tokenizer):
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+
+
+def _tokenize_batch(docs, separator, fix_text=False, tokenizer=None):
+    # encodes a batch of documents, appending the separator token to each
+    tokenizer = tokenizer if tokenizer is not None else _worker_tokenizer
+    if fix_text:
+        import ftfy
+        docs = [ftfy.fix_text(doc, normalization='NFKC') for doc in docs]
+    return [np.asarray(ids + [separator], dtype=np.int32) for ids in tokenizer(docs)["input_ids"]]
+
+
+class StreamingTextDataset(IterableDataset):
+    """
+    Streams seq_len + 1 token sequences straight from raw lm_dataformat archives (e.g. .jsonl.zst), tokenizing on the
+    fly. Documents are separated by the tokenizer's eos token and concatenated into sequences.
+
+    When iterated in the main process, documents are tokenized in batches by tokenizer_workers background processes
+    (DataLoader workers tokenize in their own process). Files are split across distributed ranks and DataLoader
+    workers - or documents, if there are fewer files than readers. Ranks may get unequal numbers of sequences, so
+    distributed training iterates it through utils.synced_batches.
+
+    If cache_dir is set, the tokens of every file read in full are written to cache_dir in the .docs format of
+    create_tfrecords.py --mode documents, and later epochs read the cache instead of re-tokenizing.
+    """
+    def __init__(self, glob_pattern, seq_len, tokenizer, seed=1, shuffle_input_filenames=True, mode="normal",
+                 cache_dir=None, tokenizer_workers=4, tokenize_batch_size=64, prefetch_batches=16, ftfy=False,
+                 **kwargs):
+        super().__init__()
+        self.files = glob.glob(glob_pattern)
+        if shuffle_input_filenames:
+            random.seed(seed)
+            random.shuffle(self.files)
+        else:
+            self.files = natural_sort(self.files)
+        self.seq_len = seq_len
+        self.tokenizer = tokenizer
+        self.separator = tokenizer.eos_token_id
+        assert mode in ["normal", "with_labels"]
+        self.mode = mode
+        self.cache_dir = cache_dir
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+        self.tokenizer_workers = tokenizer_workers
+        self.tokenize_batch_size = tokenize_batch_size
+        self.prefetch_batches = prefetch_batches
+        self.ftfy = ftfy
+
+    def _cache_prefix(self, f):
+        # keyed by the input file and tokenizer, so a changed file or tokenizer never hits a stale cache
+        stat = os.stat(f)
+        key = f"{os.path.abspath(f)}:{stat.st_size}:{stat.st_mtime_ns}:{type(self.tokenizer).__name__}:" \
+              f"{len(self.tokenizer)}:{self.separator}:{self.ftfy}"
+        digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"{os.path.basename(f)}.{digest}")
+
+    def _read_text(self, f, part, n_parts):
+        from lm_dataformat import Reader
+
+        batch = []
+        for doc_no, doc in enumerate(Reader(f).stream_data(threaded=False)):
+            if doc_no % n_parts != part:
+                continue
+            batch.append(doc)
+            if len(batch) == self.tokenize_batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _tokenized_docs(self, f, pool, part=0, n_parts=1):
+        # yields the tokens of each document in f, from the cache if there is one
+        prefix = self._cache_prefix(f) if self.cache_dir is not None else None
+        if prefix is not None and os.path.isfile(prefix + ".docs.idx"):
+            offsets = np.fromfile(prefix + ".docs.idx", dtype=np.int64)
+            tokens = np.memmap(prefix + ".docs", dtype=np.int32, mode='r') if offsets[-1] > 0 else None
+            for doc_no in range(part, len(offsets) - 1, n_parts):
+                yield tokens[offsets[doc_no]:offsets[doc_no + 1]]
+            return
+
+        # only files that are read in full can be cached
+        cache = None
+        if prefix is not None and n_parts == 1:
+            tmp_prefix = f"{prefix}.{os.getpid()}"
+            cache = open(tmp_prefix + ".docs.tmp", "wb"), [0]
+
+        if pool is None:
+            batches = (_tokenize_batch(batch, self.separator, self.ftfy, tokenizer=self.tokenizer)
+                       for batch in self._read_text(f, part, n_parts))
+        else:
+            batches = self._tokenize_in_pool(pool, self._read_text(f, part, n_parts))
+
+        try:
+            for batch in batches:
+                for doc in batch:
+                    if cache is not None:
+                        cache[0].write(doc.tobytes())
+                        cache[1].append(cache[1][-1] + len(doc))
+                    yield doc
+        except BaseException:
+            # iteration stopped part way through the file, so the cache would be incomplete
+            if cache is not None:
+                cache[0].close()
+                os.remove(tmp_prefix + ".docs.tmp")
+            raise
+
+        if cache is not None:
+            cache[0].close()
+            np.asarray(cache[1], dtype=np.int64).tofile(tmp_prefix + ".docs.idx.tmp")
+            os.replace(tmp_prefix + ".docs.tmp", prefix + ".docs")
+            os.replace(tmp_prefix + ".docs.idx.tmp", prefix + ".docs.idx")  # the index marks the cache as complete
+
+    def _tokenize_in_pool(self, pool, text_batches):
+        # keeps at most prefetch_batches batches in flight, so the reader never runs ahead of training by more
+        pending = deque()
+        for batch in text_batches:
+            pending.append(pool.apply_async(_tokenize_batch, (batch, self.separator, self.ftfy)))
+            if len(pending) >= self.prefetch_batches:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    def _sequences(self, docs):
+        # concatenates documents and cuts them into seq_len + 1 sequences
+        length = self.seq_len + 1
+        buffer = np.empty(0, dtype=np.int32)
+        for doc in docs:
+            buffer = np.concatenate([buffer, doc])
+            n = len(buffer) // length
+            for i in range(n):
+                yield torch.from_numpy(buffer[i * length:(i + 1) * length].astype(np.int64))
+            buffer = buffer[n * length:]
+
+    def __iter__(self):
+        shard, n_shards = _reader_shard()
+        if len(self.files) >= n_shards:
+            reads = [(f, 0, 1) for f in self.files[shard::n_shards]]
+        else:
+            reads = [(f, shard, n_shards) for f in self.files]
+
+        use_pool = self.tokenizer_workers > 0 and not multiprocessing.current_process().daemon
+        pool = multiprocessing.Pool(self.tokenizer_workers, initializer=_init_tokenizer_worker,
+                                    initargs=(self.tokenizer,)) if use_pool else None
+        try:
+            docs = (doc for f, part, n_parts in reads for doc in self._tokenized_docs(f, pool, part, n_parts))
+            for output in self._sequences(docs):
+                if self.mode == "normal":
+                    yield output
+                else:
+                    yield output[:-1], output[1:]
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+
+def _alias_table(weights):
+    # Vose's alias method: bucket k is kept with probability prob[k], and otherwise replaced by alias[k], so drawing
+    # from the distribution takes one uniform bucket and one biased coin
+    weights = np.asarray(weights, dtype=np.float64)
+    n = len(weights)
+    scaled = weights * n / weights.sum()
+    prob, alias = np.ones(n), np.arange(n)
+    small = [k for k in range(n) if scaled[k] < 1.0]
+    large = [k for k in range(n) if scaled[k] >= 1.0]
+    while small and large:
+        s, l = small.pop(), large.pop()
+        prob[s], alias[s] = scaled[s], l
+        scaled[l] -= 1.0 - scaled[s]
+        (small if scaled[l] < 1.0 else large).append(l)
+    return prob, alias  # whatever is left over (up to rounding) has probability 1
+
+
+class MixtureDataset(IterableDataset):
+    """
+    Mixes samples from several map-style datasets (e.g. GPT2Dataset, TextSamplerDataset) at read time, drawing the
+    source of each sample with probability proportional to its weight in O(1), with an alias table. Adding a corpus
+    to a mixture is a config change - nothing is rewritten.
+
+    Each source is read in order (or, with shuffle=True, in a new seeded permutation every epoch) and can be capped
+    at max_epochs passes (None for no cap, floats allowed), after which it drops out and the remaining weights are
+    renormalized. Iteration ends when every source is exhausted.
+
+    The mixture is a single deterministic stream for a given seed, which distributed ranks and DataLoader workers
+    split between them sample by sample. state_dict() / load_state_dict() save and restore the position in the
+    stream, and metrics() reports the tokens, samples and epochs read from each source. Both describe the dataset
+    object they're called on, so they track training when the mixture is iterated in the main process
+    (DataLoader num_workers=0).
+    """
+    def __init__(self, sources, weights=None, max_epochs=None, names=None, seed=1, shuffle=False, block_size=4096):
+        super().__init__()
+        self.sources = list(sources)
+        n = len(self.sources)
+        self.weights = np.asarray(weights if weights is not None else [1.0] * n, dtype=np.float64)
+        assert len(self.weights) == n and (self.weights > 0).all(), "need one positive weight per source"
+        if not isinstance(max_epochs, (list, tuple)):
+            max_epochs = [max_epochs] * n
+        self.limits = [None if e is None else int(math.ceil(e * len(source)))
+                       for e, source in zip(max_epochs, self.sources)]
+        self.names = list(names) if names is not None else [f"source_{i}" for i in range(n)]
+        self.seed = seed
+        self.shuffle = shuffle
+        self.block_size = block_size
+        self._perms = {}
+        self.load_state_dict(None)
+
+    def state_dict(self):
+        return {"seed": self.seed, "position": self.position, "consumed": list(self.consumed),
+                "tokens": list(self.tokens), "samples": list(self.samples), "rng": self._block_state,
+                "block_pos": self._block_pos}
+
+    def load_state_dict(self, state):
+        """restores a state_dict(), or resets to the start of the stream if state is None"""
+        n = len(self.sources)
+        if state is not None:
+            assert state["seed"] == self.seed, f"state was saved with seed {state['seed']}, not {self.seed}"
+        self.position = state["position"] if state is not None else 0  # samples drawn, by all readers
+        self.consumed = list(state["consumed"]) if state is not None else [0] * n  # reads of each source, all readers
+        self.tokens = list(state["tokens"]) if state is not None else [0] * n  # tokens read by this reader
+        self.samples = list(state["samples"]) if state is not None else [0] * n  # samples read by this reader
+        self._rng = np.random.default_rng(self.seed)
+        self._block_state, self._block_pos, self._uniforms = None, self.block_size, None
+        if state is not None and state["rng"] is not None:
+            # redraw the current block of random numbers, so the stream continues exactly where it stopped
+            self._rng.bit_generator.state = state["rng"]
+            self._draw_block()
+            self._block_pos = state["block_pos"]
+        self._update_active()
+
+    def _exhausted(self, i):
+        return len(self.sources[i]) == 0 or (self.limits[i] is not None and self.consumed[i] >= self.limits[i])
+
+    def _update_active(self):
+        self._active = [i for i in range(len(self.sources)) if not self._exhausted(i)]
+        if self._active:
+            self._prob, self._alias = _alias_table(self.weights[self._active])
+
+    def _draw_block(self):
+        # uniforms are drawn block_size at a time, and the rng state at the start of the block is what gets saved
+        self._block_state = self._rng.bit_generator.state
+        self._uniforms = self._rng.random((self.block_size, 2))
+        self._block_pos = 0
+
+    def _next(self):
+        # draws the next sample of the stream, returning (source, index in source)
+        if self._block_pos == self.block_size:
+            self._draw_block()
+        bucket, coin = self._uniforms[self._block_pos]
+        self._block_pos += 1
+        k = int(bucket * len(self._active))
+        i = self._active[k if coin < self._prob[k] else self._alias[k]]
+
+        epoch, idx = divmod(self.consumed[i], len(self.sources[i]))
+        if self.shuffle:
+            if self._perms.get(i, (None,))[0] != epoch:
+                self._perms[i] = epoch, np.random.default_rng([self.seed, i, epoch]).permutation(len(self.sources[i]))
+            idx = int(self._perms[i][1][idx])
+        self.consumed[i] += 1
+        self.position += 1
+        if self._exhausted(i):
+            self._update_active()
+        return i, idx
+
+    def __iter__(self):
+        shard, n_shards = _reader_shard()
+        while self._active:
+            is_mine = self.position % n_shards == shard
+            i, idx = self._next()
+            if not is_mine:
+                continue
+            item = self.sources[i][idx]
+            self.tokens[i] += (item[0] if isinstance(item, (tuple, list)) else item).numel()
+            self.samples[i] += 1
+            yield item
+
+    def metrics(self):
+        """tokens and samples read from each source by this reader, and how many epochs of it the mixture has used"""
+        metrics = {}
+        for name, source, tokens, samples, consumed in zip(self.names, self.sources, self.tokens, self.samples,
+                                                           self.consumed):
+            metrics[f"{name}/tokens"] = tokens
+            metrics[f"{name}/samples"] = samples
+            metrics[f"{name}/epochs"] = consumed / max(len(source), 1)
+        return metrics
+
+
 class TextSamplerDataset(Dataset):
-    def __init__(self, data, seq_len, mode="normal"):
+    """
+    Samples windows of seq_len + 1 tokens from a 1d tensor of tokens (e.g. the enwik8 bytes).
+
+    By default each item is a window at a random offset (with replacement). With strided=True, item i is the window
+    starting at i * seq_len, so one pass over the dataset covers the corpus exactly once - use this for reproducible
+    validation.
+
+    Indexing with a list / tensor of indices (e.g. through a BatchSampler with batch_size=None in the DataLoader)
+    returns a whole batch, gathered with a single indexing op over an unfolded view of the data.
+    """
+    def __init__(self, data, seq_len, mode="normal", strided=False):
         super().__init__()
         self.data = data
         self.seq_len = seq_len
         assert mode in ["normal", "with_labels"]
         self.mode = mode
+        self.strided = strided
+
+        # (n_windows, seq_len + 1) view into data, no copy
+        self.windows = self.data.unfold(0, self.seq_len + 1, 1)
+
+    def _starts(self, indices):
+        if self.strided:
+            return indices * self.seq_len
+        return torch.randint(0, self.data.size(0) - self.seq_len - 1, indices.shape)
 
     def __getitem__(self, index):
-        rand_start = torch.randint(0, self.data.size(0) - self.seq_len - 1, (1,))
+        batched = not isinstance(index, numbers.Integral)
+        indices = torch.as_tensor(index, dtype=torch.long).reshape(-1)
+        full_seq = self.windows[self._starts(indices)].long()
+        if not batched:
+            full_seq = full_seq[0]
         if self.mode == "normal":
-            full_seq = self.data[rand_start: rand_start + self.seq_len + 1].long()
             return full_seq
         elif self.mode == "with_labels":
-            x_seq = self.data[rand_start: rand_start + self.seq_len].long()
-            y_seq = self.data[rand_start+1: rand_start + self.seq_len + 1].long()
+            x_seq = full_seq[..., :-1]
+            y_seq = full_seq[..., 1:]
             return x_seq, y_seq
         else:
             raise ValueError(f'mode {self.mode} not recognized')
 
     def __len__(self):
-        return self.data.size(0) // self.seq_len
+        # number of non-overlapping seq_len + 1 windows, i.e. one epoch covers the data once
+        return (self.data.size(0) - 1) // self.seq_len
+
+    def batch_loader(self, batch_size, shuffle=False, drop_last=False, sampler=None, **kwargs):
+        """
+        returns a DataLoader that draws whole batches through the batched __getitem__ path - of the indices of sampler
+        (e.g. a distributed one) if given
+        """
+        if sampler is None:
+            sampler = RandomSampler(self) if shuffle else SequentialSampler(self)
+        return DataLoader(self, sampler=BatchSampler(sampler, batch_size, drop_last=drop_last), batch_size=None,
+                          **kwargs)
@@ -0,0 +1,194 @@
+import hashlib
+import os
+import sqlite3
+
+import numpy as np
+
+"""
+Exact and near-duplicate (MinHash / LSH) detection for tokenized documents.
+
+Documents are compared on their token ids. Exact duplicates are found by hashing the full token sequence, and near
+duplicates by computing a MinHash signature over n-token shingles, which is split into bands that are each hashed to
+one LSH key. Two documents sharing any key are considered duplicates - with b bands of r rows, documents with jaccard
+similarity s collide with probability 1 - (1 - s^r)^b.
+
+The keys are stored in a DedupIndex, either in memory or sharded across sqlite files on disk so it can be shared by
+every process of a multiprocessing pool.
+"""
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+
+
+def _hash_bytes(data, digest_size=8):
+    return hashlib.blake2b(data, digest_size=digest_size).digest()
+
+
+class MinHasher:
+    def __init__(self, num_perm=128, bands=16, shingle_size=5, seed=1):
+        assert num_perm % bands == 0, f"num_perm ({num_perm}) should be divisible by the number of bands ({bands})"
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        rng = np.random.RandomState(seed)
+        # (a * x + b) mod p, with a, b < 2^32 and x < 2^32 so the products fit in a uint64
+        self.a = rng.randint(1, 1 << 32, size=num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, 1 << 32, size=num_perm, dtype=np.uint64)
+        self.shingle_mult = rng.randint(1, 1 << 63, size=shingle_size, dtype=np.uint64) | np.uint64(1)
+
+    def _shingle_hashes(self, tokens):
+        # hashes every n-token shingle to 32 bits, with a multiply-add hash that wraps around in uint64
+        tokens = np.asarray(tokens, dtype=np.int64).astype(np.uint64)
+        n = min(self.shingle_size, len(tokens))
+        shingles = np.lib.stride_tricks.sliding_window_view(tokens, n)
+        hashes = (shingles * self.shingle_mult[None, :n]).sum(axis=1, dtype=np.uint64)
+        hashes ^= hashes >> np.uint64(32)
+        return np.unique(hashes & _MAX_HASH)
+
+    def signature(self, tokens, block_size=4096):
+        """
+        returns the num_perm MinHash values of a token sequence
+        """
+        hashes = self._shingle_hashes(tokens)
+        sig = np.full(self.num_perm, _MAX_HASH, dtype=np.uint64)
+        for i in range(0, len(hashes), block_size):
+            block = hashes[i:i + block_size, None]
+            permuted = ((block * self.a[None, :]) % _MERSENNE_PRIME + self.b[None, :]) % _MERSENNE_PRIME
+            sig = np.minimum(sig, (permuted & _MAX_HASH).min(axis=0))
+        return sig
+
+    def lsh_keys(self, tokens):
+        """
+        returns one key per band of the MinHash signature
+        """
+        sig = self.signature(tokens).reshape(self.bands, self.rows)
+        return [bytes([band]) + _hash_bytes(row.tobytes()) for band, row in enumerate(sig)]
+
+
+def exact_key(tokens):
+    return b"x" + _hash_bytes(np.asarray(tokens, dtype=np.int64).tobytes(), digest_size=16)
+
+
+class DedupIndex:
+    """
+    maps document keys to the id of the first document seen with that key.
+
+    With path=None, the index is a dict in memory. Otherwise keys are spread across n_shards sqlite files in path,
+    which every worker process can open concurrently.
+    """
+    def __init__(self, path=None, n_shards=16):
+        self.path = path
+        self.n_shards = n_shards
+        if path is None:
+            self._memory = {}
+            return
+        os.makedirs(path, exist_ok=True)
+        self._conns = []
+        for shard in range(n_shards):
+            conn = sqlite3.connect(os.path.join(path, f"shard_{shard}.sqlite"), timeout=600, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute("CREATE TABLE IF NOT EXISTS keys (key BLOB PRIMARY KEY, owner TEXT)")
+            self._conns.append(conn)
+
+    def _shard(self, key):
+        return self._conns[int.from_bytes(key[-4:], "little") % self.n_shards]
+
+    def owners(self, keys):
+        # returns the owner of each key, or None for keys not in the index
+        if self.path is None:
+            return [self._memory.get(key) for key in keys]
+        owners = []
+        for key in keys:
+            row = self._shard(key).execute("SELECT owner FROM keys WHERE key = ?", (key,)).fetchone()
+            owners.append(row[0] if row is not None else None)
+        return owners
+
+    def add(self, keys, owner):
+        # keys that are already present keep their first owner
+        if self.path is None:
+            for key in keys:
+                self._memory.setdefault(key, owner)
+            return
+        for key in keys:
+            self._shard(key).execute("INSERT OR IGNORE INTO keys (key, owner) VALUES (?, ?)", (key, owner))
+
+    def is_duplicate(self, keys, owner):
+        """
+        returns True if any of the keys belongs to a different document. Otherwise, registers the keys as owned by
+        owner - a document checked again under the same owner (e.g. when resuming) is not its own duplicate.
+        """
+        if self.path is None:
+            if any(o is not None and o != owner for o in self.owners(keys)):
+                return True
+            self.add(keys, owner)
+            return False
+
+        # the check and the insert are one transaction per shard, so two workers checking the same keys at once
+        # can't both see no owner. The shards are locked in order, so workers can't deadlock on them, and a
+        # duplicate's keys are rolled back rather than registered
+        by_shard = {}
+        for key in keys:
+            by_shard.setdefault(int.from_bytes(key[-4:], "little") % self.n_shards, []).append(key)
+        locked = []
+        duplicate = False
+        try:
+            for shard in sorted(by_shard):
+                conn = self._conns[shard]
+                conn.execute("BEGIN IMMEDIATE")
+                locked.append(conn)
+                for key in by_shard[shard]:
+                    conn.execute("INSERT OR IGNORE INTO keys (key, owner) VALUES (?, ?)", (key, owner))
+                    stored = conn.execute("SELECT owner FROM keys WHERE key = ?", (key,)).fetchone()[0]
+                    duplicate = duplicate or stored != owner
+                if duplicate:
+                    break
+        except BaseException:
+            for conn in locked:
+                conn.execute("ROLLBACK")
+            raise
+        for conn in locked:
+            conn.execute("ROLLBACK" if duplicate else "COMMIT")
+        return duplicate
+
+    def close(self):
+        if self.path is not None:
+            for conn in self._conns:
+                conn.close()
+
+
+class Deduplicator:
+    """
+    filters a stream of tokenized documents, keeping count of the documents and tokens removed.
+
+    mode is one of "exact" (only exact duplicates) or "minhash" (exact and near duplicates)
+    """
+    def __init__(self, index, mode="minhash", minhasher=None):
+        assert mode in ["exact", "minhash"], f"dedup mode {mode} not recognized"
+        self.index = index
+        self.mode = mode
+        self.minhasher = minhasher if minhasher is not None else MinHasher()
+        self.exact_duplicates = 0
+        self.near_duplicates = 0
+        self.duplicate_tokens = 0
+
+    def is_duplicate(self, tokens, doc_id):
+        if self.index.is_duplicate([exact_key(tokens)], doc_id):
+            self.exact_duplicates += 1
+            self.duplicate_tokens += len(tokens)
+            return True
+        if self.mode == "minhash" and self.index.is_duplicate(self.minhasher.lsh_keys(tokens), doc_id):
+            self.near_duplicates += 1
+            self.duplicate_tokens += len(tokens)
+            return True
+        return False
+
+    def load_stats(self, stats):
+        self.exact_duplicates = stats["exact_duplicates"]
+        self.near_duplicates = stats["near_duplicates"]
+        self.duplicate_tokens = stats["duplicate_tokens"]
+
+    def stats(self):
+        return {"exact_duplicates": self.exact_duplicates, "near_duplicates": self.near_duplicates,
+                "duplicate_tokens": self.duplicate_tokens}
@@ -0,0 +1,255 @@
+import contextlib
+import json
+import logging
+import math
+import os
+import socket
+
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, DistributedSampler, RandomSampler
+
+"""
+Device-agnostic distributed training: the same training scripts run on GPUs with DeepSpeed and NCCL, or on CPUs -
+across processes and cores - with gloo and plain PyTorch DistributedDataParallel when DeepSpeed isn't installed (or
+"engine": "ddp" is set).
+
+Read from the model config:
+
+    "device"                - "cuda" or "cpu" (default: cuda if available)
+    "dist_backend"          - default: nccl on GPUs, gloo on CPUs
+    "engine"                - "deepspeed", "ddp" or "auto" (default: deepspeed if installed and training on GPUs)
+    "num_threads"           - intra-op threads per rank (default on CPU: the cores available split between the ranks
+                              on the node)
+    "num_interop_threads"   - inter-op threads per rank (default on CPU: 1)
+    "bind_cores"            - pin each rank to its own cores (default: false)
+
+Launch with deepspeed, torchrun or torch.distributed.launch; run directly, training is a single process.
+"""
+
+
+def add_config_arguments(parser):
+    """adds DeepSpeed's --deepspeed / --deepspeed_config arguments, or stand-ins if DeepSpeed isn't installed"""
+    try:
+        import deepspeed
+    except ImportError:
+        group = parser.add_argument_group('DeepSpeed', 'DeepSpeed configurations (read by the ddp engine)')
+        group.add_argument('--deepspeed', default=False, action='store_true')
+        group.add_argument('--deepspeed_config', default=None, type=str)
+        return parser
+    return deepspeed.add_config_arguments(parser)
+
+
+def get_device(params, local_rank=None):
+    """the device this rank trains on, from params["device"]"""
+    device = params.get("device") or ("cuda" if torch.cuda.is_available() else "cpu")
+    if device == "cuda":
+        local_rank = int(os.environ.get("LOCAL_RANK", 0)) if local_rank is None or local_rank < 0 else local_rank
+        return torch.device("cuda", local_rank)
+    return torch.device(device)
+
+
+def _use_deepspeed(params):
+    engine = params.get("engine") or "auto"
+    assert engine in ["auto", "deepspeed", "ddp"], f"engine {engine} not recognized"
+    if engine == "ddp":
+        return False
+    try:
+        import deepspeed
+    except ImportError:
+        if engine == "deepspeed":
+            raise
+        return False
+    return engine == "deepspeed" or get_device(params).type == "cuda"
+
+
+def set_threads(params):
+    """
+    sets the intra-op and inter-op thread counts of this rank - on CPU by default splitting the node's cores between
+    its ranks, so they don't oversubscribe them - and optionally pins the rank to its share of the cores
+    """
+    on_cpu = get_device(params).type == "cpu"
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+    # torchrun sets LOCAL_*, mpirun (e.g. under the deepspeed launcher) OMPI_COMM_WORLD_LOCAL_*. Never the global
+    # WORLD_SIZE, which on several nodes would leave each rank a fraction of its share
+    local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", os.environ.get("OMPI_COMM_WORLD_LOCAL_SIZE", 1)))
+    local_rank = int(os.environ.get("LOCAL_RANK", os.environ.get("OMPI_COMM_WORLD_LOCAL_RANK", 0)))
+
+    num_threads = params.get("num_threads") or (max(1, len(cores) // local_world_size) if on_cpu else None)
+    if params.get("bind_cores") and num_threads is not None:
+        share = cores[local_rank * num_threads:(local_rank + 1) * num_threads] or cores
+        os.sched_setaffinity(0, share)
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    num_interop_threads = params.get("num_interop_threads") or (1 if on_cpu else None)
+    if num_interop_threads is not None:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError:
+            # can only be set before any inter-op parallel work has started
+            logging.warning(f"Couldn't set {num_interop_threads} inter-op threads - already set")
+
+
+def init_distributed(params):
+    """
+    sets up threads and the process group, with the backend for the configured device. A process started without a
+    launcher becomes a group of one
+    """
+    set_threads(params)
+    backend = params.get("dist_backend") or ("nccl" if get_device(params).type == "cuda" else "gloo")
+    if "WORLD_SIZE" not in os.environ and "OMPI_COMM_WORLD_SIZE" not in os.environ:
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        os.environ.update(RANK="0", LOCAL_RANK="0", WORLD_SIZE="1", MASTER_ADDR="127.0.0.1", MASTER_PORT=str(port))
+    if _use_deepspeed(params):
+        import deepspeed
+        deepspeed.init_distributed(dist_backend=backend)
+    elif not dist.is_initialized():
+        dist.init_process_group(backend=backend)
+    device = get_device(params)
+    if device.type == "cuda":
+        torch.cuda.set_device(device)
+
+
+def _build_optimizer(config, parameters):
+    # the DeepSpeed config's optimizer, in torch.optim
+    config = config or {"type": "Adam", "params": {}}
+    kwargs = {k: v for k, v in config.get("params", {}).items() if k in ["lr", "betas", "eps", "weight_decay"]}
+    optimizer_type = config["type"].lower()
+    if optimizer_type not in ["adam", "adamw"]:
+        logging.warning(f"{config['type']} is a DeepSpeed optimizer - using torch.optim.Adam instead")
+    return (torch.optim.AdamW if optimizer_type == "adamw" else torch.optim.Adam)(parameters, **kwargs)
+
+
+def _build_scheduler(config, optimizer):
+    # the DeepSpeed config's WarmupLR scheduler, as a LambdaLR
+    if config is None:
+        return None
+    if config["type"] != "WarmupLR":
+        raise ValueError(f"scheduler {config['type']} isn't supported without DeepSpeed")
+    params = config.get("params", {})
+    min_lr, max_lr = params.get("warmup_min_lr", 0.), params.get("warmup_max_lr", 0.001)
+    warmup_steps, warmup_type = params.get("warmup_num_steps", 1000), params.get("warmup_type", "log")
+    for group in optimizer.param_groups:
+        group["lr"] = max_lr
+
+    def factor(step):
+        if step >= warmup_steps:
+            return 1.
+        gamma = math.log(step + 1) / math.log(warmup_steps) if warmup_type == "log" else step / warmup_steps
+        return (min_lr + (max_lr - min_lr) * gamma) / max_lr
+    return torch.optim.lr_scheduler.LambdaLR(optimizer, factor)
+
+
+class DDPEngine:
+    """
+    the parts of DeepSpeedEngine the training scripts use, over torch DistributedDataParallel: batch sizes, gradient
+    accumulation, gradient clipping, the optimizer and a WarmupLR scheduler are read from the DeepSpeed config
+    """
+    def __init__(self, model, optimizer=None, model_parameters=None, config=None, device="cpu"):
+        config = config or {}
+        self.device = torch.device(device)
+        self.module = model.to(self.device)
+        self.dp_world_size = dist.get_world_size() if dist.is_initialized() else 1
+        self.global_rank = dist.get_rank() if dist.is_initialized() else 0
+        self.local_rank = int(os.environ.get("LOCAL_RANK", 0))
+        self.network = self.module
+        if self.dp_world_size > 1:
+            self.network = DistributedDataParallel(self.module,
+                                                   device_ids=[self.device] if self.device.type == "cuda" else None)
+
+        # any two of the batch sizes determine the third, as in DeepSpeed
+        train_batch_size = config.get("train_batch_size")
+        micro_batch_size = config.get("train_micro_batch_size_per_gpu")
+        accumulation = config.get("gradient_accumulation_steps")
+        if micro_batch_size is None and train_batch_size is None:
+            micro_batch_size, accumulation = 1, accumulation or 1
+        elif micro_batch_size is None:
+            accumulation = accumulation or 1
+            micro_batch_size = train_batch_size // (accumulation * self.dp_world_size)
+        elif accumulation is None:
+            accumulation = max(1, (train_batch_size or micro_batch_size * self.dp_world_size) //
+                               (micro_batch_size * self.dp_world_size))
+        self.micro_batch_size = micro_batch_size
+        self.gradient_accumulation_steps = accumulation
+        self.train_batch_size = micro_batch_size * accumulation * self.dp_world_size
+        self.gradient_clipping = config.get("gradient_clipping", 0.)
+        if config.get("fp16", {}).get("enabled"):
+            logging.warning("fp16 is only supported by DeepSpeed - training in fp32")
+
+        parameters = model_parameters if model_parameters is not None else self.module.parameters()
+        self.optimizer = optimizer if optimizer is not None else _build_optimizer(config.get("optimizer"), parameters)
+        self.lr_scheduler = _build_scheduler(config.get("scheduler"), self.optimizer)
+        self.micro_steps = 0
+        self.global_steps = 0
+        self.global_samples = 0
+        self.skipped_steps = 0
+
+    def train_micro_batch_size_per_gpu(self):
+        return self.micro_batch_size
+
+    def zero_optimization(self):
+        return False
+
+    def is_gradient_accumulation_boundary(self):
+        return (self.micro_steps + 1) % self.gradient_accumulation_steps == 0
+
+    def train(self, mode=True):
+        self.module.train(mode)
+        return self
+
+    def eval(self):
+        return self.train(False)
+
+    def __call__(self, *args, **kwargs):
+        # gradients are only all-reduced in the backward of the last micro batch before a step
+        sync = self.is_gradient_accumulation_boundary() or self.network is self.module
+        with contextlib.nullcontext() if sync else self.network.no_sync():
+            return self.network(*args, **kwargs)
+
+    def backward(self, loss):
+        (loss / self.gradient_accumulation_steps).backward()
+
+    def step(self):
+        if self.is_gradient_accumulation_boundary():
+            if self.gradient_clipping > 0:
+                torch.nn.utils.clip_grad_norm_(self.module.parameters(), self.gradient_clipping)
+            self.optimizer.step()
+            self.optimizer.zero_grad(set_to_none=True)
+            if self.lr_scheduler is not None:
+                self.lr_scheduler.step()
+            self.global_steps += 1
+            self.global_samples += self.train_batch_size
+        self.micro_steps += 1
+
+    def deepspeed_io(self, dataset, batch_size=None, pin_memory=False, data_sampler=None, collate_fn=None,
+                     num_local_io_workers=None):
+        if data_sampler is None:
+            data_sampler = DistributedSampler(dataset, num_replicas=self.dp_world_size, rank=self.global_rank) \
+                if self.dp_world_size > 1 else RandomSampler(dataset)
+        return DataLoader(dataset, batch_size=batch_size or self.micro_batch_size, sampler=data_sampler,
+                          pin_memory=pin_memory, collate_fn=collate_fn, num_workers=num_local_io_workers or 0)
+
+
+def initialize(args, model, params, optimizer=None, model_parameters=None, training_data=None):
+    """
+    deepspeed.initialize, or the DDPEngine equivalent: returns (engine, optimizer, training data loader,
+    lr scheduler)
+    """
+    if _use_deepspeed(params):
+        import deepspeed
+        return deepspeed.initialize(args=args, model=model, optimizer=optimizer, model_parameters=model_parameters,
+                                    training_data=training_data)
+    config = {}
+    if getattr(args, "deepspeed_config", None) is not None:
+        with open(args.deepspeed_config) as f:
+            config = json.load(f)
+    if optimizer is None and "optimizer" not in config and params.get("learning_rate") is not None:
+        parameters = model_parameters if model_parameters is not None else model.parameters()
+        optimizer = torch.optim.Adam(parameters, lr=params["learning_rate"])
+    engine = DDPEngine(model, optimizer=optimizer, model_parameters=model_parameters, config=config,
+                       device=get_device(params, getattr(args, "local_rank", None)))
+    loader = engine.deepspeed_io(training_data) if training_data is not None else None
+    return engine, engine.optimizer, loader, engine.lr_scheduler
@@ -0,0 +1,123 @@
+import math
+import time
+
+import torch
+import torch.distributed as dist
+import torch.nn.functional as F
+from torch.utils.data import DataLoader, IterableDataset, Subset
+
+"""
+Full-pass evaluation, sharded across distributed ranks.
+
+Each rank evaluates a contiguous slice of each eval dataset (iterable datasets shard themselves) under no_grad, with
+activation checkpointing off, and the summed loss, token and byte counts are all-reduced - so the loss is weighted by
+token, not averaged per batch, and every rank returns the same metrics: loss, perplexity and bits per byte.
+
+train.py runs it every "validate_every" steps on all ranks; scripts/evaluate.py runs it out of process against saved
+checkpoints, so evaluation doesn't stall training.
+"""
+
+
+def token_byte_lengths(tokenizer=None, vocab_size=None):
+    """
+    returns the number of bytes of text each token stands for, as a tensor indexed by token - all ones for byte level
+    models without a tokenizer (enwik8). Special tokens stand for no text
+    """
+    if tokenizer is None:
+        return torch.ones(vocab_size, dtype=torch.long)
+    try:
+        # byte level BPE tokens (GPT-2) are spelled with one character per byte
+        from transformers.models.gpt2.tokenization_gpt2 import bytes_to_unicode
+        byte_chars = set(bytes_to_unicode().values())
+    except ImportError:
+        byte_chars = set()
+    special = set(tokenizer.all_special_ids)
+    lengths = []
+    for token_id, token in enumerate(tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))):
+        if token_id in special:
+            lengths.append(0)
+        elif token is not None and byte_chars and all(c in byte_chars for c in token):
+            lengths.append(len(token))
+        else:
+            lengths.append(len(tokenizer.decode([token_id]).encode("utf-8")))
+    return torch.tensor(lengths, dtype=torch.long)
+
+
+class Evaluator:
+    """
+    evaluates a model on datasets - one dataset, or a dict of name: dataset, whose metrics are prefixed by name - in
+    batches of batch_size (seq_len + 1) token sequences, split between world_size ranks. byte_lengths (see
+    token_byte_lengths) gives bits per byte; max_batches caps the batches per rank and dataset, for cheaper
+    estimates (iterable datasets that never end need it)
+    """
+    def __init__(self, datasets, batch_size, rank=0, world_size=1, byte_lengths=None, max_batches=None,
+                 ignore_index=0):
+        self.datasets = datasets if isinstance(datasets, dict) else {None: datasets}
+        self.batch_size = batch_size
+        self.rank = rank
+        self.world_size = world_size
+        self.byte_lengths = byte_lengths
+        self.max_batches = max_batches
+        self.ignore_index = ignore_index
+
+    def _loader(self, dataset):
+        if not isinstance(dataset, IterableDataset):
+            # contiguous slices rather than strided indices, so each rank reads its own files
+            start, end = (len(dataset) * r // self.world_size for r in (self.rank, self.rank + 1))
+            dataset = Subset(dataset, range(start, end))
+        return DataLoader(dataset, batch_size=self.batch_size)
+
+    def _sums(self, model, dataset, device, byte_lengths):
+        # summed nll, token and byte counts of this rank's shard, accumulated on device to avoid a sync per batch
+        sums = torch.zeros(3, dtype=torch.float64, device=device)
+        for i, batch in enumerate(self._loader(dataset)):
+            if self.max_batches is not None and i >= self.max_batches:
+                break
+            if isinstance(batch, (tuple, list)):  # (inputs, labels)
+                batch = torch.cat([batch[0], batch[1][:, -1:]], dim=1)
+            batch = batch.to(device)
+            inputs, targets = batch[:, :-1], batch[:, 1:]
+            logits = model.net(inputs).float()
+            losses = F.cross_entropy(logits.transpose(1, 2), targets, reduction="none", ignore_index=self.ignore_index)
+            counted = targets != self.ignore_index
+            sums[0] += losses.sum()
+            sums[1] += counted.sum()
+            if byte_lengths is not None:
+                sums[2] += byte_lengths[targets][counted].sum()
+        return sums
+
+    @torch.no_grad()
+    def evaluate(self, model):
+        """
+        returns the metrics of model (an AutoregressiveWrapper) over every dataset. In a distributed run, every rank
+        has to call this
+        """
+        start = time.perf_counter()
+        net = model.net
+        was_training, checkpointing = model.training, net.gradient_checkpointing
+        model.eval()
+        net.gradient_checkpointing = False
+        device = next(model.parameters()).device
+        byte_lengths = self.byte_lengths.to(device) if self.byte_lengths is not None else None
+        try:
+            names = list(self.datasets)
+            sums = torch.stack([self._sums(model, self.datasets[name], device, byte_lengths) for name in names])
+        finally:
+            net.gradient_checkpointing = checkpointing
+            model.train(was_training)
+
+        if dist.is_available() and dist.is_initialized() and self.world_size > 1:
+            dist.all_reduce(sums)
+        sums = sums.cpu()
+
+        metrics = {}
+        for name, (nll, tokens, n_bytes) in zip(names, sums.tolist()):
+            prefix = f"{name}/" if name is not None else ""
+            loss = nll / max(tokens, 1)
+            metrics[f"{prefix}loss"] = loss
+            metrics[f"{prefix}perplexity"] = math.exp(min(loss, 100))
+            if self.byte_lengths is not None:
+                metrics[f"{prefix}bits_per_byte"] = nll / math.log(2) / max(n_bytes, 1)
+            metrics[f"{prefix}tokens"] = int(tokens)
+        metrics["seconds"] = time.perf_counter() - start
+        return metrics
@@ -0,0 +1,319 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+"""
+Downloads files over http(s) with concurrent range requests, resuming partial downloads and verifying checksums.
+
+file:// urls and plain paths are copied (or hard linked), and mirrors - local directories or url prefixes, e.g. a
+cache on a shared filesystem - are tried before the original url. Extra mirrors can be given in the
+GPT_NEOX_DATA_MIRRORS environment variable, separated by commas.
+"""
+
+_CHUNK_SIZE = 1 << 20
+_STATE_EVERY = 64 << 20  # persist range progress every 64MB
+
+
+class ChecksumError(Exception):
+    pass
+
+
+def _urlopen(url, headers=None, method=None, timeout=60):
+    return urllib.request.urlopen(urllib.request.Request(url, headers=headers or {}, method=method), timeout=timeout)
+
+
+def _local_path(url):
+    # returns the local path for file:// urls and plain paths, and None for remote urls
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme == "file":
+        return urllib.request.url2pathname(parsed.path)
+    if parsed.scheme == "":
+        return url
+    return None
+
+
+def verify_checksum(path, checksum):
+    """
+    checks path against a checksum formatted "<algorithm>:<hex digest>", e.g. "sha256:9f86d0..."
+    """
+    algorithm, expected = checksum.split(":", 1)
+    h = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b""):
+            h.update(chunk)
+    if h.hexdigest() != expected.lower():
+        raise ChecksumError(f"{path} has {algorithm} {h.hexdigest()}, expected {expected}")
+
+
+def _probe(url):
+    # returns the size of the remote file (or None if unknown) and whether the server accepts range requests
+    try:
+        with _urlopen(url, method="HEAD") as response:
+            size = response.headers.get("Content-Length")
+            return (int(size) if size is not None else None), response.headers.get("Accept-Ranges") == "bytes"
+    except urllib.error.HTTPError:
+        return None, False
+
+
+class _RangeDownload:
+    """
+    downloads a file of known size as num_connections concurrent byte ranges into a preallocated .part file.
+    Progress of each range is kept in a .part.json file next to it, so an interrupted download resumes where it left
+    off.
+    """
+    def __init__(self, url, part_path, size, num_connections, retries):
+        self.url = url
+        self.part_path = part_path
+        self.state_path = part_path + ".json"
+        self.size = size
+        self.retries = retries
+        self.lock = threading.Lock()
+        self.ranges = self._load_ranges()
+        if self.ranges is None:
+            step = max(_CHUNK_SIZE, -(-size // num_connections))
+            self.ranges = [[start, min(start + step, size), 0] for start in range(0, size, step)]
+            with open(part_path, "wb") as f:
+                f.truncate(size)
+        self._since_save = 0
+
+    def _load_ranges(self):
+        if not (os.path.isfile(self.state_path) and os.path.isfile(self.part_path)):
+            return None
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except ValueError:
+            return None
+        if state.get("url") != self.url or state.get("size") != self.size:
+            return None
+        return state["ranges"]
+
+    def _save_ranges(self):
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"url": self.url, "size": self.size, "ranges": self.ranges}, f)
+        os.replace(tmp_path, self.state_path)
+
+    def _fetch_range(self, r, fd):
+        start, end, _ = r
+        for attempt in range(self.retries + 1):
+            offset = start + r[2]
+            if offset >= end:
+                return
+            try:
+                with _urlopen(self.url, headers={"Range": f"bytes={offset}-{end - 1}"}) as response:
+                    if response.status != 206:
+                        raise IOError(f"server ignored range request (status {response.status})")
+                    for chunk in iter(lambda: response.read(_CHUNK_SIZE), b""):
+                        os.pwrite(fd, chunk, start + r[2])
+                        with self.lock:
+                            r[2] += len(chunk)
+                            self._since_save += len(chunk)
+                            if self._since_save >= _STATE_EVERY:
+                                self._save_ranges()
+                                self._since_save = 0
+                # a dropped connection ends the read early rather than raising
+                if start + r[2] < end:
+                    raise IOError(f"connection closed {end - start - r[2]} bytes before the end of the range")
+                return
+            except (IOError, OSError) as e:
+                if attempt == self.retries:
+                    raise
+                print(f"Retrying {self.url} [{offset}-{end}) after error: {e}")
+                time.sleep(2 ** attempt)
+
+    def run(self):
+        errors = []
+
+        def worker(r):
+            try:
+                self._fetch_range(r, fd)
+            except BaseException as e:
+                errors.append(e)
+
+        fd = os.open(self.part_path, os.O_WRONLY)
+        try:
+            threads = [threading.Thread(target=worker, args=(r,)) for r in self.ranges if r[2] < r[1] - r[0]]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            os.close(fd)
+            with self.lock:
+                self._save_ranges()
+        if errors:
+            raise errors[0]
+        os.remove(self.state_path)
+
+
+def _range_total(content_range):
+    # the total size in a Content-Range header ("bytes <first>-<last>/<total>" or "bytes */<total>"), if it's known
+    try:
+        return int(content_range.rsplit("/", 1)[1])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+def _stream_download(url, part_path, retries):
+    # single connection download, appending to a partial file if the server supports ranges
+    attempt = 0
+    while True:
+        offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+        try:
+            headers = {"Range": f"bytes={offset}-"} if offset > 0 else {}
+            with _urlopen(url, headers=headers) as response:
+                mode = "ab" if response.status == 206 else "wb"  # 200 means the server sent the whole file
+                length = response.headers.get("Content-Length")
+                with open(part_path, mode) as f:
+                    start = f.tell()
+                    shutil.copyfileobj(response, f, _CHUNK_SIZE)
+                    received = f.tell() - start
+            # a dropped connection ends the read early rather than raising
+            if length is not None and received < int(length):
+                raise IOError(f"connection closed {int(length) - received} bytes before the end of the file")
+            return
+        except urllib.error.HTTPError as e:
+            if e.code == 416 and offset > 0:
+                # range not satisfiable - the partial file is complete if it's the size of the remote file, otherwise
+                # it's stale (e.g. the file changed upstream) and the download starts over
+                total = _range_total(e.headers.get("Content-Range"))
+                if total is None:
+                    total, _ = _probe(url)
+                if total == offset:
+                    return
+                print(f"Restarting {url}: the partial download has {offset} bytes, the file {total}")
+                os.remove(part_path)
+                continue
+            if attempt == retries:
+                raise
+        except (IOError, OSError) as e:
+            if attempt == retries:
+                raise
+            print(f"Retrying {url} after error: {e}")
+        time.sleep(2 ** attempt)
+        attempt += 1
+
+
+def _copy_local(src, part_path):
+    # hard links when the mirror is on the same filesystem, otherwise copies
+    if os.path.exists(part_path):
+        os.remove(part_path)
+    try:
+        os.link(src, part_path)
+    except OSError:
+        shutil.copyfile(src, part_path)
+
+
+def get_mirrors(mirrors=None):
+    mirrors = list(mirrors or [])
+    env_mirrors = os.environ.get("GPT_NEOX_DATA_MIRRORS")
+    if env_mirrors:
+        mirrors += [m for m in env_mirrors.split(",") if m]
+    return mirrors
+
+
+def fetch(url, dest, checksum=None, mirrors=None, num_connections=8, retries=5):
+    """
+    downloads url to dest. Mirrors are tried first, each as <mirror>/<basename of url>. The download goes to
+    dest + ".part" and is only renamed to dest once complete (and, if checksum is given, verified), so an existing
+    dest is always a complete file.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(dest)), exist_ok=True)
+    part_path = dest + ".part"
+    filename = os.path.basename(urllib.parse.urlparse(url).path)
+    candidates = [m.rstrip("/") + "/" + filename for m in get_mirrors(mirrors)] + [url]
+
+    for i, candidate in enumerate(candidates):
+        is_last = i == len(candidates) - 1
+        t = time.perf_counter()
+        try:
+            local = _local_path(candidate)
+            if local is not None:
+                if not os.path.isfile(local):
+                    raise FileNotFoundError(local)
+                _copy_local(local, part_path)
+            else:
+                size, accepts_ranges = _probe(candidate)
+                if size is not None and accepts_ranges and num_connections > 1:
+                    _RangeDownload(candidate, part_path, size, num_connections, retries).run()
+                else:
+                    _stream_download(candidate, part_path, retries)
+            if checksum is not None:
+                verify_checksum(part_path, checksum)
+        except (IOError, OSError, ChecksumError) as e:
+            if isinstance(e, ChecksumError) and os.path.exists(part_path):
+                os.remove(part_path)  # don't resume from corrupt data
+            if is_last:
+                raise
+            print(f"Could not fetch {candidate} ({e}), trying next source")
+            continue
+
+        os.replace(part_path, dest)
+        elapsed = time.perf_counter() - t
+        size_mb = os.path.getsize(dest) / 1e6
+        print(f"Fetched {candidate} -> {dest}: {size_mb:.1f}MB in {elapsed:.1f}s ({size_mb / max(elapsed, 1e-9):.1f}MB/s)")
+        return dest
+
+
+class StreamReader:
+    """
+    file-like wrapper that counts, and if a checksum is given hashes, the bytes read through it. Call verify() once
+    the stream has been read to the end.
+    """
+    def __init__(self, f, name, checksum=None):
+        self.f = f
+        self.name = name
+        self.checksum = checksum
+        self.bytes_read = 0
+        self._hash = hashlib.new(checksum.split(":", 1)[0]) if checksum is not None else None
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.bytes_read += len(data)
+        if self._hash is not None:
+            self._hash.update(data)
+        return data
+
+    def verify(self):
+        if self._hash is None:
+            return
+        # drain anything the consumer didn't read (e.g. tar padding), so the whole file is hashed
+        while self.read(_CHUNK_SIZE):
+            pass
+        expected = self.checksum.split(":", 1)[1].lower()
+        if self._hash.hexdigest() != expected:
+            raise ChecksumError(f"{self.name} has {self._hash.name} {self._hash.hexdigest()}, expected {expected}")
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_stream(url, checksum=None, mirrors=None):
+    """
+    opens url (or the first mirror that has it) for reading as a stream, without saving it to disk first
+    """
+    filename = os.path.basename(urllib.parse.urlparse(url).path)
+    candidates = [m.rstrip("/") + "/" + filename for m in get_mirrors(mirrors)] + [url]
+    for i, candidate in enumerate(candidates):
+        try:
+            local = _local_path(candidate)
+            f = open(local, "rb") if local is not None else _urlopen(candidate)
+        except (IOError, OSError) as e:
+            if i == len(candidates) - 1:
+                raise
+            print(f"Could not open {candidate} ({e}), trying next source")
+            continue
+        return StreamReader(f, candidate, checksum)
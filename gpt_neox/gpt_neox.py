@@ -1,3 +1,5 @@
+import logging
+
 import torch
 import torch.utils.checkpoint
 import torch.nn.functional as F
@@ -7,7 +9,8 @@ from functools import partial
 from torch.utils.checkpoint import checkpoint
 from einops import rearrange
 
-from deepspeed.pipe import PipelineModule, LayerSpec
+from gpt_neox.output_head import get_output_head
+from gpt_neox.sparse_attention import BlockSparseAttention
 
 # helpers
 
@@ -15,8 +18,9 @@ def exists(val):
     return val is not None
 
 def cast_tuple(val, depth):
-    if isinstance(val, tuple):
-        return val
+    # per layer values come as tuples, or as lists from json configs
+    if isinstance(val, (tuple, list)):
+        return tuple(val)
     return (val,) * depth
 
 # classes
@@ -57,12 +61,13 @@ class FeedForward(nn.Module):
 
 def dense_attn(q, k, v, attn_mask = None, dropout_fn = None):
     scale = q.shape[-1] ** -0.5
-    sim = einsum('b h i d, b h j d -> b h i j', q, k) * scale
+    # the mask is added and the softmax taken in fp32, also when the matmuls run in reduced precision
+    sim = einsum('b h i d, b h j d -> b h i j', q, k).float() * scale
 
     if exists(attn_mask):
         sim = sim + attn_mask[None, None, :, :]
 
-    attn = sim.softmax(dim=-1)
+    attn = sim.softmax(dim=-1).to(v.dtype)
 
     if exists(dropout_fn):
         attn = dropout_fn(attn)
@@ -78,10 +83,19 @@ class Attention(nn.Module):
         self.heads = heads
         self.scale = dim_head ** -0.5
         self.dropout = nn.Dropout(dropout)
-
-        if sparse_attn:
-            from deepspeed.ops.sparse_attention import SparseSelfAttention, VariableSparsityConfig
-
+        self.sparse_attn = sparse_attn
+
+        if sparse_attn is True:
+            try:
+                from deepspeed.ops.sparse_attention import SparseSelfAttention, VariableSparsityConfig
+            except ImportError:
+                # DeepSpeed's sparse attention needs Triton - without it, the same layout in plain PyTorch
+                logging.warning("DeepSpeed sparse attention isn't available - using the equivalent fixed pattern")
+                sparse_attn = {"type": "fixed", "block": 16, "local_blocks": 4, "summary_blocks": 0,
+                               "global_blocks": [0]}
+                self.sparse_attn = sparse_attn
+
+        if sparse_attn is True:
             sparsity_config = VariableSparsityConfig(
                 num_heads=heads,
                 attention=("unidirectional" if causal else "bidirectional")
@@ -92,6 +106,9 @@ class Attention(nn.Module):
                 max_seq_length=seq_len,
                 attn_mask_mode='add'
             )
+        elif sparse_attn:
+            # a local or fixed block sparse pattern, in plain PyTorch - see gpt_neox/sparse_attention.py
+            self.attn_fn = BlockSparseAttention.from_config(sparse_attn, causal=causal, dropout_fn=self.dropout)
         else:
             self.attn_fn = partial(dense_attn, dropout_fn = self.dropout)
 
@@ -105,11 +122,14 @@ class Attention(nn.Module):
         q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> b h n d', h=h), (q, k, v))
 
         mask = None
-        if self.causal:
+        if self.causal and not isinstance(self.attn_fn, BlockSparseAttention):
             i, j = q.shape[-2], k.shape[-2]
             bool_mask = torch.ones(i, j, device=device).triu_(j - i + 1).bool()
-            mask = torch.zeros(i, j, device=device).to(q)
-            mask_value = -(torch.finfo(q.dtype).max / 2)
+            # in the dtype the scores are masked in: q's for DeepSpeed sparse attention, fp32 for dense attention -
+            # under bf16 autocast q is bf16, whose half max would overflow once added to the scores in a narrower type
+            mask_dtype = q.dtype if self.sparse_attn else torch.float32
+            mask = torch.zeros(i, j, device=device, dtype=mask_dtype)
+            mask_value = -(torch.finfo(mask_dtype).max / 2)
             mask.masked_fill_(bool_mask, mask_value)
 
         out = self.attn_fn(q, k, v, attn_mask=mask)
@@ -119,7 +139,8 @@ class Attention(nn.Module):
 
 class GPTNeoX(nn.Module):
     def __init__(self, *, num_tokens, dim, seq_len, depth, heads=8, dim_head=64, attn_dropout=0., ff_dropout=0., 
-                sparse_attn=False, use_fused_layernorm=False, tie_classifier_weights=False, gradient_checkpointing=True):
+                sparse_attn=False, use_fused_layernorm=False, tie_classifier_weights=False, gradient_checkpointing=True,
+                autocast_dtype=None, output_head=None):
         super().__init__()
         if not use_fused_layernorm:
             norm_class = nn.LayerNorm
@@ -128,6 +149,7 @@ class GPTNeoX(nn.Module):
             norm_class = FusedLayerNorm
 
         self.seq_len = seq_len
+        self.num_tokens = num_tokens
 
         self.token_emb = nn.Embedding(num_tokens, dim)
         self.pos_emb = nn.Embedding(seq_len, dim)
@@ -147,14 +169,33 @@ class GPTNeoX(nn.Module):
 
         self.norm = norm_class(dim)
 
-        if tie_classifier_weights:
+        if exists(output_head):
+            # an adaptive or sampled softmax head (see gpt_neox/output_head.py), which the AutoregressiveWrapper
+            # computes the loss with
+            assert not tie_classifier_weights, "output heads can't be tied to the token embedding"
+            self.to_logits = get_output_head(output_head, dim, num_tokens)
+        elif tie_classifier_weights:
             self.to_logits = lambda t: t @ self.token_emb.weight.t()
         else:
             self.to_logits = nn.Linear(dim, num_tokens)
         
         self.gradient_checkpointing = gradient_checkpointing
-
-    def forward(self, x, mask=None):
+        self.autocast_dtype = autocast_dtype
+
+    def autocast(self, device):
+        """
+        the mixed precision context forward runs in, with autocast_dtype (e.g. torch.bfloat16) matmuls. The residual
+        stream stays fp32, so the layer norms run in fp32
+        """
+        return torch.autocast(device_type=torch.device(device).type, dtype=self.autocast_dtype or torch.bfloat16,
+                              enabled=exists(self.autocast_dtype))
+
+    def forward(self, x, mask=None, return_hidden=False):
+        """the logits of the next token at each position, or with return_hidden the final (normed) hidden states"""
+        with self.autocast(x.device):
+            return self._forward(x, mask=mask, return_hidden=return_hidden)
+
+    def _forward(self, x, mask=None, return_hidden=False):
         n, device = x.shape[1], x.device
 
         x = self.token_emb(x)
@@ -176,7 +217,7 @@ class GPTNeoX(nn.Module):
                 x = layer_fn(x)
 
         x = self.norm(x)
-        return self.to_logits(x)
+        return x if return_hidden else self.to_logits(x)
 
 class TransformerBlock(nn.Module):
     def __init__(
@@ -220,61 +261,10 @@ class EmbedBlock(nn.Module):
         x = self.pos_emb(torch.arange(n, device=device)) + x
         return x
 
-class GPTNeoX_Pipe(PipelineModule):
-    def __init__(
-        self, 
-        *, 
-        num_tokens, 
-        dim, 
-        seq_len, 
-        depth, 
-        loss_fn,
-        heads = 8, 
-        dim_head = 64, 
-        attn_dropout = 0., 
-        ff_dropout = 0., 
-        sparse_attn = False, 
-        use_fused_layernorm = False, 
-        tie_classifier_weights = False,
-        num_stages = 2,
-        **kwargs
-    ):
-        if not use_fused_layernorm:
-            norm_class = nn.LayerNorm
-        else:
-            from apex.normalization import FusedLayerNorm
-            norm_class = FusedLayerNorm
-
-        self.seq_len = seq_len
-
-        layers_sparse_attn = cast_tuple(sparse_attn, depth)
-
-        #Build spec list
-        #Input Embedding
-        spec = [
-            LayerSpec(EmbedBlock, num_tokens = num_tokens, dim = dim, seq_len=seq_len)
-        ]
-        #Transformer layers
-        for i in range(depth):
-            spec.append(
-                LayerSpec(
-                    TransformerBlock,
-                    dim = dim, 
-                    seq_len = seq_len, 
-                    heads = heads, 
-                    dim_head = dim_head, 
-                    attn_dropout = attn_dropout, 
-                    ff_dropout = ff_dropout, 
-                    sparse_attn = layers_sparse_attn[i], 
-                    norm_class = norm_class
-                )
-            )
-        #Output norm and Linear
-        spec += [
-            LayerSpec(norm_class, dim),
-            LayerSpec(nn.Linear, dim, num_tokens),
-            lambda x: x.transpose(1, 2)
-        ]
-        print(spec)
-        assert len(spec) % num_stages == 0, f"for optimal performance, depth + 4 ({len(spec)}) should be divisible by the number of pipeline stages ({num_stages})"
-        super().__init__(layers=spec, loss_fn=loss_fn, num_stages=num_stages, **kwargs)
+def __getattr__(name):
+    # GPTNeoX_Pipe subclasses deepspeed's PipelineModule, so it lives in its own module and deepspeed
+    # is only imported once the pipeline model is actually requested
+    if name == "GPTNeoX_Pipe":
+        from gpt_neox.gpt_neox_pipe import GPTNeoX_Pipe
+        return GPTNeoX_Pipe
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
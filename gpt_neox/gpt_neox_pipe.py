@@ -0,0 +1,65 @@
+from torch import nn
+
+from deepspeed.pipe import PipelineModule, LayerSpec
+
+from gpt_neox.gpt_neox import cast_tuple, EmbedBlock, TransformerBlock
+
+
+class GPTNeoX_Pipe(PipelineModule):
+    def __init__(
+        self, 
+        *, 
+        num_tokens, 
+        dim, 
+        seq_len, 
+        depth, 
+        loss_fn,
+        heads = 8, 
+        dim_head = 64, 
+        attn_dropout = 0., 
+        ff_dropout = 0., 
+        sparse_attn = False, 
+        use_fused_layernorm = False, 
+        tie_classifier_weights = False,
+        num_stages = 2,
+        **kwargs
+    ):
+        if not use_fused_layernorm:
+            norm_class = nn.LayerNorm
+        else:
+            from apex.normalization import FusedLayerNorm
+            norm_class = FusedLayerNorm
+
+        self.seq_len = seq_len
+
+        layers_sparse_attn = cast_tuple(sparse_attn, depth)
+
+        #Build spec list
+        #Input Embedding
+        spec = [
+            LayerSpec(EmbedBlock, num_tokens = num_tokens, dim = dim, seq_len=seq_len)
+        ]
+        #Transformer layers
+        for i in range(depth):
+            spec.append(
+                LayerSpec(
+                    TransformerBlock,
+                    dim = dim, 
+                    seq_len = seq_len, 
+                    heads = heads, 
+                    dim_head = dim_head, 
+                    attn_dropout = attn_dropout, 
+                    ff_dropout = ff_dropout, 
+                    sparse_attn = layers_sparse_attn[i], 
+                    norm_class = norm_class
+                )
+            )
+        #Output norm and Linear
+        spec += [
+            LayerSpec(norm_class, dim),
+            LayerSpec(nn.Linear, dim, num_tokens),
+            lambda x: x.transpose(1, 2)
+        ]
+        print(spec)
+        assert len(spec) % num_stages == 0, f"for optimal performance, depth + 4 ({len(spec)}) should be divisible by the number of pipeline stages ({num_stages})"
+        super().__init__(layers=spec, loss_fn=loss_fn, num_stages=num_stages, **kwargs)
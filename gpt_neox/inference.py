@@ -0,0 +1,209 @@
+import logging
+
+import torch
+import torch.nn.functional as F
+
+from gpt_neox.autoregressive_wrapper import AutoregressiveWrapper, top_k, top_p
+from gpt_neox.checkpoint import build_on_meta, get_dtype, is_tensor_file, load_tensors, materialize
+from gpt_neox.gpt_neox import GPTNeoX
+from gpt_neox.utils import decode_tokens
+
+"""
+Helpers for running trained models outside of the training scripts: building a model from its config, loading a
+checkpoint, encoding / decoding text and sampling a batch of sequences of different lengths in one forward pass.
+"""
+
+FILTERS = {"top_k": top_k, "top_p": top_p}
+
+
+def build_model(params, vocab_size=None):
+    """builds the AutoregressiveWrapper(GPTNeoX) described by a model config, as in train.py"""
+    model = GPTNeoX(
+        num_tokens=vocab_size if vocab_size is not None else params["vocab_size"],
+        dim=params["hidden_dim"],
+        seq_len=params["seq_len"],
+        depth=params["n_layers"],
+        heads=params["n_heads"],
+        dim_head=params["dim_head"],
+        sparse_attn=params.get("sparse_attn", False),
+        gradient_checkpointing=False,
+        output_head=params.get("output_head"),
+        autocast_dtype=get_dtype(params.get("precision"))
+    )
+    return AutoregressiveWrapper(model)
+
+
+def read_checkpoint(checkpoint_path):
+    """
+    reads the state dict of an AutoregressiveWrapper from a torch checkpoint. Accepts plain state dicts of the wrapper
+    or of the GPTNeoX inside it, DeepSpeed model states ({"module": state_dict, ...}) and tensor files
+    (see gpt_neox.checkpoint), which are memory mapped rather than read
+    """
+    if is_tensor_file(checkpoint_path):
+        state_dict = load_tensors(checkpoint_path)
+    else:
+        state_dict = torch.load(checkpoint_path, map_location="cpu")
+    if "module" in state_dict:
+        state_dict = state_dict["module"]
+    if not any(k.startswith("net.") for k in state_dict):
+        state_dict = {f"net.{k}": v for k, v in state_dict.items()}
+    return state_dict
+
+
+def load_checkpoint(model, checkpoint_path):
+    """loads a checkpoint (in any format read_checkpoint accepts) into an AutoregressiveWrapper"""
+    model.load_state_dict(read_checkpoint(checkpoint_path))
+    return model
+
+
+class TextCodec:
+    """
+    encodes / decodes text with the tokenizer from a model config, or as raw bytes (as for enwik8) if the config
+    has no tokenizer section
+    """
+    def __init__(self, tokenizer_params=None):
+        self.tokenizer = None
+        if tokenizer_params is not None:
+            from gpt_neox.data_utils import get_tokenizer
+            self.tokenizer = get_tokenizer(tokenizer_type=tokenizer_params.get("type", None),
+                                           from_pretrained=tokenizer_params.get("from_pretrained", True),
+                                           add_padding_token=tokenizer_params.get("add_padding_token", False))
+
+    @property
+    def eos_token_id(self):
+        return self.tokenizer.eos_token_id if self.tokenizer is not None else None
+
+    @property
+    def vocab_size(self):
+        return len(self.tokenizer) if self.tokenizer is not None else None
+
+    def encode(self, text):
+        if self.tokenizer is not None:
+            return self.tokenizer.encode(text)
+        return list(text.encode("utf-8"))
+
+    def decode(self, tokens):
+        if self.tokenizer is not None:
+            return self.tokenizer.decode(tokens)
+        return decode_tokens(tokens)
+
+
+def load_model(params, checkpoint_path=None, device="cpu", dtype=None):
+    """
+    returns (model, codec) for a model config, in eval mode on device, with floating point weights cast to dtype if
+    given. Tensor file checkpoints are loaded without initializing the model first, straight from the mapped file
+    """
+    codec = TextCodec(params.get("tokenizer"))
+    vocab_size = params["vocab_size"] if params.get("vocab_size") is not None else codec.vocab_size
+    if checkpoint_path is not None and is_tensor_file(checkpoint_path):
+        model = build_on_meta(build_model, params, vocab_size)
+        state_dict = read_checkpoint(checkpoint_path)
+        if dtype is not None:
+            state_dict = {k: v.to(dtype) if v.is_floating_point() else v for k, v in state_dict.items()}
+        return materialize(model, state_dict, device).eval(), codec
+
+    model = build_model(params, vocab_size)
+    if checkpoint_path is not None:
+        load_checkpoint(model, checkpoint_path)
+    else:
+        logging.warning("No checkpoint given - using randomly initialized weights")
+    if dtype is not None:
+        model = model.to(dtype)
+    return model.to(device).eval(), codec
+
+
+@torch.no_grad()
+def next_token_logits(net, sequences):
+    """
+    returns the logits of the next token of each sequence in a list of 1d token tensors, with a single forward pass.
+    Sequences are right padded to the same length - the causal mask keeps padding from being attended to by the
+    tokens before it, so each row's logits are read at its own last position
+    """
+    seq_len = net.seq_len
+    sequences = [s[-seq_len:] for s in sequences]
+    lengths = torch.tensor([len(s) for s in sequences])
+    x = torch.zeros(len(sequences), int(lengths.max()), dtype=torch.long)
+    for row, s in enumerate(sequences):
+        x[row, :len(s)] = s
+    device = next(net.parameters()).device
+    logits = net(x.to(device))
+    return logits[torch.arange(len(sequences), device=device), lengths.to(device) - 1]
+
+
+def sample(logits, temperature=1., filter_logits_fn=top_k, filter_thres=0.9):
+    """samples a token from each row of logits, as AutoregressiveWrapper.generate does - greedily at temperature 0"""
+    if temperature == 0:
+        return logits.argmax(dim=-1)
+    if filter_logits_fn is not None:
+        logits = filter_logits_fn(logits, thres=filter_thres)
+    probs = F.softmax(logits / temperature, dim=-1)
+    return torch.multinomial(probs, 1).squeeze(-1)
+
+
+class TextDeltas:
+    """
+    turns a stream of tokens into text deltas. Text is held back while it's an incomplete character or could still
+    turn out to be the start of a stop string, and the stream ends at the first stop string (which isn't emitted)
+    """
+    def __init__(self, codec, stop=None):
+        self.codec = codec
+        self.stop = [s for s in (stop or []) if s]
+        self.tokens = []
+        self.emitted = 0
+        self.stopped = False
+
+    def _holdback(self, text):
+        # length of the longest suffix of text that's a proper prefix of a stop string
+        longest = 0
+        for s in self.stop:
+            for n in range(min(len(s) - 1, len(text)), longest, -1):
+                if text.endswith(s[:n]):
+                    longest = n
+                    break
+        return longest
+
+    def add(self, token):
+        """returns the text that's safe to emit after token, and sets stopped if a stop string was generated"""
+        self.tokens.append(token)
+        text = self.codec.decode(self.tokens)
+        if text.endswith("\ufffd"):
+            return ""  # part of a multi-byte character
+        stops = [i for i in (text.find(s, max(self.emitted - len(s) + 1, 0)) for s in self.stop) if i >= 0]
+        if stops:
+            self.stopped = True
+            end = min(stops)
+        else:
+            end = len(text) - self._holdback(text)
+        delta, self.emitted = text[self.emitted:end], max(self.emitted, end)
+        return delta
+
+    def flush(self):
+        """returns any text still held back, once the stream has ended without a stop string"""
+        if self.stopped:
+            return ""
+        text = self.codec.decode(self.tokens)
+        delta, self.emitted = text[self.emitted:], len(text)
+        return delta
+
+
+def stream_text(model, codec, prompt, max_tokens, stop=None, max_time=None, device="cpu", **sampling_kwargs):
+    """
+    yields the text generated for prompt as it's decoded, ending at max_tokens, an eos token, one of the stop strings
+    or after max_time seconds. sampling_kwargs (temperature, filter_logits_fn, filter_thres) go to generate_stream
+    """
+    start_tokens = torch.tensor(codec.encode(prompt), dtype=torch.long, device=device)
+    deltas = TextDeltas(codec, stop)
+    tokens = model.generate_stream(start_tokens, max_tokens, eos_token=codec.eos_token_id, max_time=max_time,
+                                   **sampling_kwargs)
+    try:
+        for token in tokens:
+            delta = deltas.add(int(token))
+            if delta:
+                yield delta
+            if deltas.stopped:
+                return
+        delta = deltas.flush()
+        if delta:
+            yield delta
+    finally:
+        tokens.close()  # frees the decode state right away, even if our own consumer stopped early
@@ -0,0 +1,144 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+import torch.nn.functional as F
+
+from gpt_neox.checkpoint import build_on_meta, read_header, read_tensors, tensor_nbytes
+from gpt_neox.inference import build_model, TextCodec
+
+"""
+Layer-streaming inference, for running models larger than the memory available.
+
+Only the embeddings, the final norm and the classifier stay resident. The transformer blocks in GPTNeoX.layers are read
+from a tensor file (see gpt_neox.checkpoint) one at a time, with the next blocks read by a background thread while the
+current one computes, and dropped once every sequence has been through them. Each pass streams the weights once, so
+the more sequences are batched into a pass, the less I/O each token costs.
+"""
+
+
+class LayerStreamingModel:
+    """
+    a GPTNeoX that streams its blocks from the tensor file at tensor_path, keeping at most resident_blocks of them in
+    memory (the block computing and the ones being prefetched - so 1 disables prefetching). Sequences go through each
+    block micro_batch_size at a time, which bounds the activation memory of the block, not of the pass
+    """
+    def __init__(self, params, tensor_path, resident_blocks=2, micro_batch_size=8, dtype=None, vocab_size=None):
+        assert resident_blocks >= 1, "at least one block has to be resident"
+        if vocab_size is None:
+            vocab_size = params["vocab_size"] if params.get("vocab_size") is not None else \
+                TextCodec(params.get("tokenizer")).vocab_size
+        self.net = build_on_meta(build_model, params, vocab_size).net.eval()
+        self.path = tensor_path
+        self.resident_blocks = resident_blocks
+        self.micro_batch_size = micro_batch_size
+        self.dtype = dtype
+
+        # tensor files hold AutoregressiveWrapper or GPTNeoX state dicts
+        self.header, self.data_start = read_header(tensor_path)
+        self._file_names = {name[len("net."):] if name.startswith("net.") else name: name for name in self.header}
+        self._block_names = [[name for name in self._file_names if name.startswith(f"layers.{i}.")]
+                             for i in range(len(self.net.layers))]
+
+        resident = [name for name in self._file_names if not name.startswith("layers.")]
+        tensors, _ = self._read(resident)
+        missing, _ = self.net.load_state_dict(tensors, strict=False, assign=True)
+        missing = [name for name in missing if not name.startswith("layers.")]
+        if missing:
+            raise RuntimeError(f"no tensors in {tensor_path} for {missing}")
+
+        self.block_bytes = max(sum(tensor_nbytes(self.header[self._file_names[name]]) for name in names)
+                               for names in self._block_names)
+        self._executor = ThreadPoolExecutor(max_workers=1) if resident_blocks > 1 else None
+        self.bytes_read = 0
+        self.tokens = 0
+        self.seconds = 0.
+        self.io_wait = 0.
+
+    def _read(self, names, prefix=""):
+        # returns ({name without prefix: tensor}, bytes read)
+        with open(self.path, "rb") as f:
+            tensors = read_tensors(f, self.header, self.data_start, [self._file_names[name] for name in names],
+                                   dtype=self.dtype)
+        nbytes = sum(tensor_nbytes(self.header[self._file_names[name]]) for name in names)
+        return {name[len(prefix):]: tensors[self._file_names[name]] for name in names}, nbytes
+
+    def _read_block(self, i):
+        return self._read(self._block_names[i], prefix=f"layers.{i}.")
+
+    def _micro_batches(self, n):
+        return [slice(start, start + self.micro_batch_size) for start in range(0, n, self.micro_batch_size)]
+
+    @torch.no_grad()
+    def hidden_states(self, x):
+        """returns the final hidden states (before the norm) for a (batch, seq_len) tensor of tokens"""
+        start = time.perf_counter()
+        net, depth = self.net, len(self.net.layers)
+        n = x.shape[1]
+        assert n <= net.seq_len, f"sequences are longer than the model's seq_len ({net.seq_len})"
+        h = net.token_emb(x) + net.pos_emb(torch.arange(n))
+
+        pending = {}
+        try:
+            for i in range(depth):
+                wait = time.perf_counter()
+                if self._executor is None:
+                    tensors, nbytes = self._read_block(i)
+                else:
+                    for j in range(i, min(i + self.resident_blocks, depth)):
+                        if j not in pending:
+                            pending[j] = self._executor.submit(self._read_block, j)
+                    tensors, nbytes = pending.pop(i).result()
+                self.io_wait += time.perf_counter() - wait
+                self.bytes_read += nbytes
+
+                block = net.layers[i]
+                block.load_state_dict(tensors, assign=True)
+                attn, ff = block
+                for rows in self._micro_batches(x.shape[0]):
+                    chunk = h[rows]
+                    with net.autocast(x.device):
+                        chunk = attn(chunk) + chunk
+                        h[rows] = ff(chunk) + chunk
+                block.to("meta")
+                # the block's weights are freed before the next read is submitted, so at most resident_blocks are alive
+                del tensors
+        finally:
+            for future in pending.values():
+                if not future.cancel():
+                    future.result()
+
+        self.tokens += x.numel()
+        self.seconds += time.perf_counter() - start
+        return h
+
+    @torch.no_grad()
+    def __call__(self, x):
+        """returns the logits for a (batch, seq_len) tensor of tokens, like GPTNeoX.forward"""
+        h = self.hidden_states(x)
+        with self.net.autocast(x.device):
+            return torch.cat([self.net.to_logits(self.net.norm(h[rows])) for rows in self._micro_batches(x.shape[0])])
+
+    @torch.no_grad()
+    def nll(self, x):
+        """
+        returns the summed negative log likelihood of each sequence in a (batch, seq_len) tensor of tokens, predicting
+        every token from the ones before it, without holding the logits of the whole batch at once
+        """
+        h = self.hidden_states(x[:, :-1])
+        losses = []
+        for rows in self._micro_batches(x.shape[0]):
+            with self.net.autocast(x.device):
+                logits = self.net.to_logits(self.net.norm(h[rows]))
+            logits = logits.float()
+            losses.append(F.cross_entropy(logits.transpose(1, 2), x[rows, 1:], reduction="none").sum(dim=-1))
+        return torch.cat(losses)
+
+    def metrics(self):
+        return {"tokens": self.tokens, "seconds": self.seconds, "tokens_per_sec": self.tokens / max(self.seconds, 1e-9),
+                "bytes_read": self.bytes_read, "read_mb_per_sec": self.bytes_read / 1e6 / max(self.seconds, 1e-9),
+                "io_wait_seconds": self.io_wait, "resident_block_mb": self.block_bytes * self.resident_blocks / 1e6}
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
@@ -0,0 +1,220 @@
+import copy
+import itertools
+import logging
+import math
+import os
+
+import torch
+import torch.distributed as dist
+import torch.nn.functional as F
+from torch import nn
+from torch.utils.data import IterableDataset
+
+"""
+Output heads for large vocabularies, in place of GPTNeoX's to_logits, where most of the cost of the full softmax goes to
+rare tokens. Configured by a model config's "output_head" (a type, or a dict with "type" and parameters):
+
+    "adaptive"  - adaptive softmax (Grave et al.): a shortlist of the most frequent tokens and one entry per cluster of
+                  rarer tokens form the head softmax, and each cluster has its own softmax over a smaller projection.
+                  "cutoffs" (default [2000, 10000]) are the frequency ranks where clusters start, "div_value" (default
+                  4) how much each cluster's projection shrinks
+    "sampled"   - sampled softmax (Jean et al.): a full classifier, trained against "num_samples" (default 1024)
+                  negatives drawn from a log-uniform distribution over the frequency ranks, with logits corrected by
+                  how likely each is to be drawn. Evaluation and inference use the full softmax, and its weights are
+                  those of a plain to_logits
+
+Both order tokens by frequency, counted by init_output_head over the training data - up to "count_items" sequences
+(default: all, but required for streaming datasets), cached at "counts_path" if given. Until then token ids stand in for frequency ranks, which byte level
+BPE vocabularies roughly follow.
+
+Heads take the final hidden states: calling one returns the full vocabulary's log probabilities (adaptive) or logits
+(sampled), so sampling and evaluation are unchanged, and head.loss computes the training loss without them.
+"""
+
+HEADS = ["adaptive", "sampled"]
+# read by init_output_head rather than by the heads
+COUNT_KEYS = ["count_items", "counts_path"]
+
+
+def _log_uniform(num_tokens):
+    # log P(rank r) of the log-uniform (Zipfian) distribution over ranks 0..num_tokens - 1
+    ranks = torch.arange(num_tokens, dtype=torch.float64)
+    return (torch.log((ranks + 2) / (ranks + 1)) / math.log(num_tokens + 1)).log().float()
+
+
+class AdaptiveSoftmaxHead(nn.Module):
+    def __init__(self, dim, num_tokens, cutoffs=(2000, 10000), div_value=4.):
+        super().__init__()
+        cutoffs = sorted(c for c in cutoffs if 0 < c < num_tokens)
+        self.cutoffs = cutoffs + [num_tokens]
+        self.shortlist = self.cutoffs[0]
+        self.head = nn.Linear(dim, self.shortlist + len(cutoffs))
+        self.tails = nn.ModuleList([])
+        for i, (start, end) in enumerate(zip(self.cutoffs[:-1], self.cutoffs[1:])):
+            projection = max(1, int(dim // div_value ** (i + 1)))
+            self.tails.append(nn.Sequential(nn.Linear(dim, projection, bias=False), nn.Linear(projection, end - start)))
+
+        # the tokens by frequency rank, and the rank of each token - saved with the model, as they define its outputs
+        self.register_buffer("order", torch.arange(num_tokens))
+        self.register_buffer("rank", torch.arange(num_tokens))
+
+    def set_counts(self, counts):
+        order = torch.argsort(counts.to(self.order.device), descending=True, stable=True)
+        self.order.copy_(order)
+        self.rank[order] = torch.arange(len(order), device=order.device)
+
+    def forward(self, x):
+        """the log probabilities of every token, in token order"""
+        # the softmaxes are taken in fp32, also when the projections run in reduced precision
+        head = F.log_softmax(self.head(x).float(), dim=-1)
+        parts = [head[..., :self.shortlist]]
+        for i, tail in enumerate(self.tails):
+            parts.append(F.log_softmax(tail(x).float(), dim=-1) + head[..., self.shortlist + i, None])
+        return torch.cat(parts, dim=-1)[..., self.rank]
+
+    def loss(self, x, targets, ignore_index=None):
+        """the negative log likelihood of each target, computing each cluster's softmax only for its targets"""
+        shape = targets.shape
+        x, targets = x.reshape(-1, x.shape[-1]), targets.reshape(-1)
+        ranks = self.rank[targets]
+
+        head = F.log_softmax(self.head(x).float(), dim=-1)
+        nll = -head.gather(1, ranks.clamp(max=self.shortlist - 1)[:, None])[:, 0]
+        for i, tail in enumerate(self.tails):
+            start, end = self.cutoffs[i], self.cutoffs[i + 1]
+            rows = ((ranks >= start) & (ranks < end)).nonzero(as_tuple=True)[0]
+            # also run for no rows, so every parameter takes part in the backward (as DistributedDataParallel expects)
+            tail_log_probs = F.log_softmax(tail(x[rows]).float(), dim=-1)
+            cluster_nll = -(tail_log_probs.gather(1, (ranks[rows] - start)[:, None])[:, 0] +
+                            head[rows, self.shortlist + i])
+            nll = nll.index_put((rows,), cluster_nll)
+
+        if ignore_index is not None:
+            nll = nll.masked_fill(targets == ignore_index, 0.)
+        return nll.view(shape)
+
+
+class SampledSoftmaxHead(nn.Linear):
+    def __init__(self, dim, num_tokens, num_samples=1024):
+        super().__init__(dim, num_tokens)
+        self.num_samples = min(num_samples, num_tokens)
+        # the log probability of drawing each token - log-uniform over token ids until set_counts. Saved with the
+        # model, so a head ordered by the counts keeps its order when it's loaded
+        self.register_buffer("log_q", _log_uniform(num_tokens))
+
+    def set_counts(self, counts):
+        rank = torch.empty_like(counts, dtype=torch.long)
+        rank[torch.argsort(counts, descending=True, stable=True)] = torch.arange(len(counts))
+        self.log_q.copy_(_log_uniform(len(counts))[rank].to(self.log_q.device))
+
+    def loss(self, x, targets, ignore_index=None):
+        """
+        the negative log likelihood of each target - in training against sampled negatives, shared by the batch,
+        otherwise the full softmax
+        """
+        if not self.training:
+            return F.cross_entropy(self(x).float().transpose(1, 2), targets, reduction="none",
+                                   ignore_index=ignore_index if ignore_index is not None else -100)
+        shape = targets.shape
+        x, targets = x.reshape(-1, x.shape[-1]), targets.reshape(-1)
+        samples = torch.multinomial(self.log_q.exp(), self.num_samples, replacement=True)
+
+        # logits less the log of each candidate's expected count in the samples
+        log_expected = math.log(self.num_samples)
+        true_logits = (x * self.weight[targets]).sum(dim=-1) + self.bias[targets]
+        true_logits = true_logits.float() - (self.log_q[targets] + log_expected)
+        sample_logits = F.linear(x, self.weight[samples], self.bias[samples])
+        sample_logits = sample_logits.float() - (self.log_q[samples] + log_expected)
+        # samples that happen to be the target aren't negatives
+        sample_logits = sample_logits.masked_fill(samples[None, :] == targets[:, None], float("-inf"))
+
+        logits = torch.cat([true_logits[:, None], sample_logits], dim=1)
+        nll = F.cross_entropy(logits, torch.zeros_like(targets), reduction="none")
+        if ignore_index is not None:
+            nll = nll.masked_fill(targets == ignore_index, 0.)
+        return nll.view(shape)
+
+
+def get_output_head(config, dim, num_tokens):
+    """builds the output head of an "output_head" config"""
+    config = {"type": config} if isinstance(config, str) else dict(config)
+    head_type = config.pop("type")
+    assert head_type in HEADS, f"output head {head_type} not recognized, should be one of {HEADS}"
+    kwargs = {k: v for k, v in config.items() if k not in COUNT_KEYS}
+    if head_type == "adaptive":
+        return AdaptiveSoftmaxHead(dim, num_tokens, **kwargs)
+    return SampledSoftmaxHead(dim, num_tokens, **kwargs)
+
+
+def _item_tokens(item):
+    # the tokens of a sequence, or of an (inputs, labels) pair
+    item = torch.cat([item[0], item[1][-1:]]) if isinstance(item, (tuple, list)) else item
+    return torch.as_tensor(item).reshape(-1)
+
+
+def _count(dataset, vocab_size, max_items, rank, world_size):
+    # this rank's share of the counts of a dataset
+    from gpt_neox.datasets import MixtureDataset, TextSamplerDataset
+    counts = torch.zeros(vocab_size, dtype=torch.long)
+    if isinstance(dataset, MixtureDataset):
+        # counted from the sources, never from the mixture's stream, whose position is training state. A cap is
+        # shared between the sources in proportion to their weights
+        shares = dataset.weights / dataset.weights.sum()
+        for source, share in zip(dataset.sources, shares):
+            source_items = max(1, int(max_items * share)) if max_items is not None else None
+            counts += _count(source, vocab_size, source_items, rank, world_size)
+    elif isinstance(dataset, TextSamplerDataset):
+        # the whole corpus is in memory - count it rather than its overlapping windows
+        data = dataset.data[rank * len(dataset.data) // world_size:(rank + 1) * len(dataset.data) // world_size]
+        counts += torch.bincount(data, minlength=vocab_size)[:vocab_size]
+    elif isinstance(dataset, IterableDataset):
+        if max_items is None:
+            raise ValueError("counting the tokens of an iterable dataset, which may never end, needs the output "
+                             "head's count_items (or a counts_path to read them from)")
+        # these shard themselves between ranks. A copy is read, so the training dataset's own state is untouched
+        for item in itertools.islice(copy.deepcopy(dataset), max_items // world_size):
+            counts += torch.bincount(_item_tokens(item), minlength=vocab_size)[:vocab_size]
+    else:
+        n = min(len(dataset), max_items) if max_items is not None else len(dataset)
+        for i in range(rank, n, world_size):
+            counts += torch.bincount(_item_tokens(dataset[i]), minlength=vocab_size)[:vocab_size]
+    return counts
+
+
+def token_counts(dataset, vocab_size, max_items=None, rank=0, world_size=1):
+    """
+    counts the tokens of a dataset of token sequences (or (inputs, labels) pairs), up to max_items sequences - split
+    between world_size ranks, whose counts are summed. Mixtures are counted from their sources, and iterable datasets
+    need max_items
+    """
+    counts = _count(dataset, vocab_size, max_items, rank, world_size)
+
+    if world_size > 1 and dist.is_initialized():
+        device = "cuda" if dist.get_backend() == "nccl" else "cpu"
+        counts = counts.to(device)
+        dist.all_reduce(counts)
+        counts = counts.cpu()
+    return counts
+
+
+def init_output_head(net, params, dataset, rank=0, world_size=1):
+    """
+    orders the output head of net (a GPTNeoX) by the frequency of the tokens in dataset, if the model config has an
+    output head. Call it on every rank
+    """
+    if not hasattr(net.to_logits, "set_counts"):
+        return
+    config = params["output_head"] if isinstance(params["output_head"], dict) else {}
+    counts_path = config.get("counts_path")
+    if counts_path is not None and os.path.exists(counts_path):
+        counts = torch.load(counts_path)
+    else:
+        counts = token_counts(dataset, net.num_tokens, max_items=config.get("count_items"), rank=rank,
+                              world_size=world_size)
+        if counts_path is not None and rank == 0:
+            os.makedirs(os.path.dirname(os.path.abspath(counts_path)), exist_ok=True)
+            tmp_path = f"{counts_path}.{os.getpid()}.tmp"
+            torch.save(counts, tmp_path)
+            os.replace(tmp_path, counts_path)
+    logging.info(f"Ordered the output head by the frequencies of {int(counts.sum())} tokens")
+    net.to_logits.set_counts(counts)
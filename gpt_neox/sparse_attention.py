@@ -0,0 +1,136 @@
+import math
+
+import torch
+from torch import einsum
+
+"""
+Block sparse attention in plain PyTorch, so sparse configs run on any device - DeepSpeed's SparseSelfAttention needs
+Triton on a GPU.
+
+The sequence is split into blocks of `block` tokens, and each query block attends to a fixed list of key blocks (its
+layout row). The keys and values of those blocks are gathered next to the queries, so the scores take
+(seq_len / block) * block * (key blocks per row * block) memory and compute - proportional to the pattern, not to
+seq_len ** 2. Causality, the exact window of local attention and the padding of the last block are masked per token
+within the gathered blocks.
+
+Patterns, given per layer through GPTNeoX's sparse_attn (a name, or a dict with "type" and parameters):
+
+    "local"  - sliding window attention over the previous "window" tokens (default 256), in blocks of "block" tokens
+               (default: the window)
+    "fixed"  - the fixed pattern of Sparse Transformers: attention within chunks of "local_blocks" blocks (default 4)
+               of "block" tokens (default 16), to the last "summary_blocks" blocks of every chunk (default 1) and to
+               the "global_blocks" (default [0]). With summary_blocks 0 it's the layout of DeepSpeed's default
+               VariableSparsityConfig
+"""
+
+PATTERNS = ["local", "fixed"]
+
+
+def _rows(rows, device):
+    # a (n_blocks, max row length) tensor of the sorted key blocks of each row, padded with -1
+    width = max(len(row) for row in rows)
+    return torch.tensor([sorted(row) + [-1] * (width - len(row)) for row in rows], dtype=torch.long, device=device)
+
+
+def local_layout(n_blocks, window_blocks, causal=True):
+    """each query block attends to the window_blocks blocks before it (and after it, if not causal) and itself"""
+    return [set(range(max(0, i - window_blocks), (i + 1) if causal else min(n_blocks, i + window_blocks + 1)))
+            for i in range(n_blocks)]
+
+
+def fixed_layout(n_blocks, local_blocks, summary_blocks=1, global_blocks=(0,), causal=True):
+    """
+    each query block attends to the blocks of its chunk of local_blocks blocks, to the last summary_blocks blocks of
+    every chunk and to global_blocks - all only up to itself if causal
+    """
+    summaries = {j for j in range(n_blocks) if j % local_blocks >= local_blocks - summary_blocks}
+    layout = []
+    for i in range(n_blocks):
+        start = i - i % local_blocks
+        row = set(range(start, min(n_blocks, start + local_blocks))) | summaries | \
+            {j for j in global_blocks if j < n_blocks}
+        layout.append({j for j in row if j <= i} if causal else row)
+    return layout
+
+
+def block_sparse_attn(q, k, v, layout, block, causal=True, window=None, dropout_fn=None):
+    """
+    attention of (b, h, n, d) q, k, v over a block layout - the (n_blocks, width) key block indices of each query
+    block, padded with -1 (see _rows). window additionally limits each query to the keys less than window tokens
+    before it
+    """
+    b, h, n, d = q.shape
+    n_blocks = math.ceil(n / block)
+    pad = n_blocks * block - n
+    if pad > 0:
+        q, k, v = (torch.nn.functional.pad(t, (0, 0, 0, pad)) for t in (q, k, v))
+    q, k, v = (t.reshape(b, h, n_blocks, block, d) for t in (q, k, v))
+
+    # (b, h, n_blocks, width * block, d) keys and values of the blocks each query block attends to
+    indices = layout.clamp(min=0)
+    k, v = (t[:, :, indices].reshape(b, h, n_blocks, -1, d) for t in (k, v))
+
+    # the mask is applied and the softmax taken in fp32, as in dense_attn
+    sim = einsum('b h n i d, b h n j d -> b h n i j', q, k).float() * (d ** -0.5)
+
+    q_pos = torch.arange(n_blocks * block, device=q.device).view(n_blocks, block, 1)
+    k_pos = (indices[:, :, None] * block + torch.arange(block, device=q.device)).view(n_blocks, 1, -1)
+    valid = (layout >= 0).repeat_interleave(block, dim=1)[:, None, :] & (k_pos < n)
+    if causal:
+        valid = valid & (k_pos <= q_pos)
+    if window is not None:
+        valid = valid & (k_pos > q_pos - window) & (k_pos < q_pos + window)
+    sim = sim.masked_fill(~valid, -torch.finfo(sim.dtype).max)
+
+    attn = sim.softmax(dim=-1).to(v.dtype)
+    if dropout_fn is not None:
+        attn = dropout_fn(attn)
+
+    out = einsum('b h n i j, b h n j d -> b h n i d', attn, v)
+    return out.reshape(b, h, n_blocks * block, d)[:, :, :n]
+
+
+class BlockSparseAttention:
+    """
+    a sparse pattern (see PATTERNS) as an attention function of q, k and v, in place of dense_attn. It masks
+    causality itself, so it takes no attention mask
+    """
+    def __init__(self, pattern="local", causal=True, dropout_fn=None, **kwargs):
+        assert pattern in PATTERNS, f"sparse attention pattern {pattern} not recognized, should be one of {PATTERNS}"
+        self.pattern = pattern
+        self.causal = causal
+        self.dropout_fn = dropout_fn
+        if pattern == "local":
+            self.window = kwargs.pop("window", 256)
+            self.block = kwargs.pop("block", self.window)
+        else:
+            self.window = None
+            self.block = kwargs.pop("block", 16)
+            self.local_blocks = kwargs.pop("local_blocks", 4)
+            self.summary_blocks = kwargs.pop("summary_blocks", 1)
+            self.global_blocks = tuple(kwargs.pop("global_blocks", (0,)))
+        assert not kwargs, f"unknown {pattern} sparse attention parameters {sorted(kwargs)}"
+        self._layouts = {}
+
+    @classmethod
+    def from_config(cls, config, causal=True, dropout_fn=None):
+        """from a pattern name, or a dict of the pattern "type" and its parameters"""
+        config = {"type": config} if isinstance(config, str) else dict(config)
+        return cls(config.pop("type"), causal=causal, dropout_fn=dropout_fn, **config)
+
+    def layout(self, n_blocks, device):
+        key = (n_blocks, str(device))
+        if key not in self._layouts:
+            if self.pattern == "local":
+                rows = local_layout(n_blocks, math.ceil(self.window / self.block), causal=self.causal)
+            else:
+                rows = fixed_layout(n_blocks, self.local_blocks, self.summary_blocks, self.global_blocks,
+                                    causal=self.causal)
+            self._layouts[key] = _rows(rows, device)
+        return self._layouts[key]
+
+    def __call__(self, q, k, v, attn_mask=None):
+        assert attn_mask is None, "block sparse attention masks itself"
+        layout = self.layout(math.ceil(q.shape[-2] / self.block), q.device)
+        return block_sparse_attn(q, k, v, layout, self.block, causal=self.causal, window=self.window,
+                                 dropout_fn=self.dropout_fn)
@@ -1,19 +1,21 @@
 import os
 import tarfile
 import argparse
-import deepspeed
 import json
 from collections import defaultdict
 
 
 # helpers
-def get_args():
+def get_args(default_model="gpt3_small"):
+    from gpt_neox.engine import add_config_arguments
+
     parser = argparse.ArgumentParser(description='GPTNeox Deepspeed Training Script')
     # Include DeepSpeed configuration arguments
-    parser.add_argument('--model', type=str, default="gpt3_small")
-    parser.add_argument('--local_rank', type=int, default=-1,
+    parser.add_argument('--model', type=str, default=default_model)
+    # torchrun passes the local rank in the environment rather than as an argument
+    parser.add_argument('--local_rank', type=int, default=int(os.environ.get("LOCAL_RANK", -1)),
                         help='local rank passed from distributed launcher')
-    parser = deepspeed.add_config_arguments(parser)
+    parser = add_config_arguments(parser)
     args = parser.parse_args()
     return args
 
@@ -55,6 +57,28 @@ def cycle(loader):
             yield data
 
 
+def synced_batches(batches, device="cpu"):
+    """
+    yields batches while every distributed rank still has one. Datasets that shard themselves (e.g. streaming ones)
+    give ranks unequal numbers of batches, and a rank that stops early would leave the others waiting in the gradient
+    allreduce
+    """
+    import torch
+    import torch.distributed as dist
+
+    batches = iter(batches)
+    while True:
+        batch = next(batches, None)
+        if dist.is_initialized() and dist.get_world_size() > 1:
+            has_data = torch.tensor([int(batch is not None)], device=device)
+            dist.all_reduce(has_data, op=dist.ReduceOp.MIN)
+            if not has_data.item():
+                return
+        elif batch is None:
+            return
+        yield batch
+
+
 def decode_token(token):
     return str(chr(max(32, token)))
 
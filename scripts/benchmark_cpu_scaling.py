@@ -0,0 +1,98 @@
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+import torch.multiprocessing as mp
+
+"""
+Measures the scaling of CPU training (gloo + DistributedDataParallel, see gpt_neox/engine.py) from 1 to --max_procs
+processes on one machine. Each process trains the model of a config on random tokens with a fixed micro batch (weak
+scaling), with the cores split between the processes, and the throughput of each process count is compared with
+the single process one:
+
+    procs  threads/proc  tokens/s  speedup  efficiency
+
+Usage: python scripts/benchmark_cpu_scaling.py --model base_model --max_procs 8 --steps 20
+"""
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='CPU data parallel training scaling benchmark')
+    parser.add_argument('--model', type=str, default="base_model", help='model config name or path')
+    parser.add_argument('--max_procs', type=int, default=None, help='default: the number of cores')
+    parser.add_argument('--procs', type=str, default=None, help='comma separated process counts to run')
+    parser.add_argument('--micro_batch_size', type=int, default=4)
+    parser.add_argument('--seq_len', type=int, default=None, help='default: the model seq_len')
+    parser.add_argument('--steps', type=int, default=20, help='timed steps')
+    parser.add_argument('--warmup_steps', type=int, default=3)
+    parser.add_argument('--bind_cores', action='store_true', help='pin each process to its own cores')
+    return parser.parse_args()
+
+
+def worker(rank, world_size, port, args, params, result_path):
+    from gpt_neox.engine import DDPEngine, init_distributed
+    from gpt_neox.inference import build_model
+
+    os.environ.update(RANK=str(rank), LOCAL_RANK=str(rank), WORLD_SIZE=str(world_size),
+                      LOCAL_WORLD_SIZE=str(world_size), MASTER_ADDR="127.0.0.1", MASTER_PORT=str(port))
+    params = dict(params, device="cpu", engine="ddp", bind_cores=args.bind_cores)
+    init_distributed(params)
+    torch.manual_seed(rank)
+    engine = DDPEngine(build_model(params), config={"train_micro_batch_size_per_gpu": args.micro_batch_size,
+                                                    "optimizer": {"type": "Adam", "params": {"lr": 1e-4}}})
+    seq_len = args.seq_len or params["seq_len"]
+    data = torch.randint(0, params["vocab_size"], (args.micro_batch_size, seq_len + 1))
+
+    for step in range(args.warmup_steps + args.steps):
+        if step == args.warmup_steps:
+            torch.distributed.barrier()
+            start = time.perf_counter()
+        loss = engine(data)
+        engine.backward(loss)
+        engine.step()
+    torch.distributed.barrier()
+    elapsed = time.perf_counter() - start
+    if rank == 0:
+        tokens = args.steps * args.micro_batch_size * seq_len * world_size
+        with open(result_path, "w") as f:
+            json.dump({"tokens_per_sec": tokens / elapsed, "threads": torch.get_num_threads()}, f)
+    torch.distributed.destroy_process_group()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+if __name__ == '__main__':
+    args = get_args()
+    from gpt_neox.utils import get_params
+    params = dict(get_params(args.model))
+    if params.get("vocab_size") is None:
+        params["vocab_size"] = 50257  # the GPT-2 tokenizer's - random tokens don't need the tokenizer itself
+    max_procs = args.max_procs or len(os.sched_getaffinity(0))
+    if args.procs is not None:
+        counts = [int(n) for n in args.procs.split(",")]
+    else:
+        counts = sorted({2 ** i for i in range(max_procs.bit_length()) if 2 ** i <= max_procs} | {max_procs})
+
+    print(f"{'procs':>5s} {'threads/proc':>12s} {'tokens/s':>10s} {'speedup':>8s} {'efficiency':>10s}")
+    baseline = None
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in counts:
+            result_path = os.path.join(tmp, f"{n}.json")
+            mp.spawn(worker, args=(n, free_port(), args, params, result_path), nprocs=n)
+            with open(result_path) as f:
+                result = json.load(f)
+            baseline = baseline or result["tokens_per_sec"] / n
+            speedup = result["tokens_per_sec"] / baseline
+            print(f"{n:5d} {result['threads']:12d} {result['tokens_per_sec']:10.1f} {speedup:8.2f} "
+                  f"{speedup / n:10.2f}")
@@ -0,0 +1,52 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+"""
+Measures the cold import time of the gpt_neox package in fresh interpreters, and fails if it exceeds a budget or if
+any of the heavy optional dependencies are pulled in at import time.
+
+Usage: python scripts/benchmark_import.py --budget 5.0
+"""
+
+HEAVY_MODULES = ["deepspeed", "tensorflow", "transformers", "zstandard", "ftfy", "lm_dataformat"]
+
+_PROBE = f"""
+import json, sys, time
+t = time.perf_counter()
+import gpt_neox
+elapsed = time.perf_counter() - t
+print(json.dumps({{"seconds": elapsed, "loaded": [m for m in {HEAVY_MODULES!r} if m in sys.modules]}}))
+"""
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='gpt_neox import time benchmark')
+    parser.add_argument('--budget', type=float, default=5.0, help='maximum allowed cold import time in seconds')
+    parser.add_argument('--repeats', type=int, default=3, help='number of fresh interpreters to time')
+    return parser.parse_args()
+
+
+def time_import():
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    out = subprocess.run([sys.executable, "-c", _PROBE], cwd=repo_root, check=True, capture_output=True, text=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    args = get_args()
+    results = [time_import() for _ in range(args.repeats)]
+    best = min(r["seconds"] for r in results)
+    loaded = sorted(set(m for r in results for m in r["loaded"]))
+    print(f"import gpt_neox: best {best:.3f}s over {args.repeats} runs (budget {args.budget:.3f}s)")
+
+    failed = False
+    if best > args.budget:
+        print(f"FAIL: cold import exceeded budget by {best - args.budget:.3f}s")
+        failed = True
+    if loaded:
+        print(f"FAIL: heavy modules imported eagerly: {', '.join(loaded)}")
+        failed = True
+    sys.exit(1 if failed else 0)
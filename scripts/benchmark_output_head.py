@@ -0,0 +1,111 @@
+import argparse
+import math
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+
+from gpt_neox.autoregressive_wrapper import AutoregressiveWrapper
+from gpt_neox.datasets import TextSamplerDataset
+from gpt_neox.evaluation import Evaluator
+from gpt_neox.gpt_neox import GPTNeoX
+from gpt_neox.output_head import init_output_head
+
+"""
+Compares output heads (see gpt_neox.output_head) with the full softmax on a large vocabulary: the same model, with
+each head, trains from the same initialization on the same batches, and the training throughput and the validation
+perplexity - always over the full vocabulary - are reported.
+
+Tokens come from --tokens (a 1d tensor of token ids saved with torch.save, e.g. a tokenized corpus) or are generated:
+a Zipfian unigram distribution over --vocab_size shuffled token ids, where every other token is its predecessor's
+fixed successor half of the time, so there's something to learn.
+
+Usage: python scripts/benchmark_output_head.py --vocab_size 50257 --steps 300 --heads full adaptive sampled
+"""
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='output head throughput and perplexity comparison')
+    parser.add_argument('--heads', type=str, nargs='+', default=["full", "adaptive", "sampled"])
+    parser.add_argument('--tokens', type=str, default=None, help='torch.save-d 1d tensor of token ids')
+    parser.add_argument('--vocab_size', type=int, default=50257)
+    parser.add_argument('--n_tokens', type=int, default=2000000, help='generated tokens')
+    parser.add_argument('--dim', type=int, default=256)
+    parser.add_argument('--depth', type=int, default=2)
+    parser.add_argument('--seq_len', type=int, default=128)
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--steps', type=int, default=300)
+    parser.add_argument('--learning_rate', type=float, default=1e-3)
+    parser.add_argument('--eval_batches', type=int, default=16)
+    parser.add_argument('--cutoffs', type=str, default="2000,10000", help='adaptive head cluster cutoffs')
+    parser.add_argument('--num_samples', type=int, default=1024, help='sampled head negatives')
+    parser.add_argument('--seed', type=int, default=1)
+    return parser.parse_args()
+
+
+def generated_tokens(vocab_size, n_tokens, seed):
+    generator = torch.Generator().manual_seed(seed)
+    zipf = 1 / torch.arange(1, vocab_size + 1, dtype=torch.float64) ** 1.1
+    token_of_rank = torch.randperm(vocab_size, generator=generator)
+    successor = token_of_rank[torch.multinomial(zipf, vocab_size, replacement=True, generator=generator)]
+    tokens = token_of_rank[torch.multinomial(zipf, n_tokens, replacement=True, generator=generator)]
+    # every other token follows the one before it half of the time
+    odd = torch.arange(1, n_tokens, 2)
+    odd = odd[torch.rand(len(odd), generator=generator) < 0.5]
+    tokens[odd] = successor[tokens[odd - 1]]
+    return tokens
+
+
+def head_config(name, args):
+    if name == "full":
+        return None
+    if name == "adaptive":
+        return {"type": "adaptive", "cutoffs": [int(c) for c in args.cutoffs.split(",")]}
+    return {"type": "sampled", "num_samples": args.num_samples}
+
+
+if __name__ == '__main__':
+    args = get_args()
+    tokens = torch.load(args.tokens) if args.tokens is not None else \
+        generated_tokens(args.vocab_size, args.n_tokens, args.seed)
+    vocab_size = max(args.vocab_size, int(tokens.max()) + 1)
+    n_train = len(tokens) * 9 // 10
+    train_dataset = TextSamplerDataset(tokens[:n_train], args.seq_len)
+    evaluator = Evaluator(TextSamplerDataset(tokens[n_train:], args.seq_len, strided=True),
+                          batch_size=args.batch_size, max_batches=args.eval_batches, ignore_index=-100)
+
+    print(f"{'head':>10s} {'train tok/s':>12s} {'speedup':>8s} {'val loss':>9s} {'perplexity':>11s} "
+          f"{'head params':>12s}")
+    baseline = None
+    for name in args.heads:
+        torch.manual_seed(args.seed)
+        config = head_config(name, args)
+        model = AutoregressiveWrapper(GPTNeoX(num_tokens=vocab_size, dim=args.dim, seq_len=args.seq_len,
+                                              depth=args.depth, heads=4, dim_head=args.dim // 4,
+                                              gradient_checkpointing=False, output_head=config),
+                                      ignore_index=-100)
+        init_output_head(model.net, {"output_head": config}, train_dataset)
+        optimizer = torch.optim.Adam(model.parameters(), lr=args.learning_rate)
+
+        generator = torch.Generator().manual_seed(args.seed)
+        elapsed = 0.
+        for step in range(args.steps):
+            batch = train_dataset.windows[torch.randint(0, len(train_dataset.windows), (args.batch_size,),
+                                                        generator=generator)].long()
+            start = time.perf_counter()
+            loss = model(batch)
+            loss.backward()
+            optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+            if step > 0:  # the first step warms up
+                elapsed += time.perf_counter() - start
+
+        tokens_per_sec = (args.steps - 1) * args.batch_size * args.seq_len / elapsed
+        baseline = baseline or tokens_per_sec
+        metrics = evaluator.evaluate(model)
+        head_params = sum(p.numel() for p in model.net.to_logits.parameters())
+        print(f"{name:>10s} {tokens_per_sec:12.1f} {tokens_per_sec / baseline:8.2f} {metrics['loss']:9.4f} "
+              f"{math.exp(metrics['loss']):11.1f} {head_params:12d}", flush=True)
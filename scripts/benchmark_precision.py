@@ -0,0 +1,116 @@
+import argparse
+import copy
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+
+from gpt_neox.checkpoint import get_dtype
+from gpt_neox.data_utils import read_enwik8_data
+from gpt_neox.datasets import TextSamplerDataset
+from gpt_neox.evaluation import Evaluator
+from gpt_neox.inference import build_model
+from gpt_neox.utils import get_params
+
+"""
+Compares fp32 training with mixed precision ("precision": "bfloat16" in a model config, see GPTNeoX.autocast) on
+enwik8:
+
+- convergence: two copies of the same initial model train on the same batches, one in fp32 and one under autocast,
+  and their validation losses must stay within --tolerance (relative) of each other
+- throughput: tokens/s of training steps and of inference forward passes, in each precision
+
+bf16 autocast only pays off on CPUs with native bf16 matmuls (e.g. AVX512-BF16 or AMX) - elsewhere it's emulated and
+slower than fp32, though it still converges.
+
+Usage: python scripts/benchmark_precision.py --model base_model --steps 500 --precision bfloat16
+"""
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='mixed precision convergence and throughput comparison')
+    parser.add_argument('--model', type=str, default="base_model", help='enwik8 model config name or path')
+    parser.add_argument('--precision', type=str, default="bfloat16", help='autocast dtype compared with fp32')
+    parser.add_argument('--steps', type=int, default=300, help='training steps of the convergence check')
+    parser.add_argument('--eval_every', type=int, default=100)
+    parser.add_argument('--eval_batches', type=int, default=8)
+    parser.add_argument('--batch_size', type=int, default=None, help='default: the config batch_size')
+    parser.add_argument('--tolerance', type=float, default=0.02, help='allowed relative validation loss gap')
+    parser.add_argument('--throughput_steps', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=1)
+    return parser.parse_args()
+
+
+def native_bf16():
+    try:
+        return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def train_step(model, optimizer, batch):
+    loss = model(batch)
+    loss.backward()
+    optimizer.step()
+    optimizer.zero_grad(set_to_none=True)
+    return loss.item()
+
+
+def throughput(model, batches, train):
+    # tokens/s over the batches, after one untimed warmup batch
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4) if train else None
+    start = None
+    for i, batch in enumerate(batches):
+        if i == 1:
+            start = time.perf_counter()
+        if train:
+            train_step(model, optimizer, batch)
+        else:
+            with torch.no_grad():
+                model.net(batch[:, :-1])
+    return sum(b[:, :-1].numel() for b in batches[1:]) / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    args = get_args()
+    params = get_params(args.model)
+    assert params["dataset"]["name"] == "enwik8", "the comparison runs on enwik8 configs"
+    batch_size = args.batch_size or params["batch_size"]
+    data_train, data_val = read_enwik8_data(params["dataset"]["path"])
+    train_dataset = TextSamplerDataset(data_train, params["seq_len"])
+    evaluator = Evaluator(TextSamplerDataset(data_val, params["seq_len"], strided=True), batch_size=batch_size,
+                          max_batches=args.eval_batches)
+
+    torch.manual_seed(args.seed)
+    models = {"fp32": build_model(params)}
+    models[args.precision] = copy.deepcopy(models["fp32"])
+    models[args.precision].net.autocast_dtype = get_dtype(args.precision)
+    optimizers = {name: torch.optim.Adam(model.parameters(), lr=params["learning_rate"])
+                  for name, model in models.items()}
+    print(f"native bf16 matmuls: {native_bf16()}, threads: {torch.get_num_threads()}")
+
+    print(f"{'step':>6s} " + " ".join(f"{name + ' train':>16s} {name + ' val':>16s}" for name in models))
+    generator = torch.Generator().manual_seed(args.seed)
+    losses = {}
+    for step in range(1, args.steps + 1):
+        # both models see the same batch
+        batch = train_dataset.windows[torch.randint(0, len(train_dataset.windows), (batch_size,),
+                                                    generator=generator)].long()
+        losses = {name: train_step(model, optimizers[name], batch) for name, model in models.items()}
+        if step % args.eval_every == 0 or step == args.steps:
+            val = {name: evaluator.evaluate(model)["loss"] for name, model in models.items()}
+            print(f"{step:6d} " + " ".join(f"{losses[name]:16.4f} {val[name]:16.4f}" for name in models), flush=True)
+
+    gap = abs(val[args.precision] - val["fp32"]) / val["fp32"]
+    converged = gap <= args.tolerance
+    print(f"validation loss gap: {gap:.2%} ({'within' if converged else 'over'} the {args.tolerance:.0%} tolerance)")
+
+    batches = [train_dataset[list(range(batch_size))] for _ in range(args.throughput_steps + 1)]
+    print(f"{'precision':>10s} {'train tok/s':>12s} {'infer tok/s':>12s}")
+    for name, model in models.items():
+        print(f"{name:>10s} {throughput(model, batches, train=True):12.1f} "
+              f"{throughput(model, batches, train=False):12.1f}", flush=True)
+    sys.exit(0 if converged else 1)
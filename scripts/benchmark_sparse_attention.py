@@ -0,0 +1,74 @@
+import argparse
+import json
+import math
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+
+from gpt_neox.gpt_neox import Attention
+from gpt_neox.sparse_attention import BlockSparseAttention
+
+"""
+Times the forward and backward of one attention layer, dense and with block sparse patterns (see
+gpt_neox.sparse_attention), over growing sequence lengths, and counts the attention scores each holds - the memory
+that grows with seq_len ** 2 for dense attention, and with the pattern for sparse attention.
+
+Patterns are given as json, as in a model config's sparse_attn. Dense attention is skipped above --max_dense_len.
+
+Usage: python scripts/benchmark_sparse_attention.py --seq_lens 1024,4096,16384 --patterns '"local"' \
+    '{"type": "fixed", "block": 64}'
+"""
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='dense vs block sparse attention benchmark')
+    parser.add_argument('--seq_lens', type=str, default="1024,2048,4096,8192")
+    parser.add_argument('--patterns', type=str, nargs='+', default=['"local"', '"fixed"'], help='json patterns')
+    parser.add_argument('--dim', type=int, default=512)
+    parser.add_argument('--heads', type=int, default=8)
+    parser.add_argument('--dim_head', type=int, default=64)
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--max_dense_len', type=int, default=8192)
+    parser.add_argument('--device', type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    return parser.parse_args()
+
+
+def score_elements(attn, seq_len, heads):
+    # attention scores held per sequence
+    if not isinstance(attn.attn_fn, BlockSparseAttention):
+        return heads * seq_len ** 2
+    fn = attn.attn_fn
+    n_blocks = math.ceil(seq_len / fn.block)
+    return heads * n_blocks * fn.block * fn.layout(n_blocks, "cpu").shape[1] * fn.block
+
+
+def seconds(attn, x, repeats):
+    # best of repeats, of a forward and backward
+    best = float("inf")
+    for _ in range(repeats + 1):
+        start = time.perf_counter()
+        attn(x).sum().backward()
+        if x.device.type == "cuda":
+            torch.cuda.synchronize()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == '__main__':
+    args = get_args()
+    print(f"{'pattern':>48s} {'seq_len':>8s} {'fwd+bwd s':>10s} {'scores':>14s} {'vs dense':>9s}")
+    for seq_len in [int(n) for n in args.seq_lens.split(",")]:
+        x = torch.randn(args.batch_size, seq_len, args.dim, device=args.device, requires_grad=True)
+        patterns = ([False] if seq_len <= args.max_dense_len else []) + [json.loads(p) for p in args.patterns]
+        for pattern in patterns:
+            attn = Attention(args.dim, args.heads, seq_len, dim_head=args.dim_head, sparse_attn=pattern)
+            attn = attn.to(args.device)
+            scores = score_elements(attn, seq_len, args.heads)
+            name = json.dumps(pattern) if pattern else "dense"
+            print(f"{name:>48s} {seq_len:8d} {seconds(attn, x, args.repeats):10.4f} {scores:14d} "
+                  f"{scores / (args.heads * seq_len ** 2):9.3f}", flush=True)
@@ -0,0 +1,88 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+"""
+Measures model startup: the time and peak memory to get from a checkpoint on disk to a model ready for inference, for
+
+    torch       - build and initialize the model, then torch.load a state dict and copy it in
+    tensors     - build the model on the meta device and memory map a tensor file (see gpt_neox.checkpoint)
+
+Each method runs in a fresh interpreter, so peak RSS is its own. Without --checkpoint, a randomly initialized model
+of the given config is saved in both formats first. --output_head overrides the config's output head (see
+gpt_neox.output_head), so the heads' buffers go through both load paths too.
+
+Usage: python scripts/benchmark_startup.py --model gpt3_small [--checkpoint model.pt] [--dtype bfloat16] \
+    [--output_head '"sampled"']
+"""
+
+_PROBE = """
+import json, resource, sys, time
+sys.path.insert(0, {repo_root!r})
+import torch
+from gpt_neox.checkpoint import get_dtype
+from gpt_neox.inference import load_model
+from gpt_neox.utils import get_params
+
+params = get_params({model!r})
+if {output_head!r} is not None:
+    params["output_head"] = json.loads({output_head!r})
+t = time.perf_counter()
+model, _ = load_model(params, {checkpoint!r}, dtype=get_dtype({dtype!r}))
+elapsed = time.perf_counter() - t
+with torch.no_grad():
+    model.net(torch.zeros(1, 8, dtype=torch.long))  # touch every weight once
+first_forward = time.perf_counter() - t
+print(json.dumps({{"seconds": elapsed, "with_first_forward": first_forward,
+                  "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}}))
+"""
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='model startup time benchmark')
+    parser.add_argument('--model', type=str, default="base_model", help='model config name or path')
+    parser.add_argument('--checkpoint', type=str, default=None, help='torch checkpoint to benchmark')
+    parser.add_argument('--dtype', type=str, default=None, help='cast floating point weights while loading')
+    parser.add_argument('--output_head', type=str, default=None, help='json output head, overriding the config')
+    parser.add_argument('--repeats', type=int, default=3)
+    return parser.parse_args()
+
+
+def run(repo_root, model, checkpoint, dtype, output_head):
+    probe = _PROBE.format(repo_root=repo_root, model=model, checkpoint=checkpoint, dtype=dtype,
+                          output_head=output_head)
+    out = subprocess.run([sys.executable, "-c", probe], cwd=repo_root, check=True, capture_output=True, text=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    args = get_args()
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, repo_root)
+    import torch
+    from gpt_neox.checkpoint import save_tensors
+    from gpt_neox.inference import build_model, read_checkpoint, TextCodec
+    from gpt_neox.utils import get_params
+
+    model_path = os.path.abspath(args.model) if args.model.endswith(".json") else args.model
+    with tempfile.TemporaryDirectory() as tmp:
+        checkpoint = args.checkpoint
+        if checkpoint is None:
+            params = get_params(model_path)
+            if args.output_head is not None:
+                params["output_head"] = json.loads(args.output_head)
+            vocab_size = params["vocab_size"] if params.get("vocab_size") is not None else \
+                TextCodec(params.get("tokenizer")).vocab_size
+            checkpoint = os.path.join(tmp, "model.pt")
+            torch.save(build_model(params, vocab_size).state_dict(), checkpoint)
+        tensor_file = os.path.join(tmp, "model.tensors")
+        save_tensors(read_checkpoint(checkpoint), tensor_file)
+
+        for name, path in [("torch", os.path.abspath(checkpoint)), ("tensors", tensor_file)]:
+            results = [run(repo_root, model_path, path, args.dtype, args.output_head) for _ in range(args.repeats)]
+            best = min(results, key=lambda r: r["seconds"])
+            print(f"{name:8s} load {best['seconds']:.3f}s, with first forward {best['with_first_forward']:.3f}s, "
+                  f"peak RSS {best['peak_rss_mb']:.0f}MB (best of {args.repeats})")
@@ -0,0 +1,168 @@
+import argparse
+import hashlib
+import os
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gpt_neox.fetch import ChecksumError, fetch
+
+"""
+Checks gpt_neox.fetch against a local HTTP server: concurrent range downloads, single stream downloads from servers
+without range support, resuming interrupted downloads (both ways), complete and stale partial downloads, mirrors,
+and checksum failures. The server can cut every response off half way, to interrupt a download.
+
+Usage: python scripts/check_fetch.py --size_mb 8
+"""
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='checks the downloader against a local http server')
+    parser.add_argument('--size_mb', type=int, default=8, help='size of the served file')
+    parser.add_argument('--num_connections', type=int, default=4)
+    return parser.parse_args()
+
+
+class Handler(BaseHTTPRequestHandler):
+    data = b""
+    accept_ranges = True
+    truncate = False  # send only the first half of every response body, then drop the connection
+    lock = threading.Lock()
+    requests = 0
+    bytes_served = 0
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self._respond(head=True)
+
+    def do_GET(self):
+        self._respond()
+
+    def _respond(self, head=False):
+        cls = type(self)
+        start, end = 0, len(cls.data)
+        requested = self.headers.get("Range")
+        if requested is not None and cls.accept_ranges:
+            first, last = requested[len("bytes="):].split("-")
+            start, end = int(first), (int(last) + 1 if last else len(cls.data))
+            if start >= len(cls.data):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(cls.data)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end - 1}/{len(cls.data)}")
+        else:
+            self.send_response(200)
+        if cls.accept_ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start))
+        self.end_headers()
+        if head:
+            return
+        body = cls.data[start:end]
+        if cls.truncate:
+            body = body[:len(body) // 2]
+            self.close_connection = True
+        self.wfile.write(body)
+        with cls.lock:
+            cls.requests += 1
+            cls.bytes_served += len(body)
+
+
+def serve(accept_ranges=True, truncate=False):
+    Handler.accept_ranges, Handler.truncate = accept_ranges, truncate
+    Handler.requests, Handler.bytes_served = 0, 0
+
+
+def check(name, ok, detail=""):
+    print(f"{'ok' if ok else 'FAILED':>6s}  {name}{f' ({detail})' if detail else ''}", flush=True)
+    return ok
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    Handler.data = os.urandom(args.size_mb << 20)
+    checksum = "sha256:" + hashlib.sha256(Handler.data).hexdigest()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/data.bin"
+    results = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+        serve()
+        dest = os.path.join(tmp, "parallel", "data.bin")
+        fetch(url, dest, checksum=checksum, num_connections=args.num_connections)
+        results.append(check("concurrent range download", read(dest) == Handler.data,
+                             f"{Handler.requests} range requests"))
+
+        serve(accept_ranges=False)
+        dest = os.path.join(tmp, "stream", "data.bin")
+        fetch(url, dest, checksum=checksum, num_connections=args.num_connections)
+        results.append(check("single stream without range support", read(dest) == Handler.data))
+
+        for name, num_connections in [("range", args.num_connections), ("single stream", 1)]:
+            dest = os.path.join(tmp, f"resume_{num_connections}", "data.bin")
+            serve(truncate=True)
+            try:
+                fetch(url, dest, num_connections=num_connections, retries=0)
+                interrupted = False
+            except Exception:
+                interrupted = not os.path.exists(dest) and os.path.isfile(dest + ".part")
+            first = Handler.bytes_served
+            serve()
+            fetch(url, dest, checksum=checksum, num_connections=num_connections, retries=0)
+            results.append(check(f"resumed {name} download",
+                                 interrupted and read(dest) == Handler.data and
+                                 first + Handler.bytes_served == len(Handler.data),
+                                 f"{first} bytes before the interruption, {Handler.bytes_served} after"))
+
+        for name, extra in [("complete", 0), ("stale, oversized", 1000)]:
+            dest = os.path.join(tmp, f"partial_{extra}", "data.bin")
+            os.makedirs(os.path.dirname(dest))
+            with open(dest + ".part", "wb") as f:
+                f.write(Handler.data + os.urandom(extra))
+            serve()
+            fetch(url, dest, num_connections=1, retries=0)
+            results.append(check(f"{name} partial download", read(dest) == Handler.data,
+                                 f"{Handler.bytes_served} bytes downloaded"))
+
+        serve(truncate=True)
+        dest = os.path.join(tmp, "retried", "data.bin")
+        retried = threading.Timer(0.5, serve)  # the server recovers while fetch backs off
+        retried.start()
+        fetch(url, dest, checksum=checksum, num_connections=args.num_connections, retries=2)
+        results.append(check("interrupted ranges retried", read(dest) == Handler.data))
+
+        mirror = os.path.join(tmp, "mirror")
+        os.makedirs(mirror)
+        with open(os.path.join(mirror, "data.bin"), "wb") as f:
+            f.write(Handler.data)
+        serve()
+        dest = os.path.join(tmp, "mirrored", "data.bin")
+        fetch(url, dest, checksum=checksum, mirrors=[os.path.join(tmp, "missing"), mirror])
+        results.append(check("local mirror", read(dest) == Handler.data and Handler.requests == 0))
+
+        serve()
+        dest = os.path.join(tmp, "corrupt", "data.bin")
+        try:
+            fetch(url, dest, checksum="sha256:" + "0" * 64, num_connections=args.num_connections, retries=0)
+            failed = False
+        except ChecksumError:
+            failed = True
+        results.append(check("checksum mismatch", failed and not os.path.exists(dest) and
+                             not os.path.exists(dest + ".part")))
+
+    server.shutdown()
+    sys.exit(0 if all(results) else 1)
@@ -0,0 +1,77 @@
+import argparse
+import glob
+import os
+import re
+import sys
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gpt_neox.checkpoint import get_dtype, save_tensors
+from gpt_neox.inference import read_checkpoint
+
+"""
+Converts a model checkpoint to the memory mappable tensor file format of gpt_neox.checkpoint, which serve.py and
+gpt_neox.inference.load_model load without initializing the model first.
+
+The input is either a torch checkpoint file (a state dict of the AutoregressiveWrapper or GPTNeoX, or a DeepSpeed
+model states file), or a DeepSpeed checkpoint directory, in which case the tag in its "latest" file (or --tag) is
+converted. Pipeline parallel (GPTNeoX_Pipe) checkpoints, saved one layer_XX-model_states.pt file per layer spec, are
+converted to the GPTNeoX layout, so they can be loaded - or streamed by gpt_neox.offload - like any other.
+
+Usage: python scripts/convert_checkpoint.py checkpoints/ model.tensors --dtype bfloat16
+"""
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='convert torch / DeepSpeed checkpoints to tensor files')
+    parser.add_argument('input', type=str, help='checkpoint file, or DeepSpeed checkpoint directory')
+    parser.add_argument('output', type=str, help='tensor file to write')
+    parser.add_argument('--tag', type=str, default=None, help='DeepSpeed checkpoint tag (default: the latest one)')
+    parser.add_argument('--dtype', type=str, default=None, help='cast floating point weights, e.g. to bfloat16')
+    return parser.parse_args()
+
+
+def deepspeed_model_file(checkpoint_dir, tag=None):
+    # model weights of a DeepSpeed checkpoint - the tag directory itself for pipeline parallel ones
+    if tag is None:
+        with open(os.path.join(checkpoint_dir, "latest")) as f:
+            tag = f.read().strip()
+    path = os.path.join(checkpoint_dir, tag, "mp_rank_00_model_states.pt")
+    if not os.path.isfile(path) and glob.glob(os.path.join(checkpoint_dir, tag, "layer_*-model_states.pt")):
+        return os.path.join(checkpoint_dir, tag)
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f"{path} not found")
+    return path
+
+
+def read_pipeline_checkpoint(tag_dir):
+    """
+    reads the per layer files of a GPTNeoX_Pipe checkpoint into an AutoregressiveWrapper state dict. The layer specs
+    are the EmbedBlock, the TransformerBlocks, the final norm and the classifier, in that order
+    """
+    layers = {}
+    for path in glob.glob(os.path.join(tag_dir, "layer_*-model_states.pt")):
+        layers[int(re.search(r"layer_(\d+)-", os.path.basename(path)).group(1))] = torch.load(path, map_location="cpu")
+    indices = sorted(layers)
+    embed, blocks, norm, to_logits = indices[0], indices[1:-2], indices[-2], indices[-1]
+
+    state_dict = {f"net.{k}": v for k, v in layers[embed].items()}
+    for i, index in enumerate(blocks):
+        for k, v in layers[index].items():
+            k = k.replace("attn_layer.", "0.", 1) if k.startswith("attn_layer.") else k.replace("ff_layer.", "1.", 1)
+            state_dict[f"net.layers.{i}.{k}"] = v
+    state_dict.update({f"net.norm.{k}": v for k, v in layers[norm].items()})
+    state_dict.update({f"net.to_logits.{k}": v for k, v in layers[to_logits].items()})
+    return state_dict
+
+
+if __name__ == '__main__':
+    args = get_args()
+    path = deepspeed_model_file(args.input, args.tag) if os.path.isdir(args.input) else args.input
+    state_dict = read_pipeline_checkpoint(path) if os.path.isdir(path) else read_checkpoint(path)
+    save_tensors(state_dict, args.output, dtype=get_dtype(args.dtype))
+    n_params = sum(t.numel() for t in state_dict.values())
+    print(f"Converted {path} ({n_params / 1e6:.1f}M parameters) -> {args.output} "
+          f"({os.path.getsize(args.output) / 1e6:.1f}MB)")
@@ -0,0 +1,98 @@
+import argparse
+import math
+import os
+import resource
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+
+from gpt_neox.checkpoint import get_dtype, save_tensors
+from gpt_neox.inference import build_model, load_model, TextCodec
+from gpt_neox.offload import LayerStreamingModel
+from gpt_neox.utils import get_params
+
+"""
+Evaluates a model with layer-streaming inference (see gpt_neox.offload), keeping only --resident_blocks transformer
+blocks in memory, and reports the loss, bytes read, tokens/sec and peak RSS. Every pass runs --batch_size sequences,
+so the weights are read once per batch.
+
+Sequences are taken from --text (encoded with the config's tokenizer), or are random tokens. Without --checkpoint, a
+randomly initialized model of the config is saved to a temporary tensor file first. With --check, the first batch is
+also run through the fully loaded model and the losses compared.
+
+Usage: python scripts/eval_offloaded.py --model gpt3_small --checkpoint model.tensors --batch_size 64 --text val.txt
+"""
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='layer-streaming offloaded evaluation')
+    parser.add_argument('--model', type=str, default="base_model", help='model config name or path')
+    parser.add_argument('--checkpoint', type=str, default=None, help='tensor file (see scripts/convert_checkpoint.py)')
+    parser.add_argument('--resident_blocks', type=int, default=2, help='blocks held in memory, including prefetched')
+    parser.add_argument('--batch_size', type=int, default=32, help='sequences per pass over the weights')
+    parser.add_argument('--micro_batch_size', type=int, default=8, help='sequences per block forward')
+    parser.add_argument('--num_batches', type=int, default=4)
+    parser.add_argument('--seq_len', type=int, default=None, help='default: the model seq_len')
+    parser.add_argument('--text', type=str, default=None, help='text file to evaluate on (default: random tokens)')
+    parser.add_argument('--dtype', type=str, default=None, help='compute dtype, e.g. bfloat16')
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+    parser.add_argument('--check', action='store_true', help='compare the first batch with the fully loaded model')
+    return parser.parse_args()
+
+
+def get_batches(args, codec, vocab_size, seq_len):
+    n = args.batch_size * args.num_batches
+    if args.text is not None:
+        with open(args.text, encoding="utf-8") as f:
+            tokens = torch.tensor(codec.encode(f.read()), dtype=torch.long)
+        tokens = tokens[:len(tokens) // (seq_len + 1) * (seq_len + 1)].view(-1, seq_len + 1)
+        assert len(tokens) >= n, f"{args.text} has only {len(tokens)} sequences of {seq_len + 1} tokens"
+        tokens = tokens[:n]
+    else:
+        tokens = torch.randint(0, vocab_size, (n, seq_len + 1), generator=torch.Generator().manual_seed(1))
+    return tokens.split(args.batch_size)
+
+
+if __name__ == '__main__':
+    args = get_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    params = get_params(args.model)
+    codec = TextCodec(params.get("tokenizer"))
+    vocab_size = params["vocab_size"] if params.get("vocab_size") is not None else codec.vocab_size
+    seq_len = (args.seq_len or params["seq_len"]) - 1
+
+    with tempfile.TemporaryDirectory() as tmp:
+        checkpoint = args.checkpoint
+        if checkpoint is None:
+            checkpoint = os.path.join(tmp, "model.tensors")
+            save_tensors(build_model(params, vocab_size).state_dict(), checkpoint)
+
+        model = LayerStreamingModel(params, checkpoint, resident_blocks=args.resident_blocks,
+                                    micro_batch_size=args.micro_batch_size, dtype=get_dtype(args.dtype),
+                                    vocab_size=vocab_size)
+        total_nll, total_tokens = 0., 0
+        for i, batch in enumerate(get_batches(args, codec, vocab_size, seq_len)):
+            nll = model.nll(batch)
+            total_nll += nll.sum().item()
+            total_tokens += batch[:, 1:].numel()
+            if i == 0 and args.check:
+                full, _ = load_model(params, checkpoint, dtype=get_dtype(args.dtype))
+                with torch.no_grad():
+                    logits = full.net(batch[:, :-1]).float()
+                expected = torch.nn.functional.cross_entropy(logits.transpose(1, 2), batch[:, 1:], reduction="none")
+                print(f"max difference from the fully loaded model: "
+                      f"{(nll - expected.sum(dim=-1)).abs().max().item() / batch.shape[1]:.2e} per token")
+                del full
+        model.close()
+
+    metrics = model.metrics()
+    loss = total_nll / total_tokens
+    print(f"loss {loss:.4f}, perplexity {math.exp(min(loss, 50)):.2f} over {total_tokens} tokens")
+    print(f"{metrics['tokens_per_sec']:.1f} tokens/s, {metrics['bytes_read'] / 1e6:.1f}MB read "
+          f"({metrics['read_mb_per_sec']:.1f}MB/s, {metrics['io_wait_seconds']:.2f}s waiting on reads), "
+          f"{metrics['resident_block_mb']:.1f}MB of blocks resident, "
+          f"peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f}MB")
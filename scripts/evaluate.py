@@ -0,0 +1,134 @@
+import argparse
+import glob
+import json
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+import torch.distributed as dist
+
+from gpt_neox.async_checkpoint import AsyncCheckpointer
+from gpt_neox.checkpoint import get_dtype
+from gpt_neox.evaluation import Evaluator, token_byte_lengths
+from gpt_neox.inference import build_model, read_checkpoint, TextCodec
+from gpt_neox.utils import get_params
+
+"""
+Evaluates saved checkpoints out of process, so evaluation never stalls training: a full pass over the eval data of a
+model config (see gpt_neox.evaluation), reporting loss, perplexity and bits per byte.
+
+--checkpoint is a model checkpoint file (anything gpt_neox.inference.read_checkpoint accepts) or the checkpoint_dir of
+a training run, whose newest complete checkpoint is evaluated - or, with --watch, every new one as training writes
+them. Results are printed and, with --output, appended to a JSON lines file.
+
+Runs on one process, or sharded across several with torch.distributed.launch / torchrun (gloo on CPU, nccl on GPU).
+
+Usage: python scripts/evaluate.py --model gpt3_small --checkpoint checkpoints/gpt3_small --watch --output eval.jsonl
+"""
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='GPTNeox checkpoint evaluation')
+    parser.add_argument('--model', type=str, default="base_model", help='model config name or path')
+    parser.add_argument('--checkpoint', type=str, required=True, help='checkpoint file, or training checkpoint_dir')
+    parser.add_argument('--watch', action='store_true', help='keep evaluating new checkpoints in checkpoint_dir')
+    parser.add_argument('--poll', type=float, default=60., help='seconds between looks for new checkpoints')
+    parser.add_argument('--batch_size', type=int, default=None, help='default: the config eval_batch_size')
+    parser.add_argument('--max_batches', type=int, default=None, help='batches per rank and dataset')
+    parser.add_argument('--dtype', type=str, default=None, help='cast floating point weights, e.g. to bfloat16')
+    parser.add_argument('--output', type=str, default=None, help='JSON lines file to append results to')
+    parser.add_argument('--local_rank', type=int, default=-1, help='local rank passed from distributed launcher')
+    return parser.parse_args()
+
+
+def get_eval_datasets(params, tokenizer):
+    """the eval datasets of a model config, as train.py and train_enwik8.py build them - by name for mixtures"""
+    from gpt_neox.datasets import GPT2Dataset, StreamingTextDataset, TextSamplerDataset
+    dset_params = params["dataset"]
+    if isinstance(dset_params, list):
+        return {d["name"]: GPT2Dataset(glob_pattern=d["eval_path"], seq_len=params["seq_len"], train=False, **d)
+                for d in dset_params}
+    if dset_params["name"] == "enwik8":
+        from gpt_neox.data_utils import read_enwik8_data
+        _, data_val = read_enwik8_data(dset_params["path"])
+        return TextSamplerDataset(data_val, params["seq_len"], strided=True)
+    if dset_params.get("pretokenized", True):
+        return GPT2Dataset(glob_pattern=dset_params["eval_path"], seq_len=params["seq_len"], train=False,
+                           **dset_params)
+    return StreamingTextDataset(glob_pattern=dset_params["eval_path"], seq_len=params["seq_len"], tokenizer=tokenizer,
+                                **dset_params)
+
+
+def checkpoint_steps(checkpoint_dir):
+    # (step, model file) of the complete checkpoints of a training run, oldest first
+    files = glob.glob(os.path.join(checkpoint_dir, "step_*", "rank_0-of-*.pt"))
+    if not files:
+        return []
+    world_size = int(re.search(r"rank_0-of-(\d+)\.pt$", files[0]).group(1))
+    checkpointer = AsyncCheckpointer(checkpoint_dir, world_size=world_size)
+    return [(step, checkpointer.path(step, 0)) for step in checkpointer.steps()]
+
+
+def read_model_state(path):
+    # training checkpoints hold the whole training state, of which the model is the engine's module
+    if re.fullmatch(r"rank_\d+-of-\d+\.pt", os.path.basename(path)):
+        return torch.load(path, map_location="cpu")["engine"]["module"]
+    return read_checkpoint(path)
+
+
+if __name__ == '__main__':
+    args = get_args()
+    params = get_params(args.model)
+    distributed = int(os.environ.get("WORLD_SIZE", 1)) > 1
+    device = "cpu"
+    if distributed:
+        if torch.cuda.is_available():
+            device = f"cuda:{int(os.environ.get('LOCAL_RANK', 0))}"
+            torch.cuda.set_device(device)
+        dist.init_process_group(backend="nccl" if torch.cuda.is_available() else "gloo")
+    elif torch.cuda.is_available():
+        device = "cuda"
+    rank, world_size = (dist.get_rank(), dist.get_world_size()) if distributed else (0, 1)
+
+    codec = TextCodec(params.get("tokenizer"))
+    vocab_size = params["vocab_size"] if params.get("vocab_size") is not None else codec.vocab_size
+    model = build_model(params, vocab_size)
+    dtype = get_dtype(args.dtype)
+    evaluator = Evaluator(get_eval_datasets(params, codec.tokenizer),
+                          batch_size=args.batch_size or params.get("eval_batch_size") or params["batch_size"],
+                          rank=rank, world_size=world_size,
+                          byte_lengths=token_byte_lengths(codec.tokenizer, vocab_size),
+                          max_batches=args.max_batches, ignore_index=model.ignore_index)
+
+    done = set()
+    while True:
+        if os.path.isdir(args.checkpoint):
+            todo = [(step, path) for step, path in checkpoint_steps(args.checkpoint) if step not in done]
+            todo = todo if args.watch else todo[-1:]
+        else:
+            todo = [(None, args.checkpoint)]
+        if distributed:
+            # every rank has to evaluate the same checkpoints, in the same order
+            todo = [todo]
+            dist.broadcast_object_list(todo, src=0)
+            todo = todo[0]
+
+        for step, path in todo:
+            model.load_state_dict(read_model_state(path))
+            model = model.to(device=device, dtype=dtype) if dtype is not None else model.to(device)
+            metrics = evaluator.evaluate(model)
+            done.add(step)
+            if rank == 0:
+                result = {"checkpoint": path, "step": step, **metrics}
+                print(json.dumps(result), flush=True)
+                if args.output is not None:
+                    with open(args.output, "a") as f:
+                        f.write(json.dumps(result) + "\n")
+
+        if not (args.watch and os.path.isdir(args.checkpoint)):
+            break
+        time.sleep(args.poll)
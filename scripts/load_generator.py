@@ -0,0 +1,120 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+
+"""
+Load generator for serve.py. Keeps --concurrency clients sending /generate requests over keep-alive connections for
+--duration seconds, then reports request throughput, generated tokens/sec, latency percentiles, rejected requests
+and the server's own metrics. With --stream, responses are streamed and the time to first text is reported too.
+
+Usage: python scripts/load_generator.py --port 8000 --concurrency 32 --duration 30 --max_tokens 32
+"""
+
+PROMPTS = ["The quick brown fox", "Once upon a time", "In the beginning", "It was a dark and stormy night",
+           "To be or not to be", "The history of the"]
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='load generator for the GPTNeox inference server')
+    parser.add_argument('--host', type=str, default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--concurrency', type=int, default=16, help='number of concurrent clients')
+    parser.add_argument('--duration', type=float, default=30., help='seconds to send requests for')
+    parser.add_argument('--max_tokens', type=int, default=32)
+    parser.add_argument('--temperature', type=float, default=1.)
+    parser.add_argument('--stream', action='store_true', help='stream responses and measure time to first text')
+    parser.add_argument('--seed', type=int, default=1)
+    return parser.parse_args()
+
+
+async def http_request(reader, writer, method, path, body=None):
+    payload = json.dumps(body).encode() if body is not None else b""
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+                 f"Content-Length: {len(payload)}\r\n\r\n".encode() + payload)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        key, value = line.decode("latin-1").split(":", 1)
+        headers[key.strip().lower()] = value.strip()
+    if headers.get("transfer-encoding") == "chunked":
+        return status, _read_chunks(reader)
+    return status, json.loads(await reader.readexactly(int(headers["content-length"])))
+
+
+async def _read_chunks(reader):
+    # yields the JSON lines of a chunked response
+    while True:
+        size = int((await reader.readline()).strip(), 16)
+        if size == 0:
+            await reader.readline()
+            return
+        chunk = await reader.readexactly(size + 2)
+        yield json.loads(chunk[:-2])
+
+
+async def client(args, rng, deadline, results):
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    try:
+        while time.perf_counter() < deadline:
+            body = {"prompt": rng.choice(PROMPTS), "max_tokens": args.max_tokens, "temperature": args.temperature,
+                    "stream": args.stream}
+            t = time.perf_counter()
+            status, response = await http_request(reader, writer, "POST", "/generate", body)
+            if status == 200 and args.stream:
+                first = None
+                async for message in response:
+                    if first is None and "text" in message:
+                        first = time.perf_counter() - t
+                        results["first_text"].append(first)
+                    response = message  # the last message is the summary
+            if status == 200:
+                results["latencies"].append(time.perf_counter() - t)
+                results["tokens"] += len(response["tokens"])
+            elif status == 503:
+                results["rejected"] += 1
+                await asyncio.sleep(0.1)
+            else:
+                results["errors"] += 1
+    finally:
+        writer.close()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else float("nan")
+
+
+async def main(args):
+    rng = random.Random(args.seed)
+    results = {"latencies": [], "first_text": [], "tokens": 0, "rejected": 0, "errors": 0}
+    start = time.perf_counter()
+    deadline = start + args.duration
+    await asyncio.gather(*[client(args, random.Random(rng.random()), deadline, results)
+                           for _ in range(args.concurrency)])
+    elapsed = time.perf_counter() - start
+
+    latencies = results["latencies"]
+    print(f"{len(latencies)} requests in {elapsed:.1f}s ({len(latencies) / elapsed:.2f} req/s), "
+          f"{results['tokens'] / elapsed:.1f} generated tokens/s, {results['rejected']} rejected, "
+          f"{results['errors']} errors")
+    print(f"latency p50 {percentile(latencies, 50):.3f}s p90 {percentile(latencies, 90):.3f}s "
+          f"p99 {percentile(latencies, 99):.3f}s")
+    if args.stream:
+        first_text = results["first_text"]
+        print(f"time to first text p50 {percentile(first_text, 50):.3f}s p90 {percentile(first_text, 90):.3f}s "
+              f"p99 {percentile(first_text, 99):.3f}s")
+
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    _, metrics = await http_request(reader, writer, "GET", "/metrics")
+    writer.close()
+    print(f"server metrics: {json.dumps(metrics, indent=2)}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main(get_args()))
@@ -0,0 +1,356 @@
+import argparse
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from gpt_neox.checkpoint import get_dtype
+from gpt_neox.inference import FILTERS, TextDeltas, load_model, next_token_logits, sample
+from gpt_neox.utils import get_params
+
+"""
+Batched inference server. Loads a model and its tokenizer once, and serves
+
+    POST /generate  {"prompt": "...", "max_tokens": 64, "temperature": 1.0, "filter": "top_k", "filter_thres": 0.9,
+                     "stop": ["\n\n"], "max_time": 10.0, "stream": false}
+                    -> {"text": "...", "tokens": [...], "queue_time": ..., "time_to_first_token": ..., "latency": ...}
+    GET  /metrics   -> queue times, time to first token, batch sizes and tokens/sec
+
+With "stream": true, the response is sent with chunked transfer encoding as one JSON object per line: {"text": delta}
+for each piece of text as soon as it's decoded, then the same summary as above (without "text"). Generation stops at
+max_tokens, the eos token, the first stop string (which isn't returned) or after max_time seconds, and as soon as a
+streaming client disconnects its sequence leaves the batch.
+
+Requests are queued and decoded together: once a request arrives, the server waits up to --batch_window seconds for
+more before taking a step, and at every step newly queued requests join the batch (up to --max_batch_size) while
+finished ones leave it. Each request keeps its own sampling parameters. When more than --max_queue requests are
+waiting, new ones are rejected with a 503, so clients back off instead of piling up unbounded latency.
+
+Usage: python serve.py --model base_model --checkpoint model.pt --port 8000
+"""
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='GPTNeox batched inference server')
+    parser.add_argument('--model', type=str, default="base_model", help='model config name or path')
+    parser.add_argument('--checkpoint', type=str, default=None,
+                        help='torch / DeepSpeed model checkpoint, or tensor file (see scripts/convert_checkpoint.py)')
+    parser.add_argument('--dtype', type=str, default=None, help='cast floating point weights, e.g. to bfloat16')
+    parser.add_argument('--device', type=str, default="cpu")
+    parser.add_argument('--host', type=str, default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max_batch_size', type=int, default=16, help='most sequences decoded in one step')
+    parser.add_argument('--batch_window', type=float, default=0.01,
+                        help='seconds to wait for more requests before starting a new batch')
+    parser.add_argument('--max_queue', type=int, default=256, help='queued requests before rejecting new ones')
+    parser.add_argument('--max_tokens', type=int, default=256, help='upper limit on max_tokens of a request')
+    parser.add_argument('--threads', type=int, default=0, help='torch intra-op threads (0 = torch default)')
+    return parser.parse_args()
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class GenerationRequest:
+    def __init__(self, tokens, max_tokens, temperature=1., filter_logits_fn=None, filter_thres=0.9, eos_token=None,
+                 max_time=None):
+        self.tokens = torch.tensor(tokens, dtype=torch.long)
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.filter_logits_fn = filter_logits_fn
+        self.filter_thres = filter_thres
+        self.eos_token = eos_token
+        self.generated = []
+        self.new_tokens = asyncio.Queue()  # each sampled token as it's generated, then None once finished
+        self.enqueued = time.perf_counter()
+        self.deadline = self.enqueued + max_time if max_time is not None else None
+        self.started = None
+        self.first_token = None
+        self.finished = False
+        self.error = None  # why generation failed, if it did
+        self.cancelled = False  # set by the consumer to end generation early, e.g. on a stop string
+
+    @property
+    def done(self):
+        return self.cancelled or len(self.generated) >= self.max_tokens or \
+               (self.eos_token is not None and bool(self.generated) and self.generated[-1] == self.eos_token) or \
+               (self.deadline is not None and time.perf_counter() > self.deadline)
+
+
+class ServerMetrics:
+    def __init__(self, window=1000):
+        self.start = time.perf_counter()
+        self.requests = self.rejected = self.tokens = self.steps = 0
+        self.batch_size_total = 0
+        self.queue_times = deque(maxlen=window)
+        self.first_token_times = deque(maxlen=window)
+        self.latencies = deque(maxlen=window)
+        self.recent_steps = deque(maxlen=window)  # (time, tokens) of recent steps, for the current tokens/sec
+
+    def record_step(self, batch_size):
+        self.steps += 1
+        self.tokens += batch_size
+        self.batch_size_total += batch_size
+        self.recent_steps.append((time.perf_counter(), batch_size))
+
+    @staticmethod
+    def _percentiles(values):
+        if not values:
+            return {}
+        values = sorted(values)
+        return {f"p{p}": values[min(len(values) - 1, int(len(values) * p / 100))] for p in (50, 90, 99)}
+
+    def snapshot(self, queue_size):
+        elapsed = time.perf_counter() - self.start
+        recent_tps = 0.
+        if len(self.recent_steps) > 1:
+            span = self.recent_steps[-1][0] - self.recent_steps[0][0]
+            recent_tps = sum(n for _, n in list(self.recent_steps)[1:]) / max(span, 1e-9)
+        return {"requests": self.requests, "rejected": self.rejected, "queued": queue_size, "tokens": self.tokens,
+                "steps": self.steps, "mean_batch_size": self.batch_size_total / max(self.steps, 1),
+                "tokens_per_sec": self.tokens / max(elapsed, 1e-9), "recent_tokens_per_sec": recent_tps,
+                "queue_time": self._percentiles(self.queue_times),
+                "time_to_first_token": self._percentiles(self.first_token_times),
+                "latency": self._percentiles(self.latencies)}
+
+
+class BatchingEngine:
+    """decodes queued GenerationRequests in dynamically formed batches, one token per request per step"""
+    def __init__(self, model, max_batch_size=16, batch_window=0.01, max_queue=256):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self.queue = asyncio.Queue(max_queue)
+        self.metrics = ServerMetrics()
+        # the model runs in one background thread, so the event loop keeps accepting requests during a step
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def submit(self, request):
+        try:
+            self.queue.put_nowait(request)
+        except asyncio.QueueFull:
+            self.metrics.rejected += 1
+            raise QueueFullError()
+        self.metrics.requests += 1
+
+    async def _admit(self, active):
+        # waits for work if idle, then fills the batch with whatever is queued
+        loop = asyncio.get_running_loop()
+        if not active:
+            active.append(await self.queue.get())
+            deadline = loop.time() + self.batch_window
+            while len(active) < self.max_batch_size and loop.time() < deadline:
+                try:
+                    active.append(await asyncio.wait_for(self.queue.get(), deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    break
+        while len(active) < self.max_batch_size and not self.queue.empty():
+            active.append(self.queue.get_nowait())
+
+        now = time.perf_counter()
+        for r in active:
+            if r.started is None:
+                r.started = now
+                self.metrics.queue_times.append(now - r.enqueued)
+        # requests whose client went away don't take up a row
+        active[:] = [r for r in active if not r.cancelled]
+
+    def _step(self, active):
+        logits = next_token_logits(self.model.net, [torch.cat([r.tokens, torch.tensor(r.generated, dtype=torch.long)])
+                                                    for r in active])
+        tokens = []
+        for r, row in zip(active, logits):
+            tokens.append(int(sample(row[None], r.temperature, r.filter_logits_fn, r.filter_thres)))
+        return tokens
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        active = []
+        while True:
+            await self._admit(active)
+            if not active:
+                continue
+            try:
+                tokens = await loop.run_in_executor(self.executor, self._step, active)
+            except Exception:
+                # a failing step mustn't end the engine: step each request on its own, failing only those that
+                # still fail
+                tokens = []
+                for r in active:
+                    try:
+                        tokens.extend(await loop.run_in_executor(self.executor, self._step, [r]))
+                    except Exception as e:
+                        logging.exception("generation step failed")
+                        r.error = f"{type(e).__name__}: {e}"
+                        tokens.append(None)
+            self.metrics.record_step(sum(token is not None for token in tokens))
+            now = time.perf_counter()
+            for r, token in zip(active, tokens):
+                if token is None:
+                    r.finished = True
+                    r.new_tokens.put_nowait(None)
+                    continue
+                r.generated.append(token)
+                r.new_tokens.put_nowait(token)
+                if r.first_token is None:
+                    r.first_token = now
+                    self.metrics.first_token_times.append(now - r.enqueued)
+                if r.done:
+                    r.finished = True
+                    r.new_tokens.put_nowait(None)
+                    self.metrics.latencies.append(now - r.enqueued)
+            active = [r for r in active if not r.finished]
+
+
+class Server:
+    def __init__(self, engine, codec, max_tokens):
+        self.engine = engine
+        self.codec = codec
+        self.max_tokens = max_tokens
+
+    def _parse_request(self, body):
+        request = json.loads(body)
+        tokens = request["tokens"] if "tokens" in request else self.codec.encode(request["prompt"])
+        if not tokens:
+            raise ValueError("empty prompt")
+        num_tokens = self.engine.model.net.token_emb.num_embeddings
+        if not isinstance(tokens, list) or \
+                not all(isinstance(t, int) and not isinstance(t, bool) and 0 <= t < num_tokens for t in tokens):
+            raise ValueError(f"tokens should be a list of token ids in [0, {num_tokens})")
+        max_tokens = int(request.get("max_tokens", 64))
+        if max_tokens <= 0:
+            raise ValueError("max_tokens should be positive")
+        filter_name = request.get("filter", "top_k")
+        if filter_name is not None and filter_name not in FILTERS:
+            raise ValueError(f"filter should be one of {sorted(FILTERS)} or null")
+        return GenerationRequest(tokens, max_tokens=min(max_tokens, self.max_tokens),
+                                 temperature=float(request.get("temperature", 1.)),
+                                 filter_logits_fn=FILTERS.get(filter_name),
+                                 filter_thres=float(request.get("filter_thres", 0.9)),
+                                 eos_token=request.get("eos_token", self.codec.eos_token_id),
+                                 max_time=request.get("max_time")), request.get("stop"), bool(request.get("stream"))
+
+    async def _deltas(self, request, stop):
+        # yields text deltas as tokens arrive, cancelling the request at a stop string or if the consumer goes away
+        deltas = TextDeltas(self.codec, stop)
+        try:
+            while True:
+                token = await request.new_tokens.get()
+                if token is None:
+                    break
+                delta = deltas.add(token)
+                if delta:
+                    yield delta
+                if deltas.stopped:
+                    request.cancelled = True
+                    break
+            delta = deltas.flush()
+            if delta:
+                yield delta
+        finally:
+            if not request.finished:
+                request.cancelled = True
+
+    def _summary(self, request):
+        return {"tokens": request.generated, "queue_time": request.started - request.enqueued,
+                "time_to_first_token": request.first_token - request.enqueued if request.first_token else None,
+                "latency": time.perf_counter() - request.enqueued}
+
+    async def generate(self, body, writer):
+        try:
+            request, stop, stream = self._parse_request(body)
+        except (ValueError, KeyError, TypeError) as e:
+            return self._respond(writer, 400, {"error": f"bad request: {e}"})
+        try:
+            self.engine.submit(request)
+        except QueueFullError:
+            return self._respond(writer, 503, {"error": "server overloaded, retry later"})
+
+        if not stream:
+            text = "".join([delta async for delta in self._deltas(request, stop)])
+            if request.error is not None:
+                return self._respond(writer, 500, {"error": f"generation failed: {request.error}"})
+            return self._respond(writer, 200, {"text": text, **self._summary(request)})
+
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\nTransfer-Encoding: chunked\r\n\r\n")
+        try:
+            async for delta in self._deltas(request, stop):
+                self._write_chunk(writer, {"text": delta})
+                await writer.drain()  # raises if the client went away
+        finally:
+            if not request.finished:
+                request.cancelled = True  # frees the request's row in the batch at the next step
+        summary = self._summary(request)
+        if request.error is not None:
+            summary["error"] = f"generation failed: {request.error}"
+        self._write_chunk(writer, summary)
+        writer.write(b"0\r\n\r\n")
+
+    @staticmethod
+    def _write_chunk(writer, obj):
+        line = json.dumps(obj).encode() + b"\n"
+        writer.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+
+    @staticmethod
+    def _respond(writer, status, response):
+        payload = json.dumps(response).encode()
+        reason = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error",
+                  503: "Service Unavailable"}[status]
+        extra = "Retry-After: 1\r\n" if status == 503 else ""
+        writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\n"
+                     f"Content-Length: {len(payload)}\r\n{extra}\r\n".encode() + payload)
+
+    async def handle_connection(self, reader, writer):
+        # minimal HTTP/1.1 with keep-alive - enough for JSON requests from clients and the load generator
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, value = line.decode("latin-1").split(":", 1)
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                if method == "POST" and path == "/generate":
+                    await self.generate(body, writer)
+                elif method == "GET" and path == "/metrics":
+                    self._respond(writer, 200, self.engine.metrics.snapshot(self.engine.queue.qsize()))
+                else:
+                    self._respond(writer, 404, {"error": f"no route for {method} {path}"})
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+async def main(args):
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    params = get_params(args.model)
+    model, codec = load_model(params, args.checkpoint, device=args.device, dtype=get_dtype(args.dtype))
+    engine = BatchingEngine(model, max_batch_size=args.max_batch_size, batch_window=args.batch_window,
+                            max_queue=args.max_queue)
+    server = Server(engine, codec, args.max_tokens)
+    engine_task = asyncio.ensure_future(engine.run())
+    http_server = await asyncio.start_server(server.handle_connection, args.host, args.port)
+    print(f"Serving {args.model} on http://{args.host}:{args.port}")
+    async with http_server:
+        await asyncio.gather(http_server.serve_forever(), engine_task)
+
+
+if __name__ == '__main__':
+    asyncio.run(main(get_args()))
@@ -1,13 +1,19 @@
 import random
-import deepspeed
 import torch
 from torch.utils.data import DataLoader
-from tqdm.auto import trange
+from tqdm.auto import tqdm
 import torch.distributed as distributed
 
-from gpt_neox import (GPTNeoX, AutoregressiveWrapper, GPT2Dataset, extract_tarfile,
-                      prepare_optimizer_parameters, get_tokenizer, is_main, prepare_data)
+from gpt_neox import (GPTNeoX, AutoregressiveWrapper, GPT2Dataset, StreamingTextDataset, MixtureDataset, extract_tarfile,
+                      prepare_optimizer_parameters, get_tokenizer, is_main, prepare_data, cycle, synced_batches)
 
+from gpt_neox.async_checkpoint import (get_checkpointer, optimizer_stepped, resume, training_state, ResumableLoader,
+                                       ResumableSampler)
+from gpt_neox.checkpoint import get_dtype
+from gpt_neox.curriculum import get_seq_len_warmup
+from gpt_neox.engine import init_distributed, initialize
+from gpt_neox.evaluation import Evaluator, token_byte_lengths
+from gpt_neox.output_head import init_output_head
 from gpt_neox.utils import get_args, get_params
 
 train_args = get_args()
@@ -27,34 +33,81 @@ model = GPTNeoX(
     depth=params["n_layers"],
     heads=params["n_heads"],
     dim_head=params["dim_head"],
-    gradient_checkpointing=params.get("gradient_checkpointing", True)
+    # false (dense), true (DeepSpeed's sparse attention), a block sparse pattern ("local", "fixed", or a dict with
+    # "type" and its parameters - see gpt_neox/sparse_attention.py), or a list of those, one per layer
+    sparse_attn=params.get("sparse_attn", False),
+    gradient_checkpointing=params.get("gradient_checkpointing", True),
+    # an adaptive or sampled softmax head for large vocabularies - see gpt_neox/output_head.py
+    output_head=params.get("output_head"),
+    # "precision": "bfloat16" trains with bf16 autocast - native bf16 matmuls on CPUs that have them
+    autocast_dtype=get_dtype(params.get("precision"))
 )
 
 model = AutoregressiveWrapper(model)
-# prepare data
+# prepare data - "dataset" is either one dataset, or a list of datasets to mix, each with a sampling "weight" and
+# optionally a "max_epochs" cap
 dset_params = params["dataset"]
 assert dset_params is not None
+mixture_params = dset_params if isinstance(dset_params, list) else None
 
-deepspeed.init_distributed(dist_backend='nccl')
+# nccl on GPUs, gloo on CPUs - see gpt_neox/engine.py
+init_distributed(params)
 torch.distributed.barrier()  # barrier will force processes to stop until *all* processes have reached the barrier
 if is_main(train_args):
-    prepare_data(dset_params["name"])
+    for d in (mixture_params or [dset_params]):
+        prepare_data(d["name"], **d.get("preprocessing", {}))
     torch.distributed.barrier()  # barrier will force processes to stop until *all* processes have reached the barrier
 else:
     torch.distributed.barrier()
 
-train_dataset = GPT2Dataset(glob_pattern=dset_params["train_path"],
-                            seq_len=params["seq_len"],
-                            train=True,
-                            **dset_params)
-
-eval_dataset = GPT2Dataset(glob_pattern=dset_params["eval_path"],
-                           seq_len=params["seq_len"],
-                           train=False,
-                           **dset_params)
-
-val_loader = DataLoader(eval_dataset, batch_size=params["eval_batch_size"])
-val_loader = iter(val_loader)
+if mixture_params is not None:
+    # sources are mixed as they're read, so corpora never need to be combined on disk
+    names = [d["name"] for d in mixture_params]
+    weights = [d.get("weight", 1.0) for d in mixture_params]
+    seed = params.get("seed", mixture_params[0].get("seed", 1))
+    train_dataset = MixtureDataset([GPT2Dataset(glob_pattern=d["train_path"], seq_len=params["seq_len"], train=True, **d)
+                                    for d in mixture_params],
+                                   weights=weights, max_epochs=[d.get("max_epochs") for d in mixture_params],
+                                   names=names, seed=seed)
+    # each source is evaluated on its own, and sampled from in proportion for generation
+    eval_datasets = {d["name"]: GPT2Dataset(glob_pattern=d["eval_path"], seq_len=params["seq_len"], train=False, **d)
+                     for d in mixture_params}
+    eval_dataset = MixtureDataset(list(eval_datasets.values()), weights=weights, names=names, seed=seed)
+elif dset_params.get("pretokenized", True):
+    train_dataset = GPT2Dataset(glob_pattern=dset_params["train_path"],
+                                seq_len=params["seq_len"],
+                                train=True,
+                                **dset_params)
+
+    eval_dataset = GPT2Dataset(glob_pattern=dset_params["eval_path"],
+                               seq_len=params["seq_len"],
+                               train=False,
+                               **dset_params)
+else:
+    # raw text archives, tokenized on the fly
+    train_dataset = StreamingTextDataset(glob_pattern=dset_params["train_path"],
+                                         seq_len=params["seq_len"],
+                                         tokenizer=tokenizer,
+                                         **dset_params)
+
+    eval_dataset = StreamingTextDataset(glob_pattern=dset_params["eval_path"],
+                                        seq_len=params["seq_len"],
+                                        tokenizer=tokenizer,
+                                        **dset_params)
+
+val_loader = cycle(DataLoader(eval_dataset, batch_size=params["eval_batch_size"]))
+
+# full passes over the eval data every validate_every steps, split between all ranks - eval_batches caps the batches
+# each rank evaluates, for a cheaper estimate
+evaluator = Evaluator(eval_datasets if mixture_params is not None else eval_dataset,
+                      batch_size=params["eval_batch_size"], rank=torch.distributed.get_rank(),
+                      world_size=torch.distributed.get_world_size(), byte_lengths=token_byte_lengths(tokenizer),
+                      max_batches=params.get("eval_batches"), ignore_index=model.ignore_index)
+
+# orders the output head (if any) by token frequency - before the engine syncs the ranks' weights, and before a resumed
+# checkpoint overwrites the order it trained with
+init_output_head(model.net, params, train_dataset, rank=torch.distributed.get_rank(),
+                 world_size=torch.distributed.get_world_size())
 
 # optimizer
 if train_args.local_rank == -1: # non-deepspeed
@@ -66,46 +119,91 @@ else:
 # training
 ds_model_params = prepare_optimizer_parameters(model)
 
-# deepspeed loader
-model_engine, optim, _, _ = deepspeed.initialize(args=train_args,
-                                                            model=model,
-                                                            optimizer=optim,
-                                                            model_parameters=ds_model_params,
-                                                            training_data=None)
-
-train_loader = model_engine.deepspeed_io(train_dataset, pin_memory=params.get("pin_memory", False))
-
-pbar = trange(params.get("train_steps", 1), mininterval=10., desc='Training Model', dynamic_ncols=True)
-for _ in pbar:
-    for i, data in enumerate(train_loader):
-        if i > params["train_steps"]:
-            break
+# deepspeed loader, or DistributedDataParallel without deepspeed
+model_engine, optim, _, _ = initialize(args=train_args,
+                                       model=model,
+                                       params=params,
+                                       optimizer=optim,
+                                       model_parameters=ds_model_params,
+                                       training_data=None)
+
+train_sampler = None
+if isinstance(train_dataset, (StreamingTextDataset, MixtureDataset)):
+    # streaming datasets shard themselves across ranks, so they can't go through deepspeed's distributed sampler
+    train_loader = DataLoader(train_dataset, batch_size=model_engine.train_micro_batch_size_per_gpu(),
+                              pin_memory=params.get("pin_memory", False))
+else:
+    # a sampler that can start part way through an epoch, so resuming doesn't read the data already trained on
+    train_sampler = ResumableSampler(train_dataset, rank=torch.distributed.get_rank(),
+                                     world_size=torch.distributed.get_world_size(), seed=params.get("seed", 1))
+    train_loader = model_engine.deepspeed_io(train_dataset, pin_memory=params.get("pin_memory", False),
+                                             data_sampler=train_sampler)
+train_batches = ResumableLoader(train_loader, sampler=train_sampler, dataset=train_dataset)
+
+# ramps up the training sequence length, if the config has a seq_len_warmup section
+seq_len_warmup = get_seq_len_warmup(params)
+
+# checkpoints in the background every checkpoint_every steps, if the config has a checkpoint_dir, and resumes from
+# the newest one there
+checkpointer = get_checkpointer(params, rank=torch.distributed.get_rank(),
+                                world_size=torch.distributed.get_world_size())
+step = resume(checkpointer, model_engine, train_batches, seq_len_warmup)
+checkpoint_due = False
+
+train_steps = params.get("train_steps", 1)
+pbar = tqdm(total=train_steps, initial=step, mininterval=10., desc='Training Model', dynamic_ncols=True)
+while step < train_steps:
+    batches = train_batches.epoch_batches()
+    if train_sampler is None:
+        # ranks of a streaming dataset read unequal shares, so every rank stops when the first runs out
+        batches = synced_batches(batches, model_engine.device)
+    if seq_len_warmup is not None:
+        batches = seq_len_warmup.batches(batches)
+    epoch_start = step
+    for data in batches:
+        i = step
         model_engine.train()
         is_main = model_engine.local_rank == 0
-        data = data.to(model_engine.local_rank)
+        data = data.to(model_engine.device)
 
         loss = model_engine(data)
         model_engine.backward(loss)
         model_engine.step()
 
-        pbar.set_description(f'Training Loss: {loss.item():.4f}')
+        if seq_len_warmup is not None:
+            pbar.set_description(f'Training Loss: {loss.item():.4f}, seq_len: {seq_len_warmup.current_seq_len}')
+        else:
+            pbar.set_description(f'Training Loss: {loss.item():.4f}')
         pbar.update()
 
-        if params.get("validate_every") is not None:
-            if is_main and i % params["validate_every"] == 0:
-                model_engine.eval()
-                with torch.no_grad():
-                    val_data = next(val_loader).cuda()
-                    loss = model_engine(val_data)
-                    pbar.write(f'Validation Loss: {loss.item()}')
+        if params.get("validate_every") is not None and i % params["validate_every"] == 0:
+            metrics = evaluator.evaluate(model_engine.module)  # on every rank
+            if is_main:
+                pbar.write(f'Validation: {metrics}')
+                if isinstance(train_dataset, MixtureDataset):
+                    pbar.write(f'Data mixture: {train_dataset.metrics()}')
 
         if params.get("generate_every") is not None:
             if is_main and i % params["generate_every"] == 0:
                 model.eval()
-                val_data = next(val_loader).cuda()
+                val_data = next(val_loader).to(model_engine.device)
                 inp = random.choice(val_data)[:-1]
                 prime = tokenizer.decode(inp)
                 pbar.write(f"{prime} \n\n {'*' * 100}")
-                sample = model.generate(inp.cuda(), params["generate_length"])
+                sample = model.generate(inp, params["generate_length"])
                 output_str = tokenizer.decode(sample)
                 pbar.write(output_str)
+
+        step += 1
+        # checkpoints only right after an optimizer step, as accumulated gradients aren't saved
+        checkpoint_due = checkpoint_due or step % params.get("checkpoint_every", 1000) == 0
+        if checkpointer is not None and checkpoint_due and optimizer_stepped(model_engine):
+            checkpointer.save(step, training_state(step, model_engine, train_batches, seq_len_warmup))
+            checkpoint_due = False
+        if step >= train_steps:
+            break
+    if step == epoch_start:
+        break  # the data is exhausted
+
+if checkpointer is not None:
+    checkpointer.wait()
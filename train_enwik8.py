@@ -3,22 +3,30 @@ import json
 import random
 from collections import defaultdict
 
-import deepspeed
+import os
+
 import torch
 from torch.utils.data import DataLoader
 from tqdm.auto import trange
 
+from gpt_neox.async_checkpoint import (get_checkpointer, optimizer_stepped, resume, training_state, ResumableLoader,
+                                       ResumableSampler)
+from gpt_neox.checkpoint import get_dtype
+from gpt_neox.curriculum import get_seq_len_warmup
+from gpt_neox.engine import add_config_arguments, init_distributed, initialize
+from gpt_neox.output_head import init_output_head
 from gpt_neox import (GPTNeoX, AutoregressiveWrapper, TextSamplerDataset,
-                      cycle, prepare_optimizer_parameters, decode_tokens, read_enwik8_data, is_main, prepare_data)
+                      prepare_optimizer_parameters, decode_tokens, read_enwik8_data, is_main, prepare_data)
 
 
 def get_args():
     parser = argparse.ArgumentParser(description='GPTNeox Deepspeed Training Script')
     # Include DeepSpeed configuration arguments
     parser.add_argument('--model', type=str, default="base_model")
-    parser.add_argument('--local_rank', type=int, default=-1,
+    # torchrun passes the local rank in the environment rather than as an argument
+    parser.add_argument('--local_rank', type=int, default=int(os.environ.get("LOCAL_RANK", -1)),
                         help='local rank passed from distributed launcher')
-    parser = deepspeed.add_config_arguments(parser)
+    parser = add_config_arguments(parser)
     args = parser.parse_args()
     return args
 
@@ -40,12 +48,20 @@ model = GPTNeoX(
     seq_len=params["seq_len"],
     depth=params["n_layers"],
     heads=params["n_heads"],
-    dim_head=params["dim_head"]
+    dim_head=params["dim_head"],
+    # false (dense), true (DeepSpeed's sparse attention), a block sparse pattern ("local", "fixed", or a dict with
+    # "type" and its parameters - see gpt_neox/sparse_attention.py), or a list of those, one per layer
+    sparse_attn=params.get("sparse_attn", False),
+    # an adaptive or sampled softmax head for large vocabularies - see gpt_neox/output_head.py
+    output_head=params.get("output_head"),
+    # "precision": "bfloat16" trains with bf16 autocast - native bf16 matmuls on CPUs that have them
+    autocast_dtype=get_dtype(params.get("precision"))
 )
 
 model = AutoregressiveWrapper(model)
 dset_params = params["dataset"]
-deepspeed.init_distributed(dist_backend='nccl')
+# nccl on GPUs, gloo on CPUs - see gpt_neox/engine.py
+init_distributed(params)
 torch.distributed.barrier()  # barrier will force processes to stop until *all* processes have reached the barrier
 if is_main(train_args):
     prepare_data(dset_params["name"])
@@ -56,8 +72,12 @@ else:
 # prepare enwik8 data
 data_train, data_val = read_enwik8_data(dset_params["path"])
 train_dataset = TextSamplerDataset(data_train, params["seq_len"])
-val_dataset = TextSamplerDataset(data_val, params["seq_len"])
-val_loader = cycle(DataLoader(val_dataset, batch_size=params["batch_size"]))
+val_dataset = TextSamplerDataset(data_val, params["seq_len"], strided=True)
+
+# orders the output head (if any) by token frequency - before the engine syncs the ranks' weights, and before a resumed
+# checkpoint overwrites the order it trained with
+init_output_head(model.net, params, train_dataset, rank=torch.distributed.get_rank(),
+                 world_size=torch.distributed.get_world_size())
 
 # optimizer
 optim = torch.optim.Adam(model.parameters(), lr=params["learning_rate"])
@@ -65,24 +85,49 @@ optim = torch.optim.Adam(model.parameters(), lr=params["learning_rate"])
 # training
 ds_model_params = prepare_optimizer_parameters(model)
 
-# deepspeed loader
-model_engine, optim, train_loader, _ = deepspeed.initialize(args=train_args,
-                                                            model=model,
-                                                            optimizer=optim,
-                                                            model_parameters=ds_model_params,
-                                                            training_data=train_dataset)
-
-pbar = trange(params["num_epochs"], mininterval=10., desc='Training Model', dynamic_ncols=True)
+# deepspeed loader, or DistributedDataParallel without deepspeed
+model_engine, optim, _, _ = initialize(args=train_args,
+                                       model=model,
+                                       params=params,
+                                       optimizer=optim,
+                                       model_parameters=ds_model_params,
+                                       training_data=None)
+
+# a sampler that can start part way through an epoch, so resuming doesn't read the data already trained on
+train_sampler = ResumableSampler(train_dataset, rank=torch.distributed.get_rank(),
+                                 world_size=torch.distributed.get_world_size())
+# each batch is gathered with one indexing op, rather than collated from single windows
+train_loader = train_dataset.batch_loader(model_engine.train_micro_batch_size_per_gpu(), sampler=train_sampler)
+train_batches = ResumableLoader(train_loader, sampler=train_sampler)
+
+# ramps up the training sequence length, if the config has a seq_len_warmup section
+seq_len_warmup = get_seq_len_warmup(params)
+
+# checkpoints in the background every checkpoint_every steps, if the config has a checkpoint_dir, and resumes from
+# the newest one there
+checkpointer = get_checkpointer(params, rank=torch.distributed.get_rank(),
+                                world_size=torch.distributed.get_world_size())
+step = resume(checkpointer, model_engine, train_batches, seq_len_warmup)
+checkpoint_due = False
+
+pbar = trange(train_batches.epoch, params["num_epochs"], mininterval=10., desc='Training Model', dynamic_ncols=True)
 for _ in pbar:
-    for i, data in enumerate(train_loader):
+    batches = train_batches.epoch_batches()
+    if seq_len_warmup is not None:
+        batches = seq_len_warmup.batches(batches)
+    for data in batches:
+        i = step
         model_engine.train()
-        data = data.to(model_engine.local_rank)
+        data = data.to(model_engine.device)
 
         loss = model_engine(data)
         model_engine.backward(loss)
         model_engine.step()
 
-        pbar.set_description(f'Training Loss: {loss.item():.4f}')
+        if seq_len_warmup is not None:
+            pbar.set_description(f'Training Loss: {loss.item():.4f}, seq_len: {seq_len_warmup.current_seq_len}')
+        else:
+            pbar.set_description(f'Training Loss: {loss.item():.4f}')
         pbar.update()
 
         '''if is_main(train_args) and i % params["validate_every"] == 0:
@@ -100,3 +145,13 @@ for _ in pbar:
             sample = model.generate(inp.cuda(), params["generate_length"])
             output_str = decode_tokens(sample)
             pbar.write(output_str)'''
+
+        step += 1
+        # checkpoints only right after an optimizer step, as accumulated gradients aren't saved
+        checkpoint_due = checkpoint_due or step % params.get("checkpoint_every", 1000) == 0
+        if checkpointer is not None and checkpoint_due and optimizer_stepped(model_engine):
+            checkpointer.save(step, training_state(step, model_engine, train_batches, seq_len_warmup))
+            checkpoint_due = False
+
+if checkpointer is not None:
+    checkpointer.wait()
@@ -13,6 +13,7 @@ from gpt_neox import (GPTNeoX, AutoregressiveWrapper, TextSamplerDataset,
                       GPTNeoX_Pipe)
 from gpt_neox.utils import is_main, get_args, get_params
 from gpt_neox.data_utils import read_enwik8_data
+from gpt_neox.engine import init_distributed
 import gpt_neox
 
 WORLD_SIZE = os.getenv('WORLD_SIZE')
@@ -42,7 +43,9 @@ if __name__ == '__main__':
     # arguments
     train_args = get_args()
     params = get_params(train_args.model)
-    deepspeed.init_distributed(dist_backend='nccl')
+    # nccl on GPUs, gloo on CPUs - the pipeline engine needs deepspeed either way
+    params["engine"] = "deepspeed"
+    init_distributed(params)
     model = gpt_neox.GPTNeoX_Pipe(
         num_tokens=params["vocab_size"],
         dim=params["hidden_dim"],
@@ -50,6 +53,7 @@ if __name__ == '__main__':
         depth=params["n_layers"],
         heads=params["n_heads"],
         dim_head=params["dim_head"],
+        sparse_attn=params.get("sparse_attn", False),
         loss_fn = loss_function,
         num_stages = params.get("pipeline_num_stages", 2),
         activation_checkpoint_interval=params.get('activation_checkpoint_interval', 1)
@@ -60,8 +64,8 @@ if __name__ == '__main__':
     prepare_dataset(dset_params, train_args)
     data_train, data_val = read_enwik8_data(dset_params["path"])
     train_dataset = TextSamplerDataset(data_train, params["seq_len"], mode="with_labels")
-    val_dataset = TextSamplerDataset(data_val, params["seq_len"], mode="with_labels")
-    val_loader = cycle(DataLoader(val_dataset, batch_size=params["batch_size"]))
+    val_dataset = TextSamplerDataset(data_val, params["seq_len"], mode="with_labels", strided=True)
+    val_loader = cycle(val_dataset.batch_loader(params["batch_size"]))
 
     # optimizer
     ds_model_params = prepare_optimizer_parameters(model)
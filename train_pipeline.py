@@ -11,7 +11,9 @@ from tqdm.auto import trange
 from gpt_neox import (GPTNeoX, AutoregressiveWrapper, TextSamplerDataset,
                       cycle, prepare_optimizer_parameters, decode_tokens, prepare_data,
                       GPTNeoX_Pipe)
+from gpt_neox.async_checkpoint import get_checkpointer, resume, training_state, ResumableLoader, ResumableSampler
 from gpt_neox.datasets import GPT2Dataset
+from gpt_neox.engine import init_distributed
 from gpt_neox.data_utils import get_tokenizer
 from gpt_neox.utils import is_main, get_args, get_params
 import gpt_neox
@@ -42,7 +44,9 @@ if __name__ == '__main__':
     # arguments
     train_args = get_args()
     params = get_params(train_args.model)
-    deepspeed.init_distributed(dist_backend='nccl')
+    # nccl on GPUs, gloo on CPUs - the pipeline engine needs deepspeed either way
+    params["engine"] = "deepspeed"
+    init_distributed(params)
 
     # tokenizer
     tokenizer = get_tokenizer(tokenizer_type=params["tokenizer"].get("type", None),
@@ -58,6 +62,7 @@ if __name__ == '__main__':
         depth=params["n_layers"],
         heads=params["n_heads"],
         dim_head=params["dim_head"],
+        sparse_attn=params.get("sparse_attn", False),
         loss_fn = loss_function,
         num_stages = params.get("pipeline_num_stages", 2),
         activation_checkpoint_interval=params.get('activation_checkpoint_interval', 1)
@@ -86,18 +91,43 @@ if __name__ == '__main__':
     ds_model_params = prepare_optimizer_parameters(model)
     optim = torch.optim.Adam(ds_model_params, lr=params["learning_rate"])
     # deepspeed loader
-    model_engine, optim, train_loader, _ = deepspeed.initialize(args=train_args,
-                                                                model=model,
-                                                                optimizer=optim,
-                                                                model_parameters=ds_model_params,
-                                                                training_data=train_dataset)
+    model_engine, optim, _, _ = deepspeed.initialize(args=train_args,
+                                                     model=model,
+                                                     optimizer=optim,
+                                                     model_parameters=ds_model_params,
+                                                     training_data=None)
 
     configure_checkpointing(model_engine)
 
+    # a sampler that can start part way through an epoch, so resuming doesn't read the data already trained on.
+    # Only the first and last pipeline stages draw from it
+    grid = model_engine.grid
+    train_sampler = ResumableSampler(train_dataset, rank=grid.get_data_parallel_rank(),
+                                     world_size=grid.get_data_parallel_world_size())
+    train_batches = ResumableLoader(model_engine.deepspeed_io(train_dataset, data_sampler=train_sampler),
+                                    sampler=train_sampler)
+
+    def data_iter():
+        while True:
+            yield from train_batches.epoch_batches()
+
+    # checkpoints in the background every checkpoint_every steps, if the config has a checkpoint_dir, and resumes from
+    # the newest one there
+    checkpointer = get_checkpointer(params, rank=torch.distributed.get_rank(),
+                                    world_size=torch.distributed.get_world_size())
+    step = resume(checkpointer, model_engine, train_batches, dp_ranks=grid.dp_group)
+    train_iter = data_iter()
+
     batches_to_train = 10000
-    pbar = trange(batches_to_train, mininterval=10., desc='Training Model', dynamic_ncols=True)
+    pbar = trange(step, batches_to_train, mininterval=10., desc='Training Model', dynamic_ncols=True)
     for _ in pbar:
-        for i in range(batches_to_train):
-            loss = model_engine.train_batch()
-            pbar.set_description(f'Training Loss: {loss.item():.4f}')
-            pbar.update()
+        loss = model_engine.train_batch(data_iter=train_iter)
+        pbar.set_description(f'Training Loss: {loss.item():.4f}')
+
+        step += 1
+        # train_batch runs a whole gradient accumulation window, so every step ends with an optimizer step
+        if checkpointer is not None and step % params.get("checkpoint_every", 1000) == 0:
+            checkpointer.save(step, training_state(step, model_engine, train_batches))
+
+    if checkpointer is not None:
+        checkpointer.wait()